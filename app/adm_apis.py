@@ -1,14 +1,16 @@
 """
     flask handler for all admin API/data requests for dubweb
 """
+import csv
 import json
 from functools import wraps
-from flask import request, Response
+from flask import request, Response, stream_with_context
 from app import app
+from app.apis import convert_to_download_csv
 import app.admindb as admindb
 import app.utils as utils
 
-SETTINGS = utils.load_json_definition_file(admindb.SETTINGS_FILE)
+SETTINGS = utils.get_settings(admindb.SETTINGS_FILE)
 
 # Helpers, which flask requires first
 def clean_jsgrid_int(my_param):
@@ -23,7 +25,8 @@ def check_auth(name, pwd):
     """This function is called to check if a username /
     password combination is valid.
     """
-    return name == SETTINGS['adm_user'] and pwd == SETTINGS['adm_pass']
+    return name == SETTINGS.get_str('adm_user') and \
+           pwd == SETTINGS.get_str('adm_pass')
 
 def authenticate():
     """Sends a 401 response that enables basic auth"""
@@ -133,12 +136,64 @@ def admin_budget_clone():
     myids = admindb.AdmIDs(prv_id, team_id, prjid, bgt_id, div_id)
     src_month = request.form['source']
     dest_month = request.form['dest']
-    if SETTINGS['cloning_ok'] == 1:
-        new_bdgts = admindb.clone_budget_month(myids, src_month, dest_month)
-        return 'Clone: {0} budgets in {1}.'.format(len(new_bdgts), dest_month)
+    # optional: clone through dest_end, and scale by uplift percent
+    dest_end = request.form.get('dest_end', dest_month)
+    try:
+        uplift = float(request.form.get('uplift', 0))
+        dest_months = admindb.month_range(dest_month, dest_end)
+    except ValueError:
+        return 'Clone: bad dest, dest_end or uplift.', 400
+    if SETTINGS.get_int('cloning_ok', 0) == 1:
+        counts = admindb.clone_budget_months(myids, src_month, dest_months,
+                                             uplift)
+        return 'Clone: {0} budgets in {1} month(s), {2} skipped.'.format(
+            counts['Inserted'], len(dest_months), counts['Skipped'])
     else:
         return 'Clone not enabled for this dubweb instance.'
 
+@app.route('/data/budgets/upload', methods=['POST'])
+@requires_auth
+def admin_budget_upload():
+    """ API for upserting a matrix of budgets, as csv or json """
+    matrix = request.get_json(silent=True)
+    if matrix is None:
+        upload = request.files.get('file')
+        text = upload.read() if upload is not None else request.get_data()
+        matrix = list(csv.DictReader(text.splitlines()))
+    if not isinstance(matrix, list):
+        return json.dumps({"Budgets": 0,
+                           "Errors": ["expected a list of rows"]}), 400
+    result = admindb.upload_budget_matrix(matrix,
+                                          request.args.get('Comment'))
+    if result["Errors"]:
+        return json.dumps(result), 400
+    return json.dumps(result)
+
+@app.route('/data/budgets/export', methods=['GET'])
+def admin_budget_export():
+    """ API for downloading budgets as a matrix, in upload's format """
+    prv_id = clean_jsgrid_int(request.args.get('ProviderID'))
+    team_id = clean_jsgrid_int(request.args.get('TeamID'))
+    myids = admindb.AdmIDs(prv_id, team_id, None, None, None)
+    rows = admindb.iter_budget_matrix(myids, request.args.get('first'),
+                                      request.args.get('last'))
+    if request.args.get('format') != 'json':
+        return convert_to_download_csv(rows)
+
+    def generate():
+        """ Yield a json list, an object per team and provider """
+        header = next(rows, None)
+        sep = "["
+        for row in rows:
+            yield sep + json.dumps(dict((key, val) for key, val
+                                        in zip(header, row)
+                                        if val is not None))
+            sep = ",\n"
+        yield "[]" if sep == "[" else "]"
+
+    return Response(stream_with_context(generate()),
+                    mimetype="application/json")
+
 @app.route('/data/providers/list', methods=['GET'])
 def admin_providers_get():
     """ API for listing providers """
@@ -3,11 +3,12 @@
 """
 from flask import render_template
 from app import app
+import app.dimcache as dimcache
 import app.dubwebdb as dubwebdb
 import app.admindb as admindb
 import app.utils as utils
 
-ADM_SETTINGS = utils.load_json_definition_file(admindb.SETTINGS_FILE)
+ADM_SETTINGS = utils.get_settings(admindb.SETTINGS_FILE)
 
 @app.route('/budgets.html')
 def admin_budgets():
@@ -43,27 +44,16 @@ def admin_divisions():
 def load_adm_dropdowns():
     """  Load the data structures needed for layout.html pages"""
     settings = dict()
-    metadata = utils.load_json_definition_file(dubwebdb.SETTINGS_FILE)
-    success, db_conn = utils.open_monitoring_db(metadata['dbhost'],
-                                                metadata['dbuser'],
-                                                metadata['dbpass'],
-                                                metadata['db_db'])
-    if success:
-        providers = dubwebdb.get_providers(provider_id=None,
-                                           dub_conn=db_conn)
-        settings['providers'] = [item[0] for item in providers.values()]
-        settings['prvarray'] = providers
-        divisions = dubwebdb.get_divisions(div_ids=None, dub_conn=db_conn)
-        settings['divisions'] = [item for item in divisions.values()]
-        settings['divhash'] = divisions
-        teams = dubwebdb.get_teams(team_ids=None, dub_conn=db_conn)
-        settings['teams'] = [item for item in teams.values()]
-        settings['teamhash'] = teams
-        projects = dubwebdb.get_projects(provider_id=None, team_ids=None,
-                                         project_id=None, dub_conn=db_conn)
-        settings['projects'] = [item[0] for item in projects.values()]
-        settings['prjdict'] = projects
-        settings['enable_cloning'] = ADM_SETTINGS['cloning_ok']
-        db_conn.close()
+    dims = dimcache.get_dimensions(dubwebdb.SETTINGS_FILE)
+    settings['providers'] = [item[0] for item in dims.providers.values()]
+    settings['prvarray'] = dims.providers
+    settings['divisions'] = [item for item in dims.divisions.values()]
+    settings['divhash'] = dims.divisions
+    settings['teams'] = [item for item in dims.teams.values()]
+    settings['teamhash'] = dims.teams
+    projects = dict((prj, vals[:3]) for prj, vals in dims.projects.items())
+    settings['projects'] = [item[0] for item in projects.values()]
+    settings['prjdict'] = projects
+    settings['enable_cloning'] = ADM_SETTINGS.get_int('cloning_ok', 0)
 
     return dict(asettings=settings)
@@ -19,11 +19,16 @@ admindb helper library
    limitations under the License.
 """
 
+import re
 from app import app
+import app.dimcache as dimcache
 import app.utils as utils
 
 #globals
 SETTINGS_FILE = "/var/dubweb/.admin_settings"
+# leading columns of a budget matrix, the rest are YYYY-MM months
+MATRIX_KEYS = ["TeamID", "ProviderID"]
+MONTH_RE = re.compile(r'^[0-9]{4}-(0[1-9]|1[0-2])$')
 
 class AdmIDs(object):
     """
@@ -103,11 +108,7 @@ def get_budget_items(ids, m_filter, bgt_filter):
     """
     datalist = []
 
-    settings = utils.load_json_definition_file(SETTINGS_FILE)
-    success, dubconn = utils.open_monitoring_db(settings['dbhost'],
-                                                settings['dbuser'],
-                                                settings['dbpass'],
-                                                settings['db_db'])
+    success, dubconn = utils.open_settings_db(SETTINGS_FILE)
 
     if success:
         params = []
@@ -156,11 +157,7 @@ def edit_budget_item(ids, my_month, my_budget, my_comment, my_response):
     budget, or month
     Return modified budget entry.
     """
-    settings = utils.load_json_definition_file(SETTINGS_FILE)
-    success, dubconn = utils.open_monitoring_db(settings['dbhost'],
-                                                settings['dbuser'],
-                                                settings['dbpass'],
-                                                settings['db_db'])
+    success, dubconn = utils.open_settings_db(SETTINGS_FILE)
 
     if success:
         budget = format_budget(bgt_id=int(ids.budget),
@@ -187,9 +184,12 @@ def edit_budget_item(ids, my_month, my_budget, my_comment, my_response):
                              err.args[1])
             app.logger.error("generated by: %s", query)
             success = 0
+        if success:
+            utils.bump_data_version(dimcache.BUDGETS_VERSION, dubconn)
         dubconn.commit()
         cursor.close()
         dubconn.close()
+        dimcache.invalidate()
     return budget
 
 def insert_budget_item(ids, my_month, my_budget, my_comment, my_response):
@@ -197,11 +197,7 @@ def insert_budget_item(ids, my_month, my_budget, my_comment, my_response):
     Given providers, team, project, budget, month, and comments,
     Return inserted budget entry.
     """
-    settings = utils.load_json_definition_file(SETTINGS_FILE)
-    success, dubconn = utils.open_monitoring_db(settings['dbhost'],
-                                                settings['dbuser'],
-                                                settings['dbpass'],
-                                                settings['db_db'])
+    success, dubconn = utils.open_settings_db(SETTINGS_FILE)
 
     if success:
         budget = format_budget(bgt_id=None,
@@ -227,65 +223,232 @@ def insert_budget_item(ids, my_month, my_budget, my_comment, my_response):
                              err.args[1])
             app.logger.error("generated by: %s", query)
             success = 0
+        if success:
+            utils.bump_data_version(dimcache.BUDGETS_VERSION, dubconn)
         dubconn.commit()
         cursor.close()
         dubconn.close()
+        dimcache.invalidate()
     return get_budget_items(ids, my_month, my_budget)[0]
 
-def clone_budget_month(ids, src_month, dst_month):
+def month_range(first_month, last_month):
     """
-    Clone budget from source month into (empty) destination months.
-    Return destination month budgets.
+    Return the 'YYYY-MM' months from first_month through last_month,
+    empty if last_month is before first_month.  Raise ValueError if
+    either is not a YYYY-MM month.
     """
-    settings = utils.load_json_definition_file(SETTINGS_FILE)
-    success, dubconn = utils.open_monitoring_db(settings['dbhost'],
-                                                settings['dbuser'],
-                                                settings['dbpass'],
-                                                settings['db_db'])
+    year, month = [int(part) for part in first_month.split('-')]
+    last = [int(part) for part in last_month.split('-')]
+    if not 1 <= month <= 12 or len(last) != 2 or not 1 <= last[1] <= 12:
+        raise ValueError("not a YYYY-MM month range: %s to %s" %
+                         (first_month, last_month))
+    months = []
+    while [year, month] <= last:
+        months.append("%04d-%02d" % (year, month))
+        year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+    return months
+
+def clone_budget_months(ids, src_month, dst_months, uplift=0):
+    """
+    Clone budget from source month into each (empty) destination month,
+    scaled by an optional percentage uplift, with one INSERT ... SELECT
+    per month in one transaction.  Budgets already in a destination month
+    are left alone.
+    Return the counts of inserted and skipped (existing) budgets.
+    """
+    counts = {"Inserted": 0, "Skipped": 0}
+    success, dubconn = utils.open_settings_db(SETTINGS_FILE)
 
     if success:
         my_comment = "Cloned from " + src_month
+        if uplift:
+            my_comment += " %+g%%" % uplift
+        filters = ""
+        params = [src_month]
+        if ids.team is not None:
+            filters += " AND teamid = %s "
+            params.append(str(ids.team))
+        if ids.prv is not None:
+            filters += " AND prvid = %s "
+            params.append(str(ids.prv))
+        count_query = "SELECT COUNT(*) FROM budgetdata WHERE month = %s"
+        count_query += filters
         query = """
                     INSERT IGNORE INTO budgetdata
                     (budget, month, teamid, prvid, comment, response)
-                    VALUES (%s, %s, %s, %s, %s, %s)
-                """
+                    SELECT ROUND(budget * %s), %s, teamid, prvid, %s, NULL
+                    FROM budgetdata WHERE month = %s
+                """ + filters
+        scale = 1 + float(uplift) / 100
         cursor = dubconn.cursor()
-        src_budgets = get_budget_items(ids, m_filter=src_month,
-                                       bgt_filter=None)
-        for bdgt in src_budgets:
-            budget = format_budget(bgt_id=None,
-                                   bgt=int(bdgt['Budget']),
-                                   month=dst_month,
-                                   comment=my_comment,
-                                   team_id=int(bdgt['TeamID']),
-                                   prv_id=int(bdgt['ProviderID']),
-                                   response=None)
+        try:
+            cursor.execute(count_query, tuple(params))
+            src_count = int(cursor.fetchone()[0])
+            for dst_month in dst_months:
+                cursor.execute(query, tuple([scale, dst_month, my_comment] +
+                                            params))
+                counts["Inserted"] += cursor.rowcount
+                counts["Skipped"] += src_count - cursor.rowcount
+            if counts["Inserted"]:
+                utils.bump_data_version(dimcache.BUDGETS_VERSION, dubconn)
+            dubconn.commit()
+        except Exception, err:
+            app.logger.error("mysql exception: [%d]:  %s", err.args[0],
+                             err.args[1])
+            app.logger.error("generated by: %s", query)
+            dubconn.rollback()
+            counts = {"Inserted": 0, "Skipped": 0}
+        cursor.close()
+        dubconn.close()
+        dimcache.invalidate()
+    return counts
+
+def clone_budget_month(ids, src_month, dst_month, uplift=0):
+    """
+    Clone budget from source month into an (empty) destination month.
+    Return the counts of inserted and skipped budgets.
+    """
+    return clone_budget_months(ids, src_month, [dst_month], uplift)
+
+def parse_budget_matrix(rows, dims):
+    """
+    Given budget matrix rows (dicts of TeamID, ProviderID and YYYY-MM
+    month : budget, from csv or json) and the Dimensions to check ids
+    against, skipping empty cells, and rounding fractional budgets the
+    way the clone does...
+    Return ([(budget, month, teamid, prvid), ...], [error, ...]).
+    """
+    budgets = []
+    errors = []
+    for line, row in enumerate(rows, 1):
+        if not isinstance(row, dict):
+            errors.append("row %d: not a TeamID/ProviderID/month object" %
+                          line)
+            continue
+        try:
+            team_id = int(row.get("TeamID"))
+            prv_id = int(row.get("ProviderID"))
+        except (TypeError, ValueError):
+            errors.append("row %d: bad TeamID/ProviderID" % line)
+            continue
+        if team_id not in dims.teams:
+            errors.append("row %d: unknown TeamID %d" % (line, team_id))
+        if prv_id not in dims.providers:
+            errors.append("row %d: unknown ProviderID %d" % (line, prv_id))
+        for month, cell in sorted(row.iteritems()):
+            if month in MATRIX_KEYS or cell is None or cell == "":
+                continue
+            if not MONTH_RE.match(str(month)):
+                errors.append("row %d: bad month %s" % (line, month))
+                continue
+            try:
+                budget = int(round(float(cell)))
+            except (TypeError, ValueError, OverflowError):
+                errors.append("row %d: bad budget %s for %s" %
+                              (line, cell, month))
+                continue
+            budgets.append((budget, str(month), team_id, prv_id))
+    return budgets, errors
+
+def upload_budget_matrix(rows, my_comment=None):
+    """
+    Given budget matrix rows (see parse_budget_matrix), validate them all
+    against the cached dimensions, then upsert every budget with one
+    executemany on the (month, prvid, teamid) key, in one transaction.
+    Nothing is written if any row is invalid.
+    Return the counts of budgets written, and any errors.
+    """
+    result = {"Budgets": 0, "Errors": []}
+    success, dubconn = utils.open_settings_db(SETTINGS_FILE)
 
+    if success:
+        dims = dimcache.get_dimensions(SETTINGS_FILE, dubconn)
+        budgets, result["Errors"] = parse_budget_matrix(rows, dims)
+        if budgets and not result["Errors"]:
+            query = """
+                        INSERT INTO budgetdata
+                        (budget, month, teamid, prvid, comment)
+                        VALUES (%s, %s, %s, %s, %s)
+                        ON DUPLICATE KEY UPDATE budget = VALUES(budget)
+                    """
+            cursor = dubconn.cursor()
             try:
-                cursor.execute(query, (budget['Budget'], budget['Month'],
-                                       budget['TeamID'], budget['ProviderID'],
-                                       budget['Comment'], budget['Response']))
+                cursor.executemany(query, [budget + (my_comment,)
+                                           for budget in budgets])
+                utils.bump_data_version(dimcache.BUDGETS_VERSION, dubconn)
+                dubconn.commit()
+                result["Budgets"] = len(budgets)
             except Exception, err:
                 app.logger.error("mysql exception: [%d]:  %s", err.args[0],
                                  err.args[1])
                 app.logger.error("generated by: %s", query)
-                success = 0
-        dubconn.commit()
-        cursor.close()
+                dubconn.rollback()
+                result["Errors"].append("database error, nothing written")
+            cursor.close()
+            dimcache.invalidate()
         dubconn.close()
-    return get_budget_items(ids, m_filter=dst_month, bgt_filter=None)
+    else:
+        result["Errors"].append("no database connection")
+    return result
+
+def iter_budget_matrix(ids, first_month, last_month):
+    """
+    Given optional team/provider ids and an optional month range...
+    Yield the budgets as a matrix: a header row (MATRIX_KEYS and the
+    months), then a row per team and provider, blank where there is no
+    budget.  Rows are streamed from the server as they are pivoted.
+    """
+    success, dubconn = utils.open_settings_db(SETTINGS_FILE)
+
+    if success:
+        try:
+            filters = ""
+            params = []
+            if ids.team is not None:
+                filters += " AND teamid = %s "
+                params.append(str(ids.team))
+            if ids.prv is not None:
+                filters += " AND prvid = %s "
+                params.append(str(ids.prv))
+            if first_month is not None:
+                filters += " AND month >= %s "
+                params.append(first_month)
+            if last_month is not None:
+                filters += " AND month <= %s "
+                params.append(last_month)
+
+            month_query = "SELECT DISTINCT month FROM budgetdata WHERE 1"
+            month_query += filters + " ORDER BY month"
+            months = [row[0] for row in utils.get_from_db(month_query,
+                                                          tuple(params),
+                                                          dubconn)]
+            yield MATRIX_KEYS + months
+
+            query = "SELECT teamid, prvid, month, budget FROM budgetdata"
+            query += " WHERE 1" + filters + " ORDER BY teamid, prvid, month"
+            columns = dict((month, idx + len(MATRIX_KEYS))
+                           for idx, month in enumerate(months))
+            datarow = None
+            for team_id, prv_id, month, budget in utils.stream_from_db(
+                    query, tuple(params), dubconn):
+                if datarow is None or datarow[:2] != [team_id, prv_id]:
+                    if datarow is not None:
+                        yield datarow
+                    datarow = [team_id, prv_id] + [None] * len(months)
+                # a month budgeted since the header was read is left out
+                if month in columns:
+                    datarow[columns[month]] = budget
+            if datarow is not None:
+                yield datarow
+        finally:
+            dubconn.close()
 
 def delete_budget_item(ids, my_month, my_budget, my_comment):
     """
     Given budget id, delete from db
     Return deleted budget entry.
     """
-    settings = utils.load_json_definition_file(SETTINGS_FILE)
-    success, dubconn = utils.open_monitoring_db(settings['dbhost'],
-                                                settings['dbuser'],
-                                                settings['dbpass'],
-                                                settings['db_db'])
+    success, dubconn = utils.open_settings_db(SETTINGS_FILE)
 
     if success:
         budget = get_budget_items(ids, my_month, my_budget)
@@ -303,9 +466,12 @@ def delete_budget_item(ids, my_month, my_budget, my_comment):
                              err.args[1])
             app.logger.error("generated by: %s", query)
             success = 0
+        if success:
+            utils.bump_data_version(dimcache.BUDGETS_VERSION, dubconn)
         dubconn.commit()
         cursor.close()
         dubconn.close()
+        dimcache.invalidate()
     return budget[0]
 
 def get_providers_admin(ids):
@@ -315,11 +481,7 @@ def get_providers_admin(ids):
     """
     datalist = []
 
-    settings = utils.load_json_definition_file(SETTINGS_FILE)
-    success, dubconn = utils.open_monitoring_db(settings['dbhost'],
-                                                settings['dbuser'],
-                                                settings['dbpass'],
-                                                settings['db_db'])
+    success, dubconn = utils.open_settings_db(SETTINGS_FILE)
 
     if success:
         params = []
@@ -353,11 +515,7 @@ def get_team_items(ids, name_filter):
     """
     datalist = []
 
-    settings = utils.load_json_definition_file(SETTINGS_FILE)
-    success, dubconn = utils.open_monitoring_db(settings['dbhost'],
-                                                settings['dbuser'],
-                                                settings['dbpass'],
-                                                settings['db_db'])
+    success, dubconn = utils.open_settings_db(SETTINGS_FILE)
 
     if success:
         params = []
@@ -394,11 +552,7 @@ def edit_team_item(ids, my_teamname):
     Given team id, modified teamname, and division id
     Return modified team entry.
     """
-    settings = utils.load_json_definition_file(SETTINGS_FILE)
-    success, dubconn = utils.open_monitoring_db(settings['dbhost'],
-                                                settings['dbuser'],
-                                                settings['dbpass'],
-                                                settings['db_db'])
+    success, dubconn = utils.open_settings_db(SETTINGS_FILE)
 
     if success:
         team = format_team(team_id=int(ids.team), name=my_teamname,
@@ -417,9 +571,12 @@ def edit_team_item(ids, my_teamname):
                              err.args[1])
             app.logger.error("generated by: %s", query)
             success = 0
+        if success:
+            utils.bump_data_version(dimcache.DIMENSIONS_VERSION, dubconn)
         dubconn.commit()
         cursor.close()
         dubconn.close()
+        dimcache.invalidate()
     return team
 
 def insert_team_item(ids, my_teamname):
@@ -427,11 +584,7 @@ def insert_team_item(ids, my_teamname):
     Given team, name and division id
     Return inserted team entry.
     """
-    settings = utils.load_json_definition_file(SETTINGS_FILE)
-    success, dubconn = utils.open_monitoring_db(settings['dbhost'],
-                                                settings['dbuser'],
-                                                settings['dbpass'],
-                                                settings['db_db'])
+    success, dubconn = utils.open_settings_db(SETTINGS_FILE)
 
     if success:
         query = """
@@ -447,9 +600,12 @@ def insert_team_item(ids, my_teamname):
                              err.args[1])
             app.logger.error("generated by: %s", query)
             success = 0
+        if success:
+            utils.bump_data_version(dimcache.DIMENSIONS_VERSION, dubconn)
         dubconn.commit()
         cursor.close()
         dubconn.close()
+        dimcache.invalidate()
     return get_team_items(ids, my_teamname)[0]
 
 def delete_team_item(ids, my_teamname):
@@ -457,11 +613,7 @@ def delete_team_item(ids, my_teamname):
     Given team id, delete from db
     Return deleted team entry.
     """
-    settings = utils.load_json_definition_file(SETTINGS_FILE)
-    success, dubconn = utils.open_monitoring_db(settings['dbhost'],
-                                                settings['dbuser'],
-                                                settings['dbpass'],
-                                                settings['db_db'])
+    success, dubconn = utils.open_settings_db(SETTINGS_FILE)
 
     if success:
         team = format_team(team_id=int(ids.team), name=my_teamname,
@@ -480,9 +632,12 @@ def delete_team_item(ids, my_teamname):
                              err.args[1])
             app.logger.error("generated by: %s", query)
             success = 0
+        if success:
+            utils.bump_data_version(dimcache.DIMENSIONS_VERSION, dubconn)
         dubconn.commit()
         cursor.close()
         dubconn.close()
+        dimcache.invalidate()
     return team
 
 def get_division_items(ids, name_filter):
@@ -492,11 +647,7 @@ def get_division_items(ids, name_filter):
     """
     datalist = []
 
-    settings = utils.load_json_definition_file(SETTINGS_FILE)
-    success, dubconn = utils.open_monitoring_db(settings['dbhost'],
-                                                settings['dbuser'],
-                                                settings['dbpass'],
-                                                settings['db_db'])
+    success, dubconn = utils.open_settings_db(SETTINGS_FILE)
 
     if success:
         params = []
@@ -528,11 +679,7 @@ def edit_division_item(ids, my_divname):
     Given division id and modified divisionname,
     Return modified division entry.
     """
-    settings = utils.load_json_definition_file(SETTINGS_FILE)
-    success, dubconn = utils.open_monitoring_db(settings['dbhost'],
-                                                settings['dbuser'],
-                                                settings['dbpass'],
-                                                settings['db_db'])
+    success, dubconn = utils.open_settings_db(SETTINGS_FILE)
 
     if success:
         division = format_division(div_id=int(ids.div), name=my_divname)
@@ -549,9 +696,12 @@ def edit_division_item(ids, my_divname):
                              err.args[1])
             app.logger.error("generated by: %s", query)
             success = 0
+        if success:
+            utils.bump_data_version(dimcache.DIMENSIONS_VERSION, dubconn)
         dubconn.commit()
         cursor.close()
         dubconn.close()
+        dimcache.invalidate()
     return division
 
 def insert_division_item(ids, my_divname):
@@ -559,11 +709,7 @@ def insert_division_item(ids, my_divname):
     Given division name,
     Return inserted division entry.
     """
-    settings = utils.load_json_definition_file(SETTINGS_FILE)
-    success, dubconn = utils.open_monitoring_db(settings['dbhost'],
-                                                settings['dbuser'],
-                                                settings['dbpass'],
-                                                settings['db_db'])
+    success, dubconn = utils.open_settings_db(SETTINGS_FILE)
 
     if success:
         query = """
@@ -579,9 +725,12 @@ def insert_division_item(ids, my_divname):
                              err.args[1])
             app.logger.error("generated by: %s", query)
             success = 0
+        if success:
+            utils.bump_data_version(dimcache.DIMENSIONS_VERSION, dubconn)
         dubconn.commit()
         cursor.close()
         dubconn.close()
+        dimcache.invalidate()
     return get_division_items(ids, my_divname)[0]
 
 def delete_division_item(ids, my_divname):
@@ -589,11 +738,7 @@ def delete_division_item(ids, my_divname):
     Given division id, delete from db
     Return deleted division entry.
     """
-    settings = utils.load_json_definition_file(SETTINGS_FILE)
-    success, dubconn = utils.open_monitoring_db(settings['dbhost'],
-                                                settings['dbuser'],
-                                                settings['dbpass'],
-                                                settings['db_db'])
+    success, dubconn = utils.open_settings_db(SETTINGS_FILE)
 
     if success:
         division = format_division(div_id=int(ids.div), name=my_divname)
@@ -611,9 +756,12 @@ def delete_division_item(ids, my_divname):
                              err.args[1])
             app.logger.error("generated by: %s", query)
             success = 0
+        if success:
+            utils.bump_data_version(dimcache.DIMENSIONS_VERSION, dubconn)
         dubconn.commit()
         cursor.close()
         dubconn.close()
+        dimcache.invalidate()
     return division
 
 def get_project_items(ids, name_filter, extid_filter):
@@ -624,11 +772,7 @@ def get_project_items(ids, name_filter, extid_filter):
     """
     datalist = []
 
-    settings = utils.load_json_definition_file(SETTINGS_FILE)
-    success, dubconn = utils.open_monitoring_db(settings['dbhost'],
-                                                settings['dbuser'],
-                                                settings['dbpass'],
-                                                settings['db_db'])
+    success, dubconn = utils.open_settings_db(SETTINGS_FILE)
 
     if success:
         params = []
@@ -675,11 +819,7 @@ def edit_project_item(ids, my_extname, my_extid):
     or external id,
     Return modified project entry.
     """
-    settings = utils.load_json_definition_file(SETTINGS_FILE)
-    success, dubconn = utils.open_monitoring_db(settings['dbhost'],
-                                                settings['dbuser'],
-                                                settings['dbpass'],
-                                                settings['db_db'])
+    success, dubconn = utils.open_settings_db(SETTINGS_FILE)
 
     if success:
         project = format_project(prj_id=int(ids.project),
@@ -703,9 +843,12 @@ def edit_project_item(ids, my_extname, my_extid):
                              err.args[1])
             app.logger.error("generated by: %s", query)
             success = 0
+        if success:
+            utils.bump_data_version(dimcache.DIMENSIONS_VERSION, dubconn)
         dubconn.commit()
         cursor.close()
         dubconn.close()
+        dimcache.invalidate()
     return project
 
 def insert_project_item(ids, my_extname, my_extid):
@@ -713,11 +856,7 @@ def insert_project_item(ids, my_extname, my_extid):
     Given providers, team, project, extname, and extid
     Return inserted project entry.
     """
-    settings = utils.load_json_definition_file(SETTINGS_FILE)
-    success, dubconn = utils.open_monitoring_db(settings['dbhost'],
-                                                settings['dbuser'],
-                                                settings['dbpass'],
-                                                settings['db_db'])
+    success, dubconn = utils.open_settings_db(SETTINGS_FILE)
 
     if success:
         project = format_project(prj_id=None,
@@ -740,9 +879,12 @@ def insert_project_item(ids, my_extname, my_extid):
                              err.args[1])
             app.logger.error("generated by: %s", query)
             success = 0
+        if success:
+            utils.bump_data_version(dimcache.DIMENSIONS_VERSION, dubconn)
         dubconn.commit()
         cursor.close()
         dubconn.close()
+        dimcache.invalidate()
     return get_project_items(ids, my_extname, my_extid)[0]
 
 def delete_project_item(ids, my_extname, my_extid):
@@ -750,11 +892,7 @@ def delete_project_item(ids, my_extname, my_extid):
     Given project id, delete from db
     Return deleted project entry.
     """
-    settings = utils.load_json_definition_file(SETTINGS_FILE)
-    success, dubconn = utils.open_monitoring_db(settings['dbhost'],
-                                                settings['dbuser'],
-                                                settings['dbpass'],
-                                                settings['db_db'])
+    success, dubconn = utils.open_settings_db(SETTINGS_FILE)
 
     if success:
         project = format_project(prj_id=int(ids.project),
@@ -776,8 +914,11 @@ def delete_project_item(ids, my_extname, my_extid):
                              err.args[1])
             app.logger.error("generated by: %s", query)
             success = 0
+        if success:
+            utils.bump_data_version(dimcache.DIMENSIONS_VERSION, dubconn)
         dubconn.commit()
         cursor.close()
         dubconn.close()
+        dimcache.invalidate()
     return project
 
@@ -1,15 +1,18 @@
 """
     flask handler for all usage API requests for dubweb
 """
+import json
 import time
 import csv
-import StringIO
-from flask import request, make_response
+from flask import request, Response, stream_with_context
 from app import app
 import app.dubwebdb as dubwebdb
+import app.respcache as respcache
+import app.utils as utils
 
 # Define all customer APIs
 @app.route('/data/monthly/provider')
+@respcache.cached()
 def current_chart_provider_monthly():
     """ API for monthly provider chart """
     mytime = dubwebdb.CTimes("%Y-%m", request.args.get('time_start'),
@@ -26,6 +29,7 @@ def current_chart_provider_monthly():
         return dubwebdb.get_data_provider(mytime, myids, add_budget=True)
 
 @app.route('/data/monthly/overunder')
+@respcache.cached()
 def current_chart_overunder_monthly():
     """ API for monthly provider chart """
     mytime = dubwebdb.CTimes("%Y-%m", request.args.get('time_start'),
@@ -43,6 +47,7 @@ def current_chart_overunder_monthly():
 
 
 @app.route('/data/daily/provider')
+@respcache.cached()
 def current_chart_provider_daily():
     """ API for daily provider chart """
     mytime = dubwebdb.CTimes("%Y-%m-%d",
@@ -55,6 +60,7 @@ def current_chart_provider_daily():
     return dubwebdb.get_data_provider(mytime, myids, add_budget=False)
 
 @app.route('/data/monthly/team')
+@respcache.cached()
 def current_chart_team_monthly():
     """ API for monthly Team chart """
     mytime = dubwebdb.CTimes("%Y-%m", request.args.get('time_start'),
@@ -71,6 +77,7 @@ def current_chart_team_monthly():
         return dubwebdb.get_data_team(mytime, myids, add_budget=True)
 
 @app.route('/data/monthly/division')
+@respcache.cached()
 def current_chart_division_monthly():
     """ API for monthly Division chart """
     mytime = dubwebdb.CTimes("%Y-%m", request.args.get('time_start'),
@@ -87,6 +94,7 @@ def current_chart_division_monthly():
         return dubwebdb.get_data_div(mytime, myids, add_budget=True)
 
 @app.route('/data/daily/team')
+@respcache.cached()
 def current_chart_team_daily():
     """ API for daily Team chart """
     mytime = dubwebdb.CTimes("%Y-%m-%d", request.args.get('time_start'),
@@ -98,6 +106,7 @@ def current_chart_team_daily():
     return dubwebdb.get_data_team(mytime, myids, add_budget=False)
 
 @app.route('/data/monthly/project')
+@respcache.cached()
 def current_chart_project_monthly():
     """ API for monthly Project chart """
     mytime = dubwebdb.CTimes("%Y-%m", request.args.get('time_start'),
@@ -114,6 +123,7 @@ def current_chart_project_monthly():
         return dubwebdb.get_data_project(mytime, myids, add_budget=False)
 
 @app.route('/data/daily/project')
+@respcache.cached()
 def current_chart_project_daily():
     """ API for daily Project chart """
     mytime = dubwebdb.CTimes("%Y-%m-%d", request.args.get('time_start'),
@@ -125,6 +135,7 @@ def current_chart_project_daily():
     return dubwebdb.get_data_project(mytime, myids, add_budget=False)
 
 @app.route('/data/daily/workload')
+@respcache.cached()
 def current_chart_workload_daily():
     """ API for daily Workload chart """
     mytime = dubwebdb.CTimes("%Y-%m-%d", request.args.get('time_start'),
@@ -136,6 +147,7 @@ def current_chart_workload_daily():
     return dubwebdb.get_data_workload(mytime, myids, add_budget=False)
 
 @app.route('/est/monthly/provider')
+@respcache.cached(now_dependent=True)
 def future_chart_provider_monthly():
     """ API for estimating monthly provider chart """
     mytime = dubwebdb.CTimes("%Y-%m", request.args.get('time_start'),
@@ -144,9 +156,12 @@ def future_chart_provider_monthly():
                          team_id=sanitize_list(request.args.get('teamid')),
                          project_id=request.args.get('prjid'),
                          div_id=None)
-    return dubwebdb.estimate_data_provider(mytime, myids, add_budget=True)
+    bands = bool(request.args.get('bands'))
+    return dubwebdb.estimate_data_provider(mytime, myids, add_budget=True,
+                                           add_bands=bands)
 
 @app.route('/est/monthly/team')
+@respcache.cached(now_dependent=True)
 def future_chart_team_monthly():
     """ API for estimating monthly team chart """
     mytime = dubwebdb.CTimes("%Y-%m", request.args.get('time_start'),
@@ -155,21 +170,85 @@ def future_chart_team_monthly():
                          team_id=sanitize_list(request.args.get('teamid')),
                          project_id=request.args.get('prjid'),
                          div_id=None)
-    return dubwebdb.estimate_data_team(mytime, myids, add_budget=True)
+    bands = bool(request.args.get('bands'))
+    return dubwebdb.estimate_data_team(mytime, myids, add_budget=True,
+                                       add_bands=bands)
+
+@app.route('/est/monthly/project')
+@respcache.cached(now_dependent=True)
+def future_chart_project_monthly():
+    """ API for estimating monthly project chart """
+    mytime = dubwebdb.CTimes("%Y-%m", request.args.get('time_start'),
+                             request.args.get('time_end'))
+    myids = dubwebdb.Ids(prv_id=sanitize_list(request.args.get('prvid')),
+                         team_id=sanitize_list(request.args.get('teamid')),
+                         project_id=request.args.get('prjid'),
+                         div_id=None)
+    bands = bool(request.args.get('bands'))
+    return dubwebdb.estimate_data_project(mytime, myids, add_bands=bands)
+
+@app.route('/est/monthly/division')
+@respcache.cached(now_dependent=True)
+def future_chart_division_monthly():
+    """ API for estimating monthly division chart """
+    mytime = dubwebdb.CTimes("%Y-%m", request.args.get('time_start'),
+                             request.args.get('time_end'))
+    myids = dubwebdb.Ids(prv_id=sanitize_list(request.args.get('prvid')),
+                         team_id=None,
+                         project_id=request.args.get('prjid'),
+                         div_id=sanitize_list(request.args.get('divid')))
+    bands = bool(request.args.get('bands'))
+    return dubwebdb.estimate_data_div(mytime, myids, add_budget=True,
+                                      add_bands=bands)
+
+@app.route('/est/monthly/workload')
+@respcache.cached(now_dependent=True)
+def future_chart_workload_monthly():
+    """ API for estimating monthly workload chart """
+    if not request.args.get('prvid') or not request.args.get('prjid'):
+        return 'Workload estimates need prvid and prjid.', 400
+    mytime = dubwebdb.CTimes("%Y-%m", request.args.get('time_start'),
+                             request.args.get('time_end'))
+    myids = dubwebdb.Ids(prv_id=sanitize_list(request.args.get('prvid')),
+                         team_id=None,
+                         project_id=request.args.get('prjid'),
+                         div_id=None)
+    bands = bool(request.args.get('bands'))
+    return dubwebdb.estimate_data_workload(mytime, myids, add_bands=bands)
+
+@app.route('/data/stats/dbpool')
+def stats_db_pool():
+    """ API for per-pool MySQL connection counters of this worker """
+    return json.dumps(utils.get_pool_stats())
+
+@app.route('/data/stats/respcache')
+def stats_resp_cache():
+    """ API for response cache hit/miss/byte counters """
+    return json.dumps(respcache.get_stats())
+
+class _EchoWriter(object):
+    """ File-like object handing back whatever csv.writer writes """
+    def write(self, value):
+        """ Return the formatted row instead of buffering it """
+        return value
 
 def convert_to_download_csv(rows):
     """
-    Given a list with header and body rows,
-    Return an http response that will be downloaded as csv
+    Given an iterable with header and body rows,
+    Return a streamed http response that will be downloaded as csv,
+    formatting one row at a time.
     """
     timestr = time.strftime("%Y%m%d_%H%M%S")
     content_disp = "attachment; filename=export_" + timestr + ".csv"
-    sio = StringIO.StringIO()
-    cwrtr = csv.writer(sio)
-    cwrtr.writerows(rows)
-    output = make_response(sio.getvalue())
+
+    def generate():
+        """ Yield each row as a line of csv """
+        cwrtr = csv.writer(_EchoWriter())
+        for row in rows:
+            yield cwrtr.writerow(row)
+
+    output = Response(stream_with_context(generate()), mimetype="text/csv")
     output.headers["Content-Disposition"] = content_disp
-    output.headers["Content-type"] = "text/csv"
     return output
 
 def sanitize_list(mylist):
@@ -1,10 +1,27 @@
 """
     flask handler for all capacity API requests for dubweb
 """
+import time
 from flask import request
 from app import app
 import app.raxutils as raxutils
 import app.capdb as capdb
+import app.respcache as respcache
+
+
+def past_date_only(req):
+    """
+    Return True if the request's opt_date is a day before today, whose
+    perfdata can no longer change.
+    """
+    opt_date = req.args.get('opt_date')
+    if opt_date is None:
+        return False
+    today = time.mktime(time.localtime()[:3] + (0, 0, 0, 0, 0, -1))
+    try:
+        return float(opt_date) < today
+    except ValueError:
+        return False
 
 
 @app.route('/data/rackspace/host_check')
@@ -30,6 +47,8 @@ def cloud_host_map():
     return raxutils.get_vm_hostmap(mydc, myacct)
 
 @app.route('/data/capacity/estimates')
+@respcache.cached(now_dependent=True, versions_fn=capdb.get_cap_versions,
+                  disk=False)
 def capacity_estimates():
     """ API for Capacity Estimates chart """
     myids = request.args.get('ids')
@@ -38,6 +57,8 @@ def capacity_estimates():
     return capdb.get_capacity_daily(myids, add_limits=False)
 
 @app.route('/data/capacity/model')
+@respcache.cached(now_dependent=False, versions_fn=capdb.get_cap_versions,
+                  disk=False, when=past_date_only)
 def capacity_model():
     """ API for Capacity Forecast chart """
     myids = request.args.get('ids')
@@ -45,6 +66,8 @@ def capacity_model():
     return capdb.get_capacity_model(myids, mydate)
 
 @app.route('/data/capacity/actuals')
+@respcache.cached(now_dependent=False, versions_fn=capdb.get_cap_versions,
+                  disk=False, when=past_date_only)
 def capacity_actuals():
     """ API for Capacity Actuals """
     myids = request.args.get('ids')
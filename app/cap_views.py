@@ -23,11 +23,8 @@ def capacity_reports():
 def load_cap_dropdowns():
     """  Load the data structures needed for layout_cap.html capacity pages"""
     settings = dict()
-    metadata = utils.load_json_definition_file(capdb.SETTINGS_FILE)
-    success, cdb_conn = utils.open_monitoring_db(metadata['cdbhost'],
-                                                 metadata['cdbuser'],
-                                                 metadata['cdbpass'],
-                                                 metadata['cdb_db'])
+    success, cdb_conn = utils.open_settings_db(capdb.SETTINGS_FILE,
+                                               prefix="c")
     if success:
         capmetrics = capdb.get_cap_ids(cap_ids=None, cap_conn=cdb_conn)
         settings['caparray'] = capmetrics
@@ -57,6 +57,27 @@ def get_cap_ids(cap_ids, cap_conn):
     return capdict
 
 
+def get_cap_versions():
+    """
+    Return the capacity data versions: 'lastetl', the newest
+    capacity_types.lastetl as epoch seconds; empty if it could not be
+    read, so responses are neither cached nor validated.
+    """
+    versions = {}
+    success, capconn = utils.open_settings_db(SETTINGS_FILE, prefix="c")
+
+    if success:
+        query = """
+                SELECT IFNULL(UNIX_TIMESTAMP(MAX(lastetl)), 0)
+                FROM capacity_types
+                """
+        rows = utils.get_from_db(query, None, capconn)
+        if rows:
+            versions['lastetl'] = int(rows[0][0])
+        capconn.close()
+    return versions
+
+
 def get_capacity_daily(ids, add_limits):
     """
     Given a list of capacity metric ids, and optional flags
@@ -67,11 +88,7 @@ def get_capacity_daily(ids, add_limits):
     query_params = []
     capmetrics = []
 
-    settings = utils.load_json_definition_file(SETTINGS_FILE)
-    success, capconn = utils.open_monitoring_db(settings['cdbhost'],
-                                                settings['cdbuser'],
-                                                settings['cdbpass'],
-                                                settings['cdb_db'])
+    success, capconn = utils.open_settings_db(SETTINGS_FILE, prefix="c")
 
     if success:
         cap_ids = get_cap_ids(ids, capconn)
@@ -135,11 +152,7 @@ def get_capacity_model(ids, opt_date):
     """
     capmodels = {}
 
-    settings = utils.load_json_definition_file(SETTINGS_FILE)
-    success, capconn = utils.open_monitoring_db(settings['cdbhost'],
-                                                settings['cdbuser'],
-                                                settings['cdbpass'],
-                                                settings['cdb_db'])
+    success, capconn = utils.open_settings_db(SETTINGS_FILE, prefix="c")
 
     if success:
         cap_ids = get_cap_ids(ids, capconn)
@@ -158,11 +171,7 @@ def get_driver_metric(source_metric, my_date):
     """
     Get external perfdata metric that drives capacity.
     """
-    settings = utils.load_json_definition_file(SETTINGS_FILE)
-    msuccess, monconn = utils.open_monitoring_db(settings['mdbhost'],
-                                                 settings['mdbuser'],
-                                                 settings['mdbpass'],
-                                                 settings['mdb_db'])
+    msuccess, monconn = utils.open_settings_db(SETTINGS_FILE, prefix="m")
 
     if msuccess:
         cursor = monconn.cursor()
@@ -203,15 +212,8 @@ def get_monitor_daily(ids, opt_date):
     query_params = []
     monmetrics = []
 
-    settings = utils.load_json_definition_file(SETTINGS_FILE)
-    csuccess, capconn = utils.open_monitoring_db(settings['cdbhost'],
-                                                 settings['cdbuser'],
-                                                 settings['cdbpass'],
-                                                 settings['cdb_db'])
-    msuccess, monconn = utils.open_monitoring_db(settings['mdbhost'],
-                                                 settings['mdbuser'],
-                                                 settings['mdbpass'],
-                                                 settings['mdb_db'])
+    csuccess, capconn = utils.open_settings_db(SETTINGS_FILE, prefix="c")
+    msuccess, monconn = utils.open_settings_db(SETTINGS_FILE, prefix="m")
 
     if csuccess and msuccess:
         if opt_date is None:
@@ -239,7 +241,9 @@ def get_monitor_daily(ids, opt_date):
                 data_point["Value"] = monmetric[1]
                 datalist.append(data_point)
 
+    if msuccess:
         monconn.close()
+    if csuccess:
         capconn.close()
     return json.dumps(datalist)
 
@@ -0,0 +1,219 @@
+#!/usr/bin/env python
+"""
+dimension cache library
+   Called by flask dubweb app
+   to resolve provider, team, division and project ids
+   without re-querying the dimension tables on every request.
+
+   Copyright 2015 zulily, Inc.
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+     http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+
+import threading
+import time
+
+from app import app
+import app.utils as utils
+
+#globals
+# how long a worker trusts its cached dataversions before re-reading them
+VERSION_CHECK_SECONDS = 30
+DIMENSIONS_VERSION = "dimensions"
+BUDGETS_VERSION = "budgets"
+
+_CACHE = {}
+_LOCK = threading.Lock()
+
+class Dimensions(object):
+    """
+    Snapshot of the dimension tables
+    """
+    def __init__(self, providers, teams, team_divs, divisions, projects):
+        """
+        providers: prvid : [prvname, lastetl, taxrate]
+        teams: teamid : teamname
+        team_divs: teamid : divid
+        divisions: divid : divname
+        projects: prjid : [extname, extid, prvid, teamid]
+        """
+        self.providers = providers
+        self.teams = teams
+        self.team_divs = team_divs
+        self.divisions = divisions
+        self.projects = projects
+
+
+class _CacheEntry(object):
+    """
+    Per-database cache state
+    """
+    def __init__(self):
+        self.dims = None
+        self.dim_key = None
+        self.versions = {}
+        self.checked = 0
+        # bumped by invalidate, so a refresh that was already reading
+        # does not mark its older data as checked
+        self.resets = 0
+        # held while re-reading, so only one thread hits the database
+        self.refresh_lock = threading.Lock()
+
+
+def read_data_versions(dub_conn):
+    """
+    Return name : version for every dataversions row, plus 'lastetl',
+    the newest providers.lastetl, and 'updated', the newest
+    dataversions change, both as epoch seconds.
+    """
+    query = """
+            SELECT name, version FROM dataversions
+            UNION ALL
+            SELECT 'lastetl', IFNULL(UNIX_TIMESTAMP(MAX(lastetl)), 0)
+            FROM providers
+            UNION ALL
+            SELECT 'updated', IFNULL(UNIX_TIMESTAMP(MAX(updated)), 0)
+            FROM dataversions
+            """
+    rows = utils.get_from_db(query, None, dub_conn)
+    return dict((row[0], int(row[1])) for row in rows)
+
+
+def _load_dimensions(dub_conn):
+    """
+    Read all four dimension tables
+    """
+    providers = {}
+    teams = {}
+    team_divs = {}
+    divisions = {}
+    projects = {}
+
+    rows = utils.get_from_db("SELECT prvid, prvname, lastetl, taxrate"
+                             " FROM providers", None, dub_conn)
+    for row in rows:
+        providers[row[0]] = [row[1], row[2], row[3]]
+    rows = utils.get_from_db("SELECT teamid, teamname, divid FROM teams",
+                             None, dub_conn)
+    for row in rows:
+        teams[row[0]] = row[1]
+        team_divs[row[0]] = row[2]
+    rows = utils.get_from_db("SELECT divid, divname FROM divisions",
+                             None, dub_conn)
+    for row in rows:
+        divisions[row[0]] = row[1]
+    rows = utils.get_from_db("SELECT prjid, extname, extid, prvid, teamid"
+                             " FROM projects", None, dub_conn)
+    for row in rows:
+        projects[row[0]] = [row[1], row[2], row[3], row[4]]
+
+    return Dimensions(providers, teams, team_divs, divisions, projects)
+
+
+def _get_entry(settings_file):
+    """
+    Return the cache entry for a settings file's database
+    """
+    entry = _CACHE.get(settings_file)
+    if entry is None:
+        entry = _CacheEntry()
+        _CACHE[settings_file] = entry
+    return entry
+
+
+def _refresh(settings_file, dub_conn):
+    """
+    Return the entry's (versions, dims), first re-reading dataversions
+    when the check interval has passed, and the dimension tables when
+    their version (or lastetl) moved.
+    The reads happen outside _LOCK under the entry's refresh_lock: while
+    one thread refreshes, the others keep the old snapshot, and only
+    wait for it when there is none or it was invalidated.
+    """
+    with _LOCK:
+        entry = _get_entry(settings_file)
+        snapshot = (entry.versions, entry.dims)
+        if entry.dims is not None and \
+           time.time() - entry.checked < VERSION_CHECK_SECONDS:
+            return snapshot
+        wait = entry.dims is None or entry.checked == 0
+
+    if not entry.refresh_lock.acquire(wait):
+        return snapshot
+    try:
+        with _LOCK:
+            # another thread may have refreshed while we waited
+            if entry.dims is not None and \
+               time.time() - entry.checked < VERSION_CHECK_SECONDS:
+                return (entry.versions, entry.dims)
+            dims, dim_key, resets = entry.dims, entry.dim_key, entry.resets
+
+        conn = dub_conn
+        if conn is None:
+            success, conn = utils.open_settings_db(settings_file)
+            if not success:
+                app.logger.error("dimension cache refresh failed for %s",
+                                 settings_file)
+                return snapshot
+        try:
+            versions = read_data_versions(conn)
+            new_key = (versions.get(DIMENSIONS_VERSION),
+                       versions.get('lastetl'))
+            # a missing dataversions table means we cannot trust the cache
+            if dims is None or new_key != dim_key or \
+               DIMENSIONS_VERSION not in versions:
+                dims = _load_dimensions(conn)
+        finally:
+            if dub_conn is None:
+                conn.close()
+
+        with _LOCK:
+            entry.versions = versions
+            entry.dims = dims
+            entry.dim_key = new_key
+            if entry.resets == resets:
+                entry.checked = time.time()
+        return (versions, dims)
+    finally:
+        entry.refresh_lock.release()
+
+
+def get_dimensions(settings_file, dub_conn=None):
+    """
+    Return the cached Dimensions for the database of settings_file,
+    reloading them only when dataversions says they changed.
+    A connection is only checked out if a version check is due.
+    """
+    dims = _refresh(settings_file, dub_conn)[1]
+    if dims is None:
+        dims = Dimensions({}, {}, {}, {}, {})
+    return dims
+
+
+def get_data_versions(settings_file, dub_conn=None):
+    """
+    Return the cached dataversions (see read_data_versions)
+    """
+    return dict(_refresh(settings_file, dub_conn)[0])
+
+
+def invalidate(settings_file=None):
+    """
+    Force the next lookup to re-check versions (all databases if None).
+    Used by this worker right after it writes dimension or budget data.
+    """
+    with _LOCK:
+        for key, entry in _CACHE.items():
+            if settings_file is None or key == settings_file:
+                entry.checked = 0
+                entry.resets += 1
@@ -25,16 +25,23 @@ import json
 import re
 import time
 import numpy as np
-from dateutil import parser
 from dateutil.relativedelta import relativedelta
 from app import app
+import app.dimcache as dimcache
+from dubforecast import forecast
+import app.spendcube as spendcube
 import app.utils as utils
 
 #globals
 SETTINGS_FILE = "/var/dubweb/.settings"
 #goog data lags by 2 days
 LAG_SECONDS = 172800
-DEFAULT_FORECAST_PERIOD = 3 * 29 * 86400
+# set by cub_extract --rebuild-rollups once the rollup tables are complete
+ROLLUPS_VERSION = "rollups"
+# the dataversions a cached spend cube depends on
+CUBE_VERSIONS = ("lastetl", "metricdata", ROLLUPS_VERSION)
+# bumped by cub_extract each time it materializes the forecasts table
+FORECASTS_VERSION = "forecasts"
 
 class Ids(object):
     """
@@ -66,9 +73,12 @@ def get_date_filters(my_time):
     Return start and endtimes since epoch
     """
 
+    # defaults move on the hour, so they can be cached between loads
     if my_time.dformat == "%Y-%m":
         if my_time.start is None or my_time.end is None:
-            my_end_dt = dt.datetime.now() + relativedelta(day=31)
+            my_end_dt = dt.datetime.now() + relativedelta(day=31, minute=0,
+                                                          second=0,
+                                                          microsecond=0)
             my_time.end = int(my_end_dt.strftime('%s'))
             my_start_dt = my_end_dt + relativedelta(months=-3, day=31)
             my_time.start = int(my_start_dt.strftime('%s'))
@@ -76,6 +86,7 @@ def get_date_filters(my_time):
         # dformat is "%Y-%m-%d"
         if my_time.start is None or my_time.end is None:
             my_end_dt = dt.datetime.fromtimestamp((time.time() - LAG_SECONDS))
+            my_end_dt = my_end_dt.replace(minute=0, second=0, microsecond=0)
             my_time.end = int(my_end_dt.strftime('%s'))
             my_start_dt = my_end_dt + relativedelta(days=-30)
             my_time.start = int(my_start_dt.strftime('%s'))
@@ -83,112 +94,214 @@ def get_date_filters(my_time):
     return my_time
 
 
-def get_providers(provider_id, dub_conn):
+def use_rollups(dub_conn):
     """
-    Return a dictionary of providers where
-    you have name, lastetl, taxrate  for the given (or all) providers
+    Return True if spend queries may read the rollup tables:
+    the settings allow it (use_rollups, default on) and the ETL
+    has backfilled them.
     """
+    settings = utils.get_settings(SETTINGS_FILE)
+    if not settings.get_bool('use_rollups', True):
+        return False
+    versions = dimcache.get_data_versions(SETTINGS_FILE, dub_conn)
+    return versions.get(ROLLUPS_VERSION, 0) > 0
 
-    prvdict = {}
-    query_params = []
 
-    query = """
-            SELECT prvid, prvname, lastetl, taxrate FROM providers 
-            """
-    if provider_id is not None:
-        myformat = ','.join(['%s'] * len(provider_id)) + ')'
-        query += " WHERE prvid IN ("
-        query += myformat
-        for prv_val in provider_id:
-            query_params.append(int(prv_val))
+def _day_key(day):
+    """ Return the metricdata daykey (YYYYMMDD) for a date """
+    return day.year * 10000 + day.month * 100 + day.day
 
-    rows = None
-    cursor = dub_conn.cursor()
-    try:
-        if query_params:
-            cursor.execute(query, tuple(query_params))
-        else:
-            cursor.execute(query)
-        rows = cursor.fetchall()
-        for row in rows:
-            prvdict[row[0]] = [row[1], row[2], row[3]]
-    except Exception, err:
-        app.logger.error("mysql exception: %s", err.message)
-        app.logger.error("from query: %s", query)
-    finally:
-        cursor.close()
+def _month_key(day):
+    """ Return the metricdata monthkey (YYYYMM) for a date """
+    return day.year * 100 + day.month
 
-    return prvdict
+def _rollup_key(day):
+    """ Return the rollup tables' key for a date, the DATE itself """
+    return day
 
-def get_teams(team_ids, dub_conn):
+def get_grain(d_format):
     """
-    Return key/value pairs of teamid : teamname
-    for the given (or all) teams
+    Return the bucket grain, 'month' or 'day', for a chart date format
     """
+    if d_format == "%Y-%m":
+        return "month"
+    return "day"
 
-    teams = {}
-    query_params = []
+def bucket_label(grain):
+    """
+    Return the SQL turning a bucket key of the grain into a date label,
+    it takes the date format as its one parameter.
+    """
+    if grain == "month":
+        return "DATE_FORMAT(bucket * 100 + 1, %s)"
+    return "DATE_FORMAT(bucket, %s)"
 
-    query = """
-            SELECT teamid, teamname FROM teams WHERE 1
-            """
-    if team_ids is not None:
-        myformat = ','.join(['%s'] * len(team_ids)) + ')'
+
+def get_spend_segments(my_time, dub_conn, grain, by_metric=False):
+    """
+    Split the [start, end] window into pieces each answered by the
+    coarsest source that covers them exactly, without touching
+    metricdata rows outside the covering indexes:
+      whole months - metricdata_monthly, or metricdata.monthkey
+                     (month grain only; the rollup has no metric column,
+                     so by_metric requests skip it)
+      whole days   - metricdata_daily, or metricdata.daykey
+      partial days - metricdata.datetime, at either end of the window
+    Return a list of (query, params), each selecting the grain's key
+    as bucket, then prvid, teamid, prjid, metric, cost.
+    """
+    cols = " prvid, teamid, prjid, metric, cost "
+    if grain == "month":
+        edge_key = "YEAR(datetime) * 100 + MONTH(datetime)"
+        day_key = "daykey DIV 100"
+        rollup_day_key = "EXTRACT(YEAR_MONTH FROM day)"
+    else:
+        edge_key = "YEAR(datetime) * 10000 + MONTH(datetime) * 100 + " \
+                   "DAYOFMONTH(datetime)"
+        day_key = "daykey"
+        rollup_day_key = "day + 0"
+    edge = "SELECT " + edge_key + " AS bucket," + cols + """FROM metricdata
+            WHERE datetime >= %s AND datetime < %s """
+    rollups = use_rollups(dub_conn)
+    if rollups:
+        daily = "SELECT " + rollup_day_key + " AS bucket," + cols + """
+                 FROM metricdata_daily WHERE day BETWEEN %s AND %s """
+        to_day = _rollup_key
+    else:
+        daily = "SELECT " + day_key + " AS bucket," + cols + """
+                 FROM metricdata WHERE daykey BETWEEN %s AND %s """
+        to_day = _day_key
+    if rollups and not by_metric:
+        monthly = """SELECT EXTRACT(YEAR_MONTH FROM month) AS bucket,
+                     prvid, teamid, prjid, 0 AS metric, cost
+                     FROM metricdata_monthly WHERE month BETWEEN %s AND %s """
+        to_month = _rollup_key
+    elif not rollups:
+        monthly = "SELECT monthkey AS bucket," + cols + """
+                   FROM metricdata WHERE monthkey BETWEEN %s AND %s """
+        to_month = _month_key
+    else:
+        monthly = None
+    one_day = dt.timedelta(days=1)
+
+    start_dt = dt.datetime.fromtimestamp(int(my_time.start))
+    # the window is inclusive of its end second
+    after_end = dt.datetime.fromtimestamp(int(my_time.end) + 1)
+    first_day = start_dt.date()
+    if start_dt.time() != dt.time(0):
+        first_day += one_day
+    last_day = after_end.date() - one_day
+    if first_day > last_day:
+        return [(edge, [start_dt, after_end])]
+
+    segments = []
+    first_dt = dt.datetime.combine(first_day, dt.time(0))
+    after_dt = dt.datetime.combine(last_day + one_day, dt.time(0))
+    if start_dt < first_dt:
+        segments.append((edge, [start_dt, first_dt]))
+
+    first_month = first_day + relativedelta(day=1)
+    if first_month < first_day:
+        first_month += relativedelta(months=1)
+    last_month = (last_day + one_day) + relativedelta(day=1, months=-1)
+    if grain == "month" and monthly is not None and \
+       first_month <= last_month:
+        if first_day < first_month:
+            segments.append((daily, [to_day(first_day),
+                                     to_day(first_month - one_day)]))
+        segments.append((monthly, [to_month(first_month),
+                                   to_month(last_month)]))
+        month_after = last_month + relativedelta(months=1)
+        if month_after <= last_day:
+            segments.append((daily, [to_day(month_after), to_day(last_day)]))
+    else:
+        segments.append((daily, [to_day(first_day), to_day(last_day)]))
+
+    if after_dt < after_end:
+        segments.append((edge, [after_dt, after_end]))
+    return segments
+
+
+def get_id_filters(ids):
+    """
+    Return the (sql, params) AND-clauses for the team/project/provider ids
+    """
+    query = ""
+    query_params = []
+    if ids.team is not None:
+        myformat = ','.join(['%s'] * len(ids.team)) + ')'
         query += " AND teamid IN ("
         query += myformat
-        for teamval in team_ids:
+        for teamval in ids.team:
             query_params.append(int(teamval))
-    cursor = dub_conn.cursor()
-    try:
-        if query_params:
-            cursor.execute(query, tuple(query_params))
-        else:
-            cursor.execute(query)
-        rows = cursor.fetchall()
-        for row in rows:
-            teams[row[0]] = row[1]
-    except Exception, err:
-        app.logger.error("mysql exception: %s", err.message)
-        app.logger.error("from query: %s", query)
-    finally:
-        cursor.close()
+    if ids.project is not None:
+        query += " AND prjid = %s "
+        query_params.append(int(ids.project))
+    if ids.prv is not None:
+        myformat = ','.join(['%s'] * len(ids.prv)) + ')'
+        query += " AND prvid IN ("
+        query += myformat
+        for prv_val in ids.prv:
+            query_params.append(int(prv_val))
+    return query, query_params
 
-    return teams
 
-def lookup_divisions(team_ids, dub_conn):
+def get_spend_from(my_time, ids, dub_conn, grain, by_metric=False):
     """
-    Return key/value pairs of teamid : divisionid
+    Return the (sql, params) for a "FROM (...) AS md" clause over the
+    spend segments, with the id filters applied inside every segment.
+    """
+    filters, filter_params = get_id_filters(ids)
+    parts = []
+    query_params = []
+    for seg_query, seg_params in get_spend_segments(my_time, dub_conn,
+                                                    grain, by_metric):
+        parts.append(seg_query + filters)
+        query_params += seg_params + filter_params
+    query = " FROM (" + " UNION ALL ".join(parts) + ") AS md "
+    return query, query_params
+
+
+def _id_filter(id_list):
+    """
+    Return a set of int ids for an optional list filter (None = all)
+    """
+    if id_list is None:
+        return None
+    return set(int(id_val) for id_val in id_list)
+
+def get_providers(provider_id, dub_conn):
+    """
+    Return a dictionary of providers where
+    you have name, lastetl, taxrate  for the given (or all) providers
+    """
+    dims = dimcache.get_dimensions(SETTINGS_FILE, dub_conn)
+    wanted = _id_filter(provider_id)
+
+    return dict((prv, vals) for prv, vals in dims.providers.iteritems()
+                if wanted is None or prv in wanted)
+
+def get_teams(team_ids, dub_conn):
+    """
+    Return key/value pairs of teamid : teamname
     for the given (or all) teams
     """
+    dims = dimcache.get_dimensions(SETTINGS_FILE, dub_conn)
+    wanted = _id_filter(team_ids)
 
-    teams = {}
-    query_params = []
+    return dict((team, name) for team, name in dims.teams.iteritems()
+                if wanted is None or team in wanted)
 
-    query = """
-            SELECT teamid, divid FROM teams WHERE 1
-            """
-    if team_ids is not None:
-        myformat = ','.join(['%s'] * len(team_ids)) + ')'
-        query += " AND teamid IN ("
-        query += myformat
-        for teamval in team_ids:
-            query_params.append(int(teamval))
-    cursor = dub_conn.cursor()
-    try:
-        if query_params:
-            cursor.execute(query, tuple(query_params))
-        else:
-            cursor.execute(query)
-        rows = cursor.fetchall()
-        for row in rows:
-            teams[row[0]] = row[1]
-    except Exception, err:
-        app.logger.error("mysql exception: %s", err.message)
-        app.logger.error("from query: %s", query)
-    finally:
-        cursor.close()
+def lookup_divisions(team_ids, dub_conn):
+    """
+    Return key/value pairs of teamid : divisionid
+    for the given (or all) teams
+    """
+    dims = dimcache.get_dimensions(SETTINGS_FILE, dub_conn)
+    wanted = _id_filter(team_ids)
 
-    return teams
+    return dict((team, div) for team, div in dims.team_divs.iteritems()
+                if wanted is None or team in wanted)
 
 def set_teams_from_divs(ids, dub_conn):
     """
@@ -196,32 +309,11 @@ def set_teams_from_divs(ids, dub_conn):
     return the ID class with the appropriate teams set,
     with all teams, if no division is set.
     """
+    dims = dimcache.get_dimensions(SETTINGS_FILE, dub_conn)
+    wanted = _id_filter(ids.div)
 
-    query_params = []
-
-    query = """
-            SELECT distinct teamid FROM teams WHERE 1
-            """
-    if ids.div is not None:
-        myformat = ','.join(['%s'] * len(ids.div)) + ')'
-        query += " AND divid IN ("
-        query += myformat
-        for divval in ids.div:
-            query_params.append(int(divval))
-    cursor = dub_conn.cursor()
-    try:
-        if query_params:
-            cursor.execute(query, tuple(query_params))
-        else:
-            cursor.execute(query)
-        rows = cursor.fetchall()
-        ids.team = [str(row[0]) for row in rows]
-
-    except Exception, err:
-        app.logger.error("mysql exception: %s", err.message)
-        app.logger.error("from query: %s", query)
-    finally:
-        cursor.close()
+    ids.team = [str(team) for team, div in dims.team_divs.iteritems()
+                if wanted is None or div in wanted]
 
     return ids
 
@@ -230,110 +322,47 @@ def get_divisions(div_ids, dub_conn):
     Return key/value pairs of divid : divname
     for the given (or all) divisions
     """
+    dims = dimcache.get_dimensions(SETTINGS_FILE, dub_conn)
+    wanted = _id_filter(div_ids)
 
-    divisions = {}
-    query_params = []
-
-    query = """
-            SELECT divid, divname FROM divisions WHERE 1
-            """
-    if div_ids is not None:
-        myformat = ','.join(['%s'] * len(div_ids)) + ')'
-        query += " AND divid IN ("
-        query += myformat
-        for divval in div_ids:
-            query_params.append(int(divval))
-    cursor = dub_conn.cursor()
-    try:
-        if query_params:
-            cursor.execute(query, tuple(query_params))
-        else:
-            cursor.execute(query)
-        rows = cursor.fetchall()
-        for row in rows:
-            divisions[row[0]] = row[1]
-    except Exception, err:
-        app.logger.error("mysql exception: %s", err.message)
-        app.logger.error("from query: %s", query)
-    finally:
-        cursor.close()
-
-    return divisions
+    return dict((div, name) for div, name in dims.divisions.iteritems()
+                if wanted is None or div in wanted)
 
 def get_projects(provider_id, team_ids, project_id, dub_conn):
     """
     Return dictionary of project id : external name, external id,
     provider id;  for the given (or all) teams
     """
+    dims = dimcache.get_dimensions(SETTINGS_FILE, dub_conn)
+    prvs = _id_filter(provider_id)
+    teams = _id_filter(team_ids)
 
     projectdict = {}
-    query_params = []
-
-    query = """
-            SELECT prjid, extname, extid, prvid FROM projects WHERE 1
-            """
-    if provider_id is not None:
-        myformat = ','.join(['%s'] * len(provider_id)) + ')'
-        query += " AND prvid IN ("
-        query += myformat
-        for prv_val in provider_id:
-            query_params.append(int(prv_val))
-    if team_ids is not None:
-        myformat = ','.join(['%s'] * len(team_ids)) + ')'
-        query += " AND teamid IN ("
-        query += myformat
-        for teamval in team_ids:
-            query_params.append(int(teamval))
-    if project_id is not None:
-        query += " AND prjid = %s"
-        query_params.append(int(project_id))
-
-    cursor = dub_conn.cursor()
-    try:
-        if query_params:
-            cursor.execute(query, tuple(query_params))
-        else:
-            cursor.execute(query)
-        rows = cursor.fetchall()
-        for row in rows:
-            projectdict[row[0]] = [row[1], row[2], row[3]]
-    except Exception, err:
-        app.logger.error("mysql exception: %s", err.message)
-        app.logger.error("from query: %s", query)
-    finally:
-        cursor.close()
+    for prj, vals in dims.projects.iteritems():
+        if prvs is not None and vals[2] not in prvs:
+            continue
+        if teams is not None and vals[3] not in teams:
+            continue
+        if project_id is not None and prj != int(project_id):
+            continue
+        projectdict[prj] = vals[:3]
 
     return projectdict
 
 
-def get_budget_by_providers(ids, dub_conn):
+def get_budget_by_providers(ids, dub_conn, month_keys=None):
     """
-    Return dubweb budget values by provider and month.
+    Return dubweb budget values by provider and month, only of the
+    (first, last) monthkeys in month_keys if given.
     """
-
-    query_params = []
-    query = "SELECT month, CAST(IFNULL(sum(budget),0) AS SIGNED INT), prvid"
-    query += " FROM budgetdata WHERE 1 "
-    if ids.team is not None:
-        myformat = ','.join(['%s'] * len(ids.team)) + ')'
-        query += " AND teamid IN ("
-        query += myformat
-        for teamval in ids.team:
-            query_params.append(int(teamval))
-    if ids.prv is not None:
-        myformat = ','.join(['%s'] * len(ids.prv)) + ')'
-        query += " AND prvid IN ("
-        query += myformat
-        for prv_val in ids.prv:
-            query_params.append(int(prv_val))
-    query += " GROUP BY prvid, month"
-
-    return utils.get_from_db(query, tuple(query_params), dub_conn)
+    query, query_params = build_budget_query(ids, ["prvid"], month_keys)
+    return utils.get_from_db(query, query_params, dub_conn)
 
 
-def get_response_dict(ids, dub_conn):
+def get_response_dict(ids, dub_conn, month_keys=None):
     """
-    Return dubweb budget responses by team, provider, month.
+    Return dubweb budget responses by team, provider, month, only of
+    the (first, last) monthkeys in month_keys if given.
     """
 
     query_params = []
@@ -355,6 +384,9 @@ def get_response_dict(ids, dub_conn):
         query += myformat
         for prv_val in ids.prv:
             query_params.append(int(prv_val))
+    if month_keys is not None:
+        query += " AND monthkey BETWEEN %s AND %s "
+        query_params.extend(month_keys)
     responses = utils.get_from_db(query, tuple(query_params), dub_conn)
     for row in responses:
         data_points[row[0]][row[1]][row[2]] = row[3]
@@ -362,16 +394,18 @@ def get_response_dict(ids, dub_conn):
     return data_points
 
 
-def date_in_range(date_str, start_ts, end_ts):
+def budget_month_keys(start_ts, end_ts):
     """
-    Return True if month is between the timestamps.
+    Return the (first, last) budgetdata monthkeys of the months whose
+    first day starts between the timestamps.
     """
-    curdate = parser.parse(date_str + "-01 00:00:00")
-    cur_ts = time.mktime(curdate.timetuple())
-    if int(start_ts) <= cur_ts <= int(end_ts):
-        return True
-    else:
-        return False
+    start_dt = dt.datetime.fromtimestamp(int(start_ts))
+    first = start_dt + relativedelta(day=1, hour=0, minute=0, second=0,
+                                     microsecond=0)
+    if first < start_dt:
+        first += relativedelta(months=1)
+    last = dt.datetime.fromtimestamp(int(end_ts))
+    return _month_key(first), _month_key(last)
 
 def get_budget_provider_dict(ids, start_ts, end_ts, dub_conn):
     """
@@ -380,11 +414,11 @@ def get_budget_provider_dict(ids, start_ts, end_ts, dub_conn):
     months = {}
     data_points = defaultdict(dict)
     providers = get_providers(ids.prv, dub_conn)
-    budget_list = get_budget_by_providers(ids, dub_conn)
+    budget_list = get_budget_by_providers(ids, dub_conn,
+                                          budget_month_keys(start_ts, end_ts))
     for budget in budget_list:
-        if date_in_range(budget[0], start_ts, end_ts):
-            data_points[providers[budget[2]][0]][budget[0]] = int(budget[1])
-            months[budget[0]] = 1
+        data_points[providers[budget[2]][0]][budget[0]] = int(budget[1])
+        months[budget[0]] = 1
 
     return data_points, sorted(months.keys())
 
@@ -396,11 +430,11 @@ def get_budget_team_dict(ids, start_ts, end_ts, dub_conn):
     months = {}
     data_points = defaultdict(dict)
     teams = get_teams(ids.team, dub_conn)
-    budget_list = get_budget_by_teams(ids, dub_conn)
+    budget_list = get_budget_by_teams(ids, dub_conn,
+                                      budget_month_keys(start_ts, end_ts))
     for budget in budget_list:
-        if date_in_range(budget[0], start_ts, end_ts):
-            data_points[teams[budget[2]]][budget[0]] = int(budget[1])
-            months[budget[0]] = 1
+        data_points[teams[budget[2]]][budget[0]] = int(budget[1])
+        months[budget[0]] = 1
 
     return data_points, sorted(months.keys())
 
@@ -410,11 +444,12 @@ def get_budget_div_dict(ids, my_time, divs, t_divs, dub_conn):
     """
     months = {}
     datapts = defaultdict(lambda: defaultdict(int))
-    budget_list = get_budget_by_teams(ids, dub_conn)
-    for bgt in budget_list:
-        if date_in_range(bgt[0], my_time.start, my_time.end):
-            datapts[divs[t_divs[bgt[2]]]][bgt[0]] += int(bgt[1])
-            months[bgt[0]] = 1
+    div_budgets = sum_budgets_by_division(ids, t_divs, dub_conn,
+                                          budget_month_keys(my_time.start,
+                                                            my_time.end))
+    for div, budgets in div_budgets.iteritems():
+        datapts[divs[div]].update(budgets)
+        months.update(dict.fromkeys(budgets, 1))
 
     return datapts, sorted(months.keys())
 
@@ -438,13 +473,16 @@ def add_budget_series_providers(ids, months, data_list, names, dub_conn):
     return data_list
 
 
-def get_budget_by_teams(ids, dub_conn):
+def build_budget_query(ids, group_cols, month_keys=None):
     """
-    Return dubweb budget values by team and month.
+    Return the (query, params) for dubweb budget values by month and the
+    group_cols (teamid and/or prvid), selected after month and budget,
+    only of the (first, last) monthkeys in month_keys if given.
     """
 
     query_params = []
-    query = "SELECT month, CAST(IFNULL(sum(budget),0) AS SIGNED INT), teamid"
+    query = "SELECT month, CAST(IFNULL(sum(budget),0) AS SIGNED INT), "
+    query += ", ".join(group_cols)
     query += " FROM budgetdata WHERE 1 "
     if ids.team is not None:
         myformat = ','.join(['%s'] * len(ids.team)) + ')'
@@ -458,9 +496,49 @@ def get_budget_by_teams(ids, dub_conn):
         query += myformat
         for prv_val in ids.prv:
             query_params.append(int(prv_val))
-    query += " GROUP BY teamid, month"
+    if month_keys is not None:
+        query += " AND monthkey BETWEEN %s AND %s "
+        query_params.extend(month_keys)
+    query += " GROUP BY " + ", ".join(group_cols) + ", month"
+    return query, tuple(query_params)
 
-    return utils.get_from_db(query, tuple(query_params), dub_conn)
+def build_budget_by_teams_query(ids, month_keys=None):
+    """
+    Return the (query, params) for dubweb budget values by team and month,
+    only of the (first, last) monthkeys in month_keys if given.
+    """
+    return build_budget_query(ids, ["teamid"], month_keys)
+
+def get_budget_by_teams(ids, dub_conn, month_keys=None):
+    """
+    Return dubweb budget values by team and month.
+    """
+    query, query_params = build_budget_by_teams_query(ids, month_keys)
+    return utils.get_from_db(query, query_params, dub_conn)
+
+def sum_budgets_by_division(ids, team_divs, dub_conn, month_keys=None):
+    """
+    Return divid : month : budget, the team budgets rolled up into
+    divisions with one vectorized group-by, only of the (first, last)
+    monthkeys in month_keys if given.
+    """
+    query, query_params = build_budget_by_teams_query(ids, month_keys)
+    bgts = utils.get_columns_from_db(query, query_params, dub_conn,
+                                     [('month', 'id'), ('budget', 'float'),
+                                      ('teamid', 'id')])
+    months = bgts.values('month')
+
+    team_div = np.array([team_divs[team] for team in bgts.values('teamid')],
+                        dtype=np.int64)
+    divs, div_codes = np.unique(team_div[bgts['teamid']], return_inverse=True)
+    sums, counts = utils.group_sum([div_codes, bgts['month']],
+                                   [len(divs), len(months)], bgts['budget'])
+
+    datapts = defaultdict(dict)
+    div_idx, month_idx = np.nonzero(counts)
+    for div, month in zip(div_idx, month_idx):
+        datapts[int(divs[div])][str(months[month])] = int(sums[div, month])
+    return datapts
 
 def add_budget_series_teams(ids, months, data_list, names, dub_conn):
     """
@@ -486,12 +564,7 @@ def add_budget_series_divisions(ids, months, data_list, divisions,
     Return dubweb budget chart series by division and month.
     """
 
-    budget_list = defaultdict(lambda: defaultdict(int))
-    t_budgets = get_budget_by_teams(ids, dub_conn)
-    for t_bgt in t_budgets:
-        if t_bgt[1] is not None:
-            # sum across divisions
-            budget_list[team_divs[t_bgt[2]]][t_bgt[0]] += int(t_bgt[1])
+    budget_list = sum_budgets_by_division(ids, team_divs, dub_conn)
 
     for div in budget_list:
         for month in budget_list[div]:
@@ -559,107 +632,34 @@ def get_provider_metric_buckets(provider_id, dub_conn):
     return metricbuckets
 
 
-def compute_month_stats(slice_len, stat_array):
+def estimate_monthly_metrics(my_time, d_metrics):
     """
-    Return calculated statistics.
+    Return projected monthly metrics for each id, given the
+    ColumnarResult of an estimate query (day, grp, spend per day).
+    All ids are forecast together, see forecast.decay_forecast.
     """
-    sdict = {}
-    sdict['avg'] = np.mean(stat_array)
-    sdict['len'] = len(stat_array)
-    sdict['std'] = np.std(stat_array)
-    if not slice_len:
-        slice_len = sdict['len']
-    sdict['slice_avg'] = np.mean(stat_array[:slice_len])
-    sdict['slice_len'] = len(stat_array[:slice_len])
-
-    return sdict
+    if len(d_metrics) == 0:
+        return []
 
-def forecast_metrics(times, my_id, current, prev):
-    """
-    Return projected monthly values for each provider.
-    """
-    stats_list = []
-    decay = 1.0
+    batch = forecast.SeriesBatch.from_codes(d_metrics.values('grp'),
+                                            d_metrics.values('day'),
+                                            d_metrics['grp'],
+                                            d_metrics['day'],
+                                            d_metrics['spend'])
+    # no end means each id's default horizon
+    end_ts = 0 if my_time.end is None else int(my_time.end)
+    return forecast.decay_forecast(batch, end_ts)
 
-    if prev:
-        trend = current['slice_avg'] / prev['slice_avg']
-        if trend < 0:
-            decay = -1.0
-    else:
-        trend = 1.0
-    forecast = dt.datetime.fromtimestamp(float(times.start))
-    endtime = dt.datetime.fromtimestamp(float(times.end))
-    firstofmonth = dt.datetime.now() + relativedelta(day=1)
-    if not prev or current['std'] == 0.0:
-        dailyspend = current['avg']
-    else:
-        dailyspend = prev['avg']
-
-    while forecast < endtime:
-        forecast = forecast + relativedelta(day=1, months=+1, days=-1)
-        daycount = int(forecast.strftime('%d'))
-        month = forecast.strftime('%Y-%m')
-        monthly_estimate = int(dailyspend * daycount)
-        # Don't show estimated data from the past
-        if forecast > firstofmonth:
-            stats_list.append([month, my_id, monthly_estimate])
-        forecast = forecast + relativedelta(days=+1)
-        dailyspend *= trend
-        # Allow trend to decay over time
-        trend = (trend + decay + decay) / 3.0
-
-    return stats_list
 
-def estimate_monthly_metrics(my_time, d_metrics):
+def iter_item_table(data_set, header_row, inc_total, sum_col):
     """
-    Return projected monthly metrics for each id.
-    """
-    metdict = {}
-    prevmon = None
-
-    # separate daily metrics into array
-    for metric in d_metrics:
-        if metric[1] not in metdict:
-            metdict[metric[1]] = OrderedDict()
-        if metric[0] not in metdict[metric[1]]:
-            metdict[metric[1]][metric[0]] = []
-        metdict[metric[1]][metric[0]].append(metric[2])
-    d_metrics = []
-
-    # calculate data needed for forecasting, by id
-    for m_id in metdict.iterkeys():
-        if len(metdict[m_id].keys()) > 1:
-            prevmon = metdict[m_id].keys()[-2]
-        curmon = metdict[m_id].keys()[-1]
-        curmon_dt = dt.datetime.strptime(curmon + '-01T00:00:00',
-                                         '%Y-%m-%dT%H:%M:%S')
-        my_time.start = int(curmon_dt.strftime('%s'))
-        if my_time.end < (my_time.start + DEFAULT_FORECAST_PERIOD):
-            my_time.end = int((curmon_dt + \
-                              relativedelta(months=3)).strftime('%s'))
-        curstdict = {}
-        prevdict = {}
-        curstdict = compute_month_stats(None,
-                                        np.array(metdict[m_id][curmon]))
-        if m_id in metdict and prevmon in metdict[m_id]:
-            prevdict = compute_month_stats(curstdict['len'],
-                                           np.array(metdict[m_id][prevmon]))
-        # forecast, based on id
-        d_metrics += forecast_metrics(my_time, m_id, curstdict,
-                                      prevdict)
-
-    return d_metrics
-
-
-def gen_item_table(data_set, header_row, inc_total, sum_col):
-    """
-        Return a list of lists with each 'cell' of a csv table.
+        Yield each row of a csv table, as a list of 'cells',
+        keeping a running total of sum_col for the last row.
     """
     datarow = []
-    datalist = []
 
     # Construct header row
-    datalist.append(header_row)
+    yield header_row
 
     # Parse into table, adding subtotals
     total = 0
@@ -671,14 +671,19 @@ def gen_item_table(data_set, header_row, inc_total, sum_col):
             except KeyError:
                 value = 0
             total += value
-        datalist.append(datarow)
+        yield datarow
 
     lastrow = [None]*len(datarow)
     if inc_total:
         lastrow[0] = "Total:"
         lastrow[sum_col] = total
-    datalist.append(lastrow)
-    return datalist
+    yield lastrow
+
+def gen_item_table(data_set, header_row, inc_total, sum_col):
+    """
+        Return a list of lists with each 'cell' of a csv table.
+    """
+    return list(iter_item_table(data_set, header_row, inc_total, sum_col))
 
 def gen_cost_table(data_set, month_arr, table_str):
     """
@@ -729,9 +734,12 @@ def gen_cost_table(data_set, month_arr, table_str):
     return datalist
 
 
-def gen_over_under_table(data_set, ids, mytime, dubconn, table_str):
+def gen_over_under_table(data_set, budgets, responses, table_str):
     """
-        Return a list of lists with each 'cell' of an over/under csv table.
+        Given actuals and budgets (provider : month : value) and
+        responses (provider : month : response) of one table,
+        Return a list of lists with each 'cell' of an over/under csv table,
+        with a column group for each budgeted month.
     """
     monthvals = {}
     monthbudgets = {}
@@ -739,9 +747,8 @@ def gen_over_under_table(data_set, ids, mytime, dubconn, table_str):
     datarow = []
     datalist = []
 
-    budgets, month_arr = get_budget_provider_dict(ids, int(mytime.start),
-                                                  int(mytime.end), dubconn)
-    responses = get_response_dict(ids, dubconn)
+    month_arr = sorted(set(month for bgts in budgets.itervalues()
+                           for month in bgts))
     # Construct header row
     datarow = [table_str]
     for month in month_arr:
@@ -771,7 +778,7 @@ def gen_over_under_table(data_set, ids, mytime, dubconn, table_str):
             overunder = value - budget
             datarow.extend([overunder])
             try:
-                response = responses[int(ids.team[0])][p_key][month]
+                response = responses[p_key][month]
             except KeyError:
                 response = None
             datarow.extend([response])
@@ -815,11 +822,7 @@ def get_data_budget_provider(mytime, ids):
     data_points = defaultdict(dict)
     datalist = []
 
-    settings = utils.load_json_definition_file(SETTINGS_FILE)
-    success, dubconn = utils.open_monitoring_db(settings['dbhost'],
-                                                settings['dbuser'],
-                                                settings['dbpass'],
-                                                settings['db_db'])
+    success, dubconn = utils.open_settings_db(SETTINGS_FILE)
 
     if success:
         mytime = get_date_filters(mytime)
@@ -840,49 +843,61 @@ def get_data_budget_provider(mytime, ids):
     return datalist
 
 
+def sum_team_points(team_points):
+    """
+    Return name : month : value, summed over the teams of
+    team : name : month : value.
+    """
+    data_points = defaultdict(lambda: defaultdict(int))
+    for points in team_points.itervalues():
+        for name, months in points.iteritems():
+            for month, value in months.iteritems():
+                data_points[name][month] += value
+    return data_points
+
+
 def get_budget_over_under(my_time, ids):
     """
-    Return a csv containing provider actuals and budget over/under by month.
-    Assumes a teamid is passed in the ids structure.
+    Return a csv containing provider actuals and budget over/under by month,
+    a table per team in ids (or one for all teams), all built from one
+    spend cube slice, one budget query and one response query.
     """
-    data_points = defaultdict(dict)
     datalist = []
-    dubs = []
     providers = {}
     teams = {}
 
-    settings = utils.load_json_definition_file(SETTINGS_FILE)
-    success, dubconn = utils.open_monitoring_db(settings['dbhost'],
-                                                settings['dbuser'],
-                                                settings['dbpass'],
-                                                settings['db_db'])
+    success, dubconn = utils.open_settings_db(SETTINGS_FILE)
 
     if success:
         mytime = get_date_filters(my_time)
         providers = get_providers(ids.prv, dubconn)
         teams = get_teams(ids.team, dubconn)
+        month_keys = budget_month_keys(mytime.start, mytime.end)
+
+        # actuals, budgets and responses of every team at once,
+        # keyed team : provider name : month
+        actuals = defaultdict(lambda: defaultdict(dict))
+        cube = get_spend_cube(mytime, ids, dubconn)
+        for month, team, prv, spend in cube.slice_teams(ids, "prvid"):
+            actuals[team][providers[prv][0]][month] = spend
+        budgets = defaultdict(lambda: defaultdict(dict))
+        query, query_params = build_budget_query(ids, ["teamid", "prvid"],
+                                                 month_keys)
+        for month, budget, team, prv in utils.get_from_db(query, query_params,
+                                                          dubconn):
+            budgets[int(team)][providers[prv][0]][month] = int(budget)
+        responses = get_response_dict(ids, dubconn, month_keys)
+
         if ids.team is not None:
-            tmp_id = ids
             for teamval in ids.team:
-                tmp_id.team = [teamval]
-                data_points = defaultdict(dict)
-                dubs = get_data_general(mytime, tmp_id, dubconn,
-                                        group_by="prvid")
-                for dub in dubs:
-                    data_points[providers[dub[1]][0]][dub[0]] = dub[2]
-                datalist += gen_over_under_table(data_points, tmp_id,
-                                                 mytime, dubconn,
-                                                 teams[int(teamval)] + ":")
-
+                team = int(teamval)
+                datalist += gen_over_under_table(actuals[team], budgets[team],
+                                                 responses[team],
+                                                 teams[team] + ":")
         else:
-            dubs = get_data_general(mytime, ids, dubconn,
-                                    group_by="prvid")
-
-            for dub in dubs:
-                data_points[providers[dub[1]][0]][dub[0]] = dub[2]
-
-            datalist = gen_over_under_table(data_points, ids, mytime,
-                                            dubconn, table_str='All Teams:')
+            datalist = gen_over_under_table(sum_team_points(actuals),
+                                            sum_team_points(budgets), {},
+                                            table_str='All Teams:')
 
         dubconn.close()
 
@@ -897,11 +912,7 @@ def get_data_budget_team(my_time, ids):
     data_points = defaultdict(dict)
     datalist = []
 
-    settings = utils.load_json_definition_file(SETTINGS_FILE)
-    success, dubconn = utils.open_monitoring_db(settings['dbhost'],
-                                                settings['dbuser'],
-                                                settings['dbpass'],
-                                                settings['db_db'])
+    success, dubconn = utils.open_settings_db(SETTINGS_FILE)
 
     if success:
         mytime = get_date_filters(my_time)
@@ -929,21 +940,17 @@ def get_data_budget_div(my_time, ids):
     dubmetrics = defaultdict(lambda: defaultdict(int))
     datalist = []
 
-    settings = utils.load_json_definition_file(SETTINGS_FILE)
-    success, dubconn = utils.open_monitoring_db(settings['dbhost'],
-                                                settings['dbuser'],
-                                                settings['dbpass'],
-                                                settings['db_db'])
+    success, dubconn = utils.open_settings_db(SETTINGS_FILE)
 
     if success:
         mytime = get_date_filters(my_time)
         divs = get_divisions(ids.div, dubconn)
         ids = set_teams_from_divs(ids, dubconn)
         t_divs = lookup_divisions(ids.team, dubconn)
-        t_metrics = get_data_general(mytime, ids, dubconn, group_by="teamid")
-        for t_met in t_metrics:
-            dubmetrics[divs[t_divs[t_met[1]]]][t_met[0]] += t_met[2]
-            months[t_met[0]] = 1
+        d_metrics = get_data_general(mytime, ids, dubconn, group_by="divid")
+        for d_met in d_metrics:
+            dubmetrics[divs[d_met[1]]][d_met[0]] += d_met[2]
+            months[d_met[0]] = 1
 
         budgets, bgt_months = get_budget_div_dict(ids, mytime, divs,
                                                   t_divs, dubconn)
@@ -955,99 +962,113 @@ def get_data_budget_div(my_time, ids):
     return datalist
 
 
-def get_data_item_cost(my_time, ids):
+def build_item_cost_query(my_time, ids, dubconn):
     """
-    Return a csv containing item costs by project, provider, team.
+    Return the (query, params) for item costs per bucket and metric.
     """
-    datalist = []
+    grain = get_grain(my_time.dformat)
     query_params = []
 
-    settings = utils.load_json_definition_file(SETTINGS_FILE)
-    success, dubconn = utils.open_monitoring_db(settings['dbhost'],
-                                                settings['dbuser'],
-                                                settings['dbpass'],
-                                                settings['db_db'])
-
-    if success:
-        mytime = get_date_filters(my_time)
-        # retrieve raw list of rows, one per actual/budget
-
-        query = """
-                   SELECT DATE_FORMAT(md.datetime,%s), mt.metricname,
-                   CAST(IFNULL(sum(md.cost),0) AS SIGNED INT), prj.extname,
-                   prv.prvname, tm.teamname FROM metricdata AS md 
-                   JOIN teams AS tm ON md.teamid = tm.teamid
-                   JOIN metrictypes AS mt ON md.metric = mt.metricid
-                   JOIN projects AS prj ON md.prjid = prj.prjid
-                   JOIN providers AS prv ON md.prvid = prv.prvid
-                   WHERE datetime BETWEEN FROM_UNIXTIME(%s) AND
-                   FROM_UNIXTIME(%s) """
-        query_params.append(mytime.dformat)
-        query_params.append(mytime.start)
-        query_params.append(mytime.end)
-        if ids.team is not None:
-            myformat = ','.join(['%s'] * len(ids.team)) + ')'
-            query += " AND md.teamid IN ("
-            query += myformat
-            for teamval in ids.team:
-                query_params.append(int(teamval))
-        if ids.project is not None:
-            query += " AND md.prjid = %s "
-            query_params.append(int(ids.project))
-        if ids.prv is not None:
-            myformat = ','.join(['%s'] * len(ids.prv)) + ')'
-            query += " AND md.prvid IN ("
-            query += myformat
-            for prv_val in ids.prv:
-                query_params.append(int(prv_val))
-        query += " GROUP by DATE_FORMAT(md.datetime,%s), md.metric "
-        query += " ORDER BY md.teamid, md.prvid, md.prjid, md.metric, "
-        query += " DATE_FORMAT(md.datetime,%s)"
-        query_params.append(mytime.dformat)
-        query_params.append(mytime.dformat)
-
-        dubmetrics = utils.get_from_db(query, query_params, dubconn)
-        header = ['Date', 'Item', 'Cost', 'Project', 'Provider', 'Team']
-        datalist = gen_item_table(dubmetrics, header, inc_total=True,
-                                  sum_col=2)
-
-        dubconn.close()
-
-    return datalist
+    query = " SELECT " + bucket_label(grain) + """, mt.metricname,
+               CAST(IFNULL(sum(md.cost),0) AS SIGNED INT), prj.extname,
+               prv.prvname, tm.teamname """
+    query_params.append(my_time.dformat)
+    from_query, from_params = get_spend_from(my_time, ids, dubconn, grain,
+                                             by_metric=True)
+    query += from_query
+    query_params += from_params
+    query += """
+               JOIN teams AS tm ON md.teamid = tm.teamid
+               JOIN metrictypes AS mt ON md.metric = mt.metricid
+               JOIN projects AS prj ON md.prjid = prj.prjid
+               JOIN providers AS prv ON md.prvid = prv.prvid """
+    query += " GROUP by md.bucket, md.metric "
+    query += " ORDER BY md.teamid, md.prvid, md.prjid, md.metric, md.bucket"
+    return query, query_params
 
 
-def get_data_general(my_time, ids, dubconn, group_by):
+def get_data_item_cost(my_time, ids):
     """
-    Make the DB call for the given budget actuals.
+    Yield the rows of a csv containing item costs by project, provider,
+    team.  Rows are streamed from the server, so the export's size
+    does not matter; the connection is held until the last row.
     """
+    success, dubconn = utils.open_settings_db(SETTINGS_FILE)
+
+    if success:
+        try:
+            mytime = get_date_filters(my_time)
+            query, query_params = build_item_cost_query(mytime, ids, dubconn)
+            dubmetrics = utils.stream_from_db(query, query_params, dubconn)
+            header = ['Date', 'Item', 'Cost', 'Project', 'Provider', 'Team']
+            for row in iter_item_table(dubmetrics, header, inc_total=True,
+                                       sum_col=2):
+                yield row
+        finally:
+            dubconn.close()
+
+
+def build_cube_query(my_time, dubconn, prv_ids=None):
+    """
+    Return the (query, params) summing the window's spend per bucket of
+    the chart's date format, provider, team and project, for the given
+    providers (all if None).
+    """
+    grain = get_grain(my_time.dformat)
+    cube_ids = Ids(prv_id=prv_ids, team_id=None, project_id=None,
+                   div_id=None)
     query_params = []
 
-    query = " SELECT DATE_FORMAT(datetime,%s), " + group_by
-    query += """,  CAST(IFNULL(sum(cost),0) AS SIGNED INT) FROM metricdata
-                WHERE datetime BETWEEN FROM_UNIXTIME(%s) AND
-                FROM_UNIXTIME(%s) """
+    query = " SELECT " + bucket_label(grain) + ", prvid, teamid, prjid"
+    query += ", IFNULL(sum(cost),0)"
     query_params.append(my_time.dformat)
-    query_params.append(my_time.start)
-    query_params.append(my_time.end)
-    if ids.team is not None:
-        myformat = ','.join(['%s'] * len(ids.team)) + ')'
-        query += " AND teamid IN ("
-        query += myformat
-        for teamval in ids.team:
-            query_params.append(int(teamval))
-    if ids.project is not None:
-        query += " AND prjid = %s "
-        query_params.append(int(ids.project))
+    from_query, from_params = get_spend_from(my_time, cube_ids, dubconn,
+                                             grain)
+    query += from_query
+    query_params += from_params
+    query += " GROUP BY bucket, prvid, teamid, prjid"
+    return query, query_params
+
+def get_spend_cube(my_time, ids, dubconn):
+    """
+    Return the SpendCube for the window and ids' providers, from this
+    worker's cube cache unless the spend data moved since it was built.
+    Team and project filters are sliced from the cube, not pushed into
+    its query: every team/project chart of the same window and
+    providers shares one cube, at the price of a cold one reading all
+    of their spend.
+    """
+    prv_ids = None
     if ids.prv is not None:
-        myformat = ','.join(['%s'] * len(ids.prv)) + ')'
-        query += " AND prvid IN ("
-        query += myformat
-        for prv_val in ids.prv:
-            query_params.append(int(prv_val))
-    query += " GROUP BY " + group_by
-    query += " , DATE_FORMAT(datetime,%s)"
-    query_params.append(my_time.dformat)
-    return utils.get_from_db(query, query_params, dubconn)
+        prv_ids = sorted(set(int(prv_val) for prv_val in ids.prv))
+
+    def load_cube():
+        """ Scan the window once """
+        query, query_params = build_cube_query(my_time, dubconn, prv_ids)
+        return spendcube.SpendCube(utils.get_columns_from_db(
+            query, query_params, dubconn, spendcube.SpendCube.COLUMNS))
+
+    versions = dimcache.get_data_versions(SETTINGS_FILE, dubconn)
+    if 'lastetl' not in versions:
+        return load_cube()
+    # budget and dimension edits do not touch spend
+    cube_versions = dict((name, versions.get(name))
+                         for name in CUBE_VERSIONS)
+    key = (my_time.dformat, int(my_time.start), int(my_time.end),
+           None if prv_ids is None else tuple(prv_ids))
+    return spendcube.get_cube(key, cube_versions, load_cube)
+
+def get_data_general(my_time, ids, dubconn, group_by):
+    """
+    Return the given budget actuals, (month, group_by id, spend) rows,
+    sliced from the window's spend cube.
+    group_by is prvid, teamid, prjid or divid.
+    """
+    team_divs = None
+    if group_by == "divid":
+        team_divs = dimcache.get_dimensions(SETTINGS_FILE, dubconn).team_divs
+    cube = get_spend_cube(my_time, ids, dubconn)
+    return cube.slice(ids, group_by, team_divs)
 
 def get_data_provider(my_time, ids, add_budget):
     """
@@ -1057,11 +1078,7 @@ def get_data_provider(my_time, ids, add_budget):
     months = {}
     datalist = []
 
-    settings = utils.load_json_definition_file(SETTINGS_FILE)
-    success, dubconn = utils.open_monitoring_db(settings['dbhost'],
-                                                settings['dbuser'],
-                                                settings['dbpass'],
-                                                settings['db_db'])
+    success, dubconn = utils.open_settings_db(SETTINGS_FILE)
 
     if success:
         mytime = get_date_filters(my_time)
@@ -1092,11 +1109,7 @@ def get_data_team(my_time, ids, add_budget):
     months = {}
     datalist = []
 
-    settings = utils.load_json_definition_file(SETTINGS_FILE)
-    success, dubconn = utils.open_monitoring_db(settings['dbhost'],
-                                                settings['dbuser'],
-                                                settings['dbpass'],
-                                                settings['db_db'])
+    success, dubconn = utils.open_settings_db(SETTINGS_FILE)
 
     if success:
         mytime = get_date_filters(my_time)
@@ -1129,22 +1142,15 @@ def get_data_div(my_time, ids, add_budget):
     months = {}
     datalist = []
 
-    settings = utils.load_json_definition_file(SETTINGS_FILE)
-    success, dubconn = utils.open_monitoring_db(settings['dbhost'],
-                                                settings['dbuser'],
-                                                settings['dbpass'],
-                                                settings['db_db'])
+    success, dubconn = utils.open_settings_db(SETTINGS_FILE)
 
     if success:
         mytime = get_date_filters(my_time)
         divisions = get_divisions(ids.div, dubconn)
         ids = set_teams_from_divs(ids, dubconn)
-        team_divs = lookup_divisions(ids.team, dubconn)
-        t_metrics = get_data_general(mytime, ids, dubconn, group_by="teamid")
-        for t_metric in t_metrics:
-            if len(t_metric) > 0 and t_metric[2] is not None:
-                # sum across divisions
-                dubmetrics[team_divs[t_metric[1]]][t_metric[0]] += t_metric[2]
+        d_metrics = get_data_general(mytime, ids, dubconn, group_by="divid")
+        for d_metric in d_metrics:
+            dubmetrics[d_metric[1]][d_metric[0]] += d_metric[2]
 
         for div in dubmetrics:
             for month in dubmetrics[div]:
@@ -1157,6 +1163,7 @@ def get_data_div(my_time, ids, add_budget):
                     months[month] = 1
 
         if add_budget:
+            team_divs = lookup_divisions(ids.team, dubconn)
             datalist = add_budget_series_divisions(ids, months, datalist,
                                                    divisions, team_divs,
                                                    dubconn)
@@ -1173,11 +1180,7 @@ def get_data_project(my_time, ids, add_budget):
     months = {}
     datalist = []
 
-    settings = utils.load_json_definition_file(SETTINGS_FILE)
-    success, dubconn = utils.open_monitoring_db(settings['dbhost'],
-                                                settings['dbuser'],
-                                                settings['dbpass'],
-                                                settings['db_db'])
+    success, dubconn = utils.open_settings_db(SETTINGS_FILE)
 
     if success:
         mytime = get_date_filters(my_time)
@@ -1196,6 +1199,26 @@ def get_data_project(my_time, ids, add_budget):
         dubconn.close()
     return json.dumps(datalist)
 
+def build_workload_query(my_time, ids, dubconn):
+    """
+    Return the (query, params) for spend per bucket and metric of
+    one provider (ids.prv, a single id) and project.
+    """
+    grain = get_grain(my_time.dformat)
+    query_params = []
+
+    query = " SELECT " + bucket_label(grain) + """, metric,
+               CAST(IFNULL(sum(cost),0) AS SIGNED INT) """
+    query_params.append(my_time.dformat)
+    wl_ids = Ids(prv_id=[ids.prv], team_id=None,
+                 project_id=ids.project, div_id=None)
+    from_query, from_params = get_spend_from(my_time, wl_ids, dubconn, grain,
+                                             by_metric=True)
+    query += from_query
+    query_params += from_params
+    query += " GROUP BY metric, bucket "
+    return query, query_params
+
 def get_data_workload(mytime, ids, add_budget):
     """
     Return dubweb values for each workload, by given time period.
@@ -1204,31 +1227,15 @@ def get_data_workload(mytime, ids, add_budget):
     buckets = {}
     met_sums = defaultdict(dict)
     datalist = []
-    query_params = []
 
-    settings = utils.load_json_definition_file(SETTINGS_FILE)
-    success, dubconn = utils.open_monitoring_db(settings['dbhost'],
-                                                settings['dbuser'],
-                                                settings['dbpass'],
-                                                settings['db_db'])
+    success, dubconn = utils.open_settings_db(SETTINGS_FILE)
 
     if success:
         ids.prv = ids.prv[0]
         mytime = get_date_filters(mytime)
         buckets = get_provider_metric_buckets(ids.prv, dubconn)
 
-        query = """
-                   SELECT DATE_FORMAT(datetime,%s), metric,
-                   CAST(IFNULL(sum(cost),0) AS SIGNED INT) FROM metricdata
-                   WHERE datetime BETWEEN FROM_UNIXTIME(%s) AND
-                   FROM_UNIXTIME(%s) AND prvid = %s AND prjid = %s 
-                   GROUP BY metric, DATE_FORMAT(datetime,%s) """
-        query_params.append(mytime.dformat)
-        query_params.append(mytime.start)
-        query_params.append(mytime.end)
-        query_params.append(int(ids.prv))
-        query_params.append(int(ids.project))
-        query_params.append(mytime.dformat)
+        query, query_params = build_workload_query(mytime, ids, dubconn)
 
         dubmetrics = utils.get_from_db(query, query_params, dubconn)
 
@@ -1256,56 +1263,107 @@ def get_data_workload(mytime, ids, add_budget):
     return json.dumps(datalist)
 
 
-def estimate_data_provider(mytime, ids, add_budget):
+def build_estimate_query(my_time, ids, dubconn, group_by, by_metric=False):
+    """
+    Return the (query, params) for the daily spend points, keyed by day
+    (YYYYMMDD), that estimates are built from.
+    Rows come ordered by group_by then day.
+    """
+    query = " SELECT bucket, " + group_by
+    query += ",  CAST(IFNULL(sum(cost),0) AS SIGNED INT)"
+    from_query, query_params = get_spend_from(my_time, ids, dubconn, "day",
+                                              by_metric)
+    query += from_query
+    query += " GROUP BY " + group_by + ", bucket"
+    query += " ORDER BY " + group_by + ", bucket"
+    return query, query_params
+
+def get_materialized_estimates(my_time, dubconn):
+    """
+    Return the nightly project forecasts (see cub_extract) as
+    [month, prjid, spend, sigma] rows, ordered by project then month,
+    or None when the request needs an on-demand forecast: a custom time
+    window, or no forecasts stamped with the current data.
+    """
+    if my_time.start is not None or my_time.end is not None:
+        return None
+    versions = dimcache.get_data_versions(SETTINGS_FILE, dubconn)
+    if versions.get(FORECASTS_VERSION, 0) == 0:
+        return None
+
+    this_month = dt.date.today().replace(day=1)
+    query = """
+            SELECT DATE_FORMAT(month, '%%Y-%%m'), grpid, spend, sigma
+            FROM forecasts WHERE grp = 'prjid' AND lastetl = %s
+            AND dimversion = %s AND month >= %s
+            ORDER BY grpid, month """
+    query_params = [versions.get('lastetl', 0),
+                    versions.get(dimcache.DIMENSIONS_VERSION, 0), this_month]
+    rows = utils.get_from_db(query, query_params, dubconn)
+    if not rows:
+        return None
+    return [[row[0], int(row[1]), int(row[2]), int(row[3])] for row in rows]
+
+def get_project_estimates(my_time, ids, dubconn):
+    """
+    Return projected monthly spend per project as
+    [month, prjid, spend, sigma] rows, from the forecasts table when it
+    covers the request, else forecast from one daily fetch grouped by
+    prjid.
+    """
+    estimates = get_materialized_estimates(my_time, dubconn)
+    if estimates is not None:
+        return estimates
+
+    def_time = CTimes(d_format="%Y-%m", start_time=None, end_time=None)
+    def_time = get_date_filters(def_time)
+    query, query_params = build_estimate_query(def_time, ids, dubconn,
+                                               group_by="prjid")
+    dailymetrics = utils.get_columns_from_db(query, query_params, dubconn,
+                                             [('day', 'id'),
+                                              ('grp', 'id'),
+                                              ('spend', 'float')])
+    return estimate_monthly_metrics(my_time, dailymetrics)
+
+def get_estimates(my_time, ids, dubconn, group_by):
+    """
+    Return projected monthly spend of group_by (prjid, teamid, divid or
+    prvid) as [month, id, spend, sigma] rows: the forecasts of the
+    projects ids selects, summed up the project -> team -> division (or
+    project -> provider) hierarchy, so every level agrees.
+    """
+    dims = dimcache.get_dimensions(SETTINGS_FILE, dubconn)
+    parents = {}
+    for prj in get_projects(ids.prv, ids.team, ids.project, dubconn):
+        prv, team = dims.projects[prj][2:4]
+        parents[prj] = {'prjid': prj, 'prvid': prv, 'teamid': team,
+                        'divid': dims.team_divs.get(team)}[group_by]
+
+    estimates = get_project_estimates(my_time, ids, dubconn)
+    return forecast.rollup_forecast(estimates, parents)
+
+def set_bands(data_point, dubmetric):
+    """
+    Add the p10/p50/p90 band of an estimate row to its chart data point
+    """
+    data_point["P10"], data_point["P50"], data_point["P90"] = \
+        forecast.bands(dubmetric[2], dubmetric[3])
+    return data_point
+
+def estimate_data_provider(mytime, ids, add_budget, add_bands=False):
     """
     Estimate (where necessary) and return dubweb values for each provider,
-    by given time period.
+    by given time period, with p10/p50/p90 bands if add_bands.
     """
     providers = {}
     months = {}
     datalist = []
-    query_params = []
 
-    settings = utils.load_json_definition_file(SETTINGS_FILE)
-    success, dubconn = utils.open_monitoring_db(settings['dbhost'],
-                                                settings['dbuser'],
-                                                settings['dbpass'],
-                                                settings['db_db'])
+    success, dubconn = utils.open_settings_db(SETTINGS_FILE)
 
     if success:
-        def_time = CTimes(d_format="%Y-%m", start_time=None, end_time=None)
-        def_time = get_date_filters(def_time)
         providers = get_providers(ids.prv, dubconn)
-
-        query = """
-                   SELECT DATE_FORMAT(datetime,%s), prvid,
-                   CAST(IFNULL(sum(cost),0) AS SIGNED INT) FROM metricdata
-                   WHERE datetime BETWEEN FROM_UNIXTIME(%s) AND
-                   FROM_UNIXTIME(%s) """
-        query_params.append(def_time.dformat)
-        query_params.append(def_time.start)
-        query_params.append(def_time.end)
-        if ids.team is not None:
-            myformat = ','.join(['%s'] * len(ids.team)) + ')'
-            query += " AND teamid IN ("
-            query += myformat
-            for teamval in ids.team:
-                query_params.append(int(teamval))
-        if ids.project is not None:
-            query += " AND prjid = %s "
-            query_params.append(int(ids.project))
-        if ids.prv is not None:
-            myformat = ','.join(['%s'] * len(ids.prv)) + ')'
-            query += " AND prvid IN ("
-            query += myformat
-            for prv_val in ids.prv:
-                query_params.append(int(prv_val))
-        query += " GROUP BY prvid, DATE_FORMAT(datetime,%s)"
-        query_params.append("%Y-%m-%d")
-
-        dailymetrics = utils.get_from_db(query, query_params, dubconn)
-
-        dubmetrics = estimate_monthly_metrics(mytime, dailymetrics)
+        dubmetrics = get_estimates(mytime, ids, dubconn, group_by="prvid")
 
         for dubmetric in dubmetrics:
             if len(dubmetric) > 0 and dubmetric[2] is not None:
@@ -1313,6 +1371,8 @@ def estimate_data_provider(mytime, ids, add_budget):
                 data_point["Month"] = dubmetric[0]
                 data_point["Provider"] = providers[dubmetric[1]][0]
                 data_point["Spend"] = dubmetric[2]
+                if add_bands:
+                    set_bands(data_point, dubmetric)
                 datalist.append(data_point)
                 months[dubmetric[0]] = 1
 
@@ -1324,55 +1384,20 @@ def estimate_data_provider(mytime, ids, add_budget):
         dubconn.close()
     return json.dumps(datalist)
 
-def estimate_data_team(mytime, ids, add_budget):
+def estimate_data_team(mytime, ids, add_budget, add_bands=False):
     """
-    Return dubweb values for each team, by given time period.
+    Return dubweb values for each team, by given time period,
+    with p10/p50/p90 bands if add_bands.
     """
     teams = {}
     months = {}
     datalist = []
-    query_params = []
 
-    settings = utils.load_json_definition_file(SETTINGS_FILE)
-    success, dubconn = utils.open_monitoring_db(settings['dbhost'],
-                                                settings['dbuser'],
-                                                settings['dbpass'],
-                                                settings['db_db'])
+    success, dubconn = utils.open_settings_db(SETTINGS_FILE)
 
     if success:
-        def_time = CTimes(d_format="%Y-%m", start_time=None, end_time=None)
-        def_time = get_date_filters(def_time)
         teams = get_teams(ids.team, dubconn)
-
-        query = """
-                   SELECT DATE_FORMAT(datetime,%s), teamid,
-                   CAST(IFNULL(sum(cost),0) AS SIGNED INT) FROM metricdata
-                   WHERE datetime BETWEEN FROM_UNIXTIME(%s) AND
-                   FROM_UNIXTIME(%s) """
-        query_params.append(def_time.dformat)
-        query_params.append(def_time.start)
-        query_params.append(def_time.end)
-        if ids.team is not None:
-            myformat = ','.join(['%s'] * len(ids.team)) + ')'
-            query += " AND teamid IN ("
-            query += myformat
-            for teamval in ids.team:
-                query_params.append(int(teamval))
-        if ids.project is not None:
-            query += " AND prjid = %s "
-            query_params.append(int(ids.project))
-        if ids.prv is not None:
-            myformat = ','.join(['%s'] * len(ids.prv)) + ')'
-            query += " AND prvid IN ("
-            query += myformat
-            for prv_val in ids.prv:
-                query_params.append(int(prv_val))
-        query += " GROUP BY teamid, DATE_FORMAT(datetime,%s)"
-        query_params.append("%Y-%m-%d")
-
-        dailymetrics = utils.get_from_db(query, query_params, dubconn)
-
-        dubmetrics = estimate_monthly_metrics(mytime, dailymetrics)
+        dubmetrics = get_estimates(mytime, ids, dubconn, group_by="teamid")
 
         for dubmetric in dubmetrics:
             if len(dubmetric) > 0 and dubmetric[2] is not None:
@@ -1380,6 +1405,8 @@ def estimate_data_team(mytime, ids, add_budget):
                 data_point["Month"] = dubmetric[0]
                 data_point["Team"] = teams[dubmetric[1]]
                 data_point["Spend"] = dubmetric[2]
+                if add_bands:
+                    set_bands(data_point, dubmetric)
                 datalist.append(data_point)
                 months[dubmetric[0]] = 1
 
@@ -1390,3 +1417,117 @@ def estimate_data_team(mytime, ids, add_budget):
         dubconn.close()
     return json.dumps(datalist)
 
+
+def estimate_data_project(mytime, ids, add_bands=False):
+    """
+    Return estimated dubweb values for each project,
+    with p10/p50/p90 bands if add_bands.
+    """
+    projects = {}
+    datalist = []
+
+    success, dubconn = utils.open_settings_db(SETTINGS_FILE)
+
+    if success:
+        projects = get_projects(ids.prv, ids.team, ids.project, dubconn)
+        dubmetrics = get_estimates(mytime, ids, dubconn, group_by="prjid")
+
+        for dubmetric in dubmetrics:
+            data_point = {}
+            data_point["Month"] = dubmetric[0]
+            data_point["Project"] = projects[dubmetric[1]][0]
+            data_point["Spend"] = dubmetric[2]
+            if add_bands:
+                set_bands(data_point, dubmetric)
+            datalist.append(data_point)
+
+        dubconn.close()
+    return json.dumps(datalist)
+
+def estimate_data_div(mytime, ids, add_budget, add_bands=False):
+    """
+    Return estimated dubweb values for each division,
+    with p10/p50/p90 bands if add_bands.
+    """
+    divisions = {}
+    months = {}
+    datalist = []
+
+    success, dubconn = utils.open_settings_db(SETTINGS_FILE)
+
+    if success:
+        divisions = get_divisions(ids.div, dubconn)
+        ids = set_teams_from_divs(ids, dubconn)
+        dubmetrics = get_estimates(mytime, ids, dubconn, group_by="divid")
+
+        for dubmetric in dubmetrics:
+            data_point = {}
+            data_point["Month"] = dubmetric[0]
+            data_point["Division"] = divisions[dubmetric[1]]
+            data_point["Spend"] = dubmetric[2]
+            if add_bands:
+                set_bands(data_point, dubmetric)
+            datalist.append(data_point)
+            months[dubmetric[0]] = 1
+
+        if add_budget:
+            team_divs = lookup_divisions(ids.team, dubconn)
+            datalist = add_budget_series_divisions(ids, months, datalist,
+                                                   divisions, team_divs,
+                                                   dubconn)
+
+        dubconn.close()
+    return json.dumps(datalist)
+
+def estimate_data_workload(mytime, ids, add_bands=False):
+    """
+    Return estimated dubweb values for each workload of one provider
+    and project: every metric is forecast, then summed into its
+    workload bucket.  Includes p10/p50/p90 bands if add_bands.
+    Without both a provider and a project, the list is empty.
+    """
+    datalist = []
+    if not ids.prv or not ids.project:
+        return json.dumps(datalist)
+
+    success, dubconn = utils.open_settings_db(SETTINGS_FILE)
+
+    if success:
+        prv_id = ids.prv[0]
+        buckets = get_provider_metric_buckets(prv_id, dubconn)
+        parents = {}
+        names = {}
+        for metric, bucket in buckets.iteritems():
+            # metrics no rule matched keep their own name as bucket
+            if isinstance(bucket, list):
+                parents[metric] = bucket[0]
+                names[bucket[0]] = bucket[1]
+            else:
+                parents[metric] = bucket
+                names[bucket] = bucket
+
+        def_time = CTimes(d_format="%Y-%m", start_time=None, end_time=None)
+        def_time = get_date_filters(def_time)
+        wl_ids = Ids(prv_id=[prv_id], team_id=None,
+                     project_id=ids.project, div_id=None)
+        query, query_params = build_estimate_query(def_time, wl_ids, dubconn,
+                                                   group_by="metric",
+                                                   by_metric=True)
+        dailymetrics = utils.get_columns_from_db(query, query_params, dubconn,
+                                                 [('day', 'id'),
+                                                  ('grp', 'id'),
+                                                  ('spend', 'float')])
+        dubmetrics = forecast.rollup_forecast(
+            estimate_monthly_metrics(mytime, dailymetrics), parents)
+
+        for dubmetric in dubmetrics:
+            data_point = {}
+            data_point["Month"] = dubmetric[0]
+            data_point["Workload"] = names[dubmetric[1]]
+            data_point["Spend"] = dubmetric[2]
+            if add_bands:
+                set_bands(data_point, dubmetric)
+            datalist.append(data_point)
+
+        dubconn.close()
+    return json.dumps(datalist)
@@ -0,0 +1,337 @@
+#!/usr/bin/env python
+"""
+response cache library
+   Called by flask dubweb apis
+   to answer conditional GETs, and serve repeated /data and /est
+   requests from local disk, shared by every uwsgi worker, until
+   the ETL or an admin edit moves the data versions.
+
+   Copyright 2015 zulily, Inc.
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+     http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+
+import calendar
+import datetime
+import functools
+import hashlib
+import json
+import os
+import stat
+import tempfile
+import threading
+import time
+from flask import request, make_response
+
+from app import app
+import app.dimcache as dimcache
+import app.dubwebdb as dubwebdb
+import app.utils as utils
+
+#globals
+# private to the dubweb user (0700), next to its settings; entries are
+# only read from a directory it owns that no one else can write
+CACHE_DIR = "/var/dubweb/respcache"
+CACHE_MAX_MB = 256
+# entries untouched this long belong to old data versions
+CACHE_MAX_AGE = 2 * 86400
+# prune the directory every this many stores (per worker)
+PRUNE_EVERY = 200
+
+_STATS = {'hits': 0, 'misses': 0, 'not_modified': 0, 'stores': 0,
+          'bytes_served': 0, 'bytes_stored': 0, 'errors': 0}
+_LOCK = threading.Lock()
+
+def _settings():
+    """
+    Return the dubweb settings, where respcache_* keys live
+    """
+    return utils.get_settings(dubwebdb.SETTINGS_FILE)
+
+
+def _cache_dir():
+    """
+    Return the cache directory from settings (respcache_dir)
+    """
+    return _settings().get_str('respcache_dir', CACHE_DIR)
+
+
+def _private_dir(path):
+    """
+    Create path (mode 0700) if missing, and return True if it is a
+    directory, not a link, owned by this process's user and closed to
+    everyone else.
+    """
+    try:
+        if not os.path.lexists(path):
+            os.makedirs(path, 0700)
+        dstat = os.lstat(path)
+    except OSError, err:
+        app.logger.error("response cache directory %s: %s", path, err)
+        return False
+    if not stat.S_ISDIR(dstat.st_mode) or dstat.st_uid != os.getuid() or \
+       dstat.st_mode & 0077:
+        app.logger.error("response cache directory %s is not private to "
+                         "uid %d, not using it", path, os.getuid())
+        return False
+    return True
+
+
+def _count(counter, amount=1):
+    """
+    Bump one of this worker's counters
+    """
+    with _LOCK:
+        _STATS[counter] += amount
+
+
+def normalize_args(args):
+    """
+    Return the query args as a sorted list of (name, value), with
+    comma separated id lists sorted too, so equivalent requests share
+    an entry.
+    """
+    normal = []
+    for name in sorted(args.iterkeys()):
+        for value in sorted(args.getlist(name)):
+            if ',' in value:
+                value = ','.join(sorted(value.split(',')))
+            normal.append((name, value))
+    return normal
+
+
+def _clock_dependent(args, now_dependent):
+    """
+    Return True if the answer depends on the clock: estimates, or
+    windowed requests using the default time window.
+    now_dependent is True, False, or 'window' to check the args.
+    """
+    if now_dependent == 'window':
+        return args.get('time_start') is None or \
+            args.get('time_end') is None
+    return bool(now_dependent)
+
+
+def make_key(path, args, versions, now_dependent):
+    """
+    Return the cache key for a request: its path, normalized args and
+    the data versions, plus the current hour if its answer depends on
+    the clock.
+    """
+    parts = [path, normalize_args(args), sorted(versions.iteritems())]
+    if _clock_dependent(args, now_dependent):
+        parts.append(int(time.time() // 3600))
+    return hashlib.sha1(repr(parts)).hexdigest()
+
+
+def last_modified(args, versions, now_dependent):
+    """
+    Return the epoch seconds the answer last changed: the newest ETL
+    run or version bump, or the current hour if that is later and the
+    answer depends on the clock.
+    """
+    stamp = max([versions.get('lastetl', 0), versions.get('updated', 0)])
+    if _clock_dependent(args, now_dependent):
+        stamp = max(stamp, int(time.time() // 3600) * 3600)
+    return stamp
+
+
+def not_modified(key, modified):
+    """
+    Return True if the request's If-None-Match (or, without one, its
+    If-Modified-Since) shows the client already has this answer.
+    """
+    if request.if_none_match:
+        return request.if_none_match.contains(key)
+    if request.if_modified_since is not None:
+        since = calendar.timegm(request.if_modified_since.utctimetuple())
+        return since >= int(modified)
+    return False
+
+
+def _add_validators(response, key, modified):
+    """
+    Set the strong ETag and Last-Modified headers on response
+    """
+    response.set_etag(key)
+    response.last_modified = datetime.datetime.utcfromtimestamp(modified)
+    return response
+
+
+def _entry_path(key):
+    """
+    Return the file holding key's entry
+    """
+    return os.path.join(_cache_dir(), key[:2], key)
+
+
+def load(key):
+    """
+    Return the cached (status, headers, body) for key, or None.
+    An entry is a json [status, headers] line followed by the body.
+    """
+    path = _entry_path(key)
+    try:
+        with open(path, 'rb') as entry_file:
+            (status, headers) = json.loads(entry_file.readline())
+            body = entry_file.read()
+        # mtime doubles as the last-used time for pruning
+        os.utime(path, None)
+    except (IOError, OSError):
+        return None
+    except (ValueError, TypeError), err:
+        app.logger.error("response cache read failed: %s", err)
+        _count('errors')
+        return None
+    return (status, [tuple(header) for header in headers], body)
+
+
+def store(key, entry):
+    """
+    Write entry for key, atomically: other workers see the old file,
+    no file, or the complete new one.
+    """
+    path = _entry_path(key)
+    try:
+        header_line = json.dumps([entry[0], entry[1]])
+        entry_dir = os.path.dirname(path)
+        if not os.path.isdir(entry_dir):
+            os.makedirs(entry_dir, 0700)
+        fdesc, tmp_path = tempfile.mkstemp(dir=entry_dir, prefix='.tmp')
+        with os.fdopen(fdesc, 'wb') as entry_file:
+            entry_file.write(header_line + "\n")
+            entry_file.write(entry[2])
+        os.rename(tmp_path, path)
+    except (IOError, OSError, ValueError, UnicodeDecodeError), err:
+        app.logger.error("response cache write failed: %s", err)
+        _count('errors')
+        return
+
+    _count('stores')
+    _count('bytes_stored', len(entry[2]))
+    if _STATS['stores'] % PRUNE_EVERY == 0:
+        prune()
+
+
+def _scan():
+    """
+    Return (mtime, size, path) for every entry on disk
+    """
+    entries = []
+    for dirpath, _, filenames in os.walk(_cache_dir()):
+        for filename in filenames:
+            path = os.path.join(dirpath, filename)
+            try:
+                fstat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((fstat.st_mtime, fstat.st_size, path))
+    return entries
+
+
+def prune():
+    """
+    Remove entries unused for CACHE_MAX_AGE, then the least recently
+    used ones until the cache fits respcache_max_mb.
+    """
+    max_bytes = _settings().get_int('respcache_max_mb', CACHE_MAX_MB) << 20
+    entries = sorted(_scan())
+    total = sum(entry[1] for entry in entries)
+    oldest_ok = time.time() - CACHE_MAX_AGE
+    for mtime, size, path in entries:
+        if mtime >= oldest_ok and total <= max_bytes:
+            break
+        try:
+            os.remove(path)
+            total -= size
+        except OSError:
+            pass
+
+
+def get_stats():
+    """
+    Return this worker's counters, plus what is on disk for all workers
+    """
+    with _LOCK:
+        stats = dict(_STATS)
+    entries = _scan()
+    stats['entries'] = len(entries)
+    stats['disk_bytes'] = sum(entry[1] for entry in entries)
+    return stats
+
+
+def dub_versions():
+    """
+    Return the dubweb data versions (see dimcache.read_data_versions)
+    """
+    return dimcache.get_data_versions(dubwebdb.SETTINGS_FILE)
+
+
+def cached(now_dependent='window', versions_fn=dub_versions, disk=True,
+           when=None):
+    """
+    Decorate a flask view with conditional GET support and, if disk,
+    the on-disk response cache, both keyed by path, args and the data
+    versions from versions_fn.  Answers that depend on the clock (see
+    _clock_dependent) also change key every hour.
+    Requests the client already has get a 304 before the view runs.
+    Only 200 responses are stored, streamed responses are passed
+    through.  when(request), if given, says whether a request may be
+    cached at all.  The disk cache is off with use_respcache: 0, and
+    when its directory is not private.  Requests whose versions could
+    not be read (no 'lastetl') just call the view, as the key and
+    validators would then never change.
+    """
+    def decorator(view):
+        """ Wrap view """
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            """ Answer 304, serve from the cache, or call the view """
+            if when is not None and not when(request):
+                return view(*args, **kwargs)
+
+            versions = versions_fn()
+            if 'lastetl' not in versions:
+                return view(*args, **kwargs)
+            key = make_key(request.path, request.args, versions,
+                           now_dependent)
+            modified = last_modified(request.args, versions, now_dependent)
+            if not_modified(key, modified):
+                _count('not_modified')
+                return _add_validators(make_response('', 304), key, modified)
+
+            use_disk = disk and \
+                _settings().get_bool('use_respcache', True) and \
+                _private_dir(_cache_dir())
+            entry = None
+            if use_disk:
+                entry = load(key)
+            if entry is not None:
+                _count('hits')
+                _count('bytes_served', len(entry[2]))
+                response = make_response(entry[2], entry[0])
+                response.headers.clear()
+                response.headers.extend(entry[1])
+                return response
+
+            response = make_response(view(*args, **kwargs))
+            if response.status_code == 200:
+                _add_validators(response, key, modified)
+                if use_disk and not response.is_streamed:
+                    _count('misses')
+                    store(key, (response.status_code,
+                                response.headers.items(),
+                                response.get_data()))
+            return response
+        return wrapper
+    return decorator
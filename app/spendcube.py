@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+"""
+spend cube library
+   Called by dubwebdb
+   to answer the provider, team, division and project charts
+   from one scan of a time window's spend.
+
+   Copyright 2015 zulily, Inc.
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+     http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+
+from collections import OrderedDict
+import threading
+import numpy as np
+
+import app.utils as utils
+
+#globals
+# windows kept per worker; each is a few thousand rows at most
+CUBE_CACHE_SIZE = 16
+
+_CUBES = OrderedDict()
+_LOCK = threading.Lock()
+
+class SpendCube(object):
+    """
+    Spend of one time window at (bucket, prvid, teamid, prjid) grain
+    """
+    # columns of the cube query, in order
+    COLUMNS = [('label', 'id'), ('prvid', 'id'), ('teamid', 'id'),
+               ('prjid', 'id'), ('cost', 'float')]
+
+    def __init__(self, result):
+        """
+        result: utils.ColumnarResult of the cube query (see COLUMNS)
+        """
+        self.result = result
+
+    def __len__(self):
+        return len(self.result)
+
+    def select(self, ids):
+        """
+        Return the cube rows matching ids (prv/team lists, a project id)
+        """
+        cube = self.result
+        mask = np.ones(len(cube), dtype=bool)
+        for name, id_list in (('prvid', ids.prv), ('teamid', ids.team)):
+            if id_list is not None:
+                wanted = np.array([int(id_val) for id_val in id_list])
+                mask &= np.in1d(cube.decoded(name), wanted)
+        if ids.project is not None:
+            mask &= cube.decoded('prjid') == int(ids.project)
+        return cube.take(mask)
+
+    def slice(self, ids, group_by, team_divs=None):
+        """
+        Sum the cube rows matching ids (prv/team lists, a project id)
+        per bucket label and group_by column, one of prvid, teamid,
+        prjid or divid (which needs team_divs, teamid : divid).
+        Return (label, group id, spend) rows ordered by group then label,
+        with spend rounded like MySQL's CAST(... AS SIGNED INT).
+        """
+        rows = self.select(ids)
+
+        if group_by == "divid":
+            team_div = np.array([team_divs[team]
+                                 for team in rows.values('teamid')],
+                                dtype=np.int64)
+            groups, group_codes = np.unique(team_div[rows['teamid']],
+                                            return_inverse=True)
+        else:
+            groups = rows.values(group_by)
+            group_codes = rows[group_by]
+        labels = rows.values('label')
+
+        sums, counts = utils.group_sum([group_codes, rows['label']],
+                                       [len(groups), len(labels)],
+                                       rows['cost'])
+        spend = utils.round_half_away(sums)
+        group_idx, label_idx = np.nonzero(counts)
+        return [(str(labels[lbl]), int(groups[grp]), int(spend[grp, lbl]))
+                for grp, lbl in zip(group_idx, label_idx)]
+
+    def slice_teams(self, ids, group_by):
+        """
+        Like slice, but per team as well: sum the rows matching ids per
+        bucket label, teamid and group_by column (prvid or prjid).
+        Return (label, teamid, group id, spend) rows ordered by team,
+        group then label.
+        """
+        rows = self.select(ids)
+        teams = rows.values('teamid')
+        groups = rows.values(group_by)
+        labels = rows.values('label')
+
+        sums, counts = utils.group_sum([rows['teamid'], rows[group_by],
+                                        rows['label']],
+                                       [len(teams), len(groups), len(labels)],
+                                       rows['cost'])
+        spend = utils.round_half_away(sums)
+        team_idx, group_idx, label_idx = np.nonzero(counts)
+        return [(str(labels[lbl]), int(teams[team]), int(groups[grp]),
+                 int(spend[team, grp, lbl]))
+                for team, grp, lbl in zip(team_idx, group_idx, label_idx)]
+
+
+def get_cube(key, versions, loader):
+    """
+    Return the cached SpendCube for key (the normalized window) if it
+    was built under the same data versions, else build it with loader()
+    and cache it (unless empty), dropping the least recently used window.
+    """
+    with _LOCK:
+        entry = _CUBES.pop(key, None)
+        if entry is not None and entry[0] == versions:
+            _CUBES[key] = entry
+            return entry[1]
+
+    cube = loader()
+    # an empty window is cheap to rescan, and may be a failed query
+    if len(cube):
+        with _LOCK:
+            _CUBES[key] = (versions, cube)
+            while len(_CUBES) > CUBE_CACHE_SIZE:
+                _CUBES.popitem(last=False)
+    return cube
+
+
+def clear():
+    """
+    Drop every cached cube
+    """
+    with _LOCK:
+        _CUBES.clear()
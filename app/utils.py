@@ -5,9 +5,252 @@ utils helper library
    for loading data, etc.
 """
 import json
+import os
+import threading
+import time
+import numpy as np
 import MySQLdb
+import MySQLdb.cursors
 from app import app
 
+#globals
+POOL_SIZE = 8
+POOL_TIMEOUT = 10
+POOL_RECYCLE = 3600
+SETTINGS_CHECK_SECONDS = 1.0
+STREAM_BATCH_ROWS = 1000
+
+_POOLS = {}
+_POOLS_LOCK = threading.Lock()
+_SETTINGS_POOLS = {}
+_SETTINGS = {}
+_SETTINGS_LOCK = threading.Lock()
+
+class PoolTimeout(Exception):
+    """
+    Raised when no pooled connection frees up before the checkout timeout
+    """
+    pass
+
+class PooledConnection(object):
+    """
+    Thin wrapper around a MySQLdb connection checked out of a pool.
+    close() hands the connection back to its pool instead of closing it.
+    """
+    def __init__(self, pool, conn, created):
+        self._pool = pool
+        self._conn = conn
+        self._created = created
+
+    def cursor(self, *args):
+        """ Return a cursor on the underlying connection """
+        return self._conn.cursor(*args)
+
+    def commit(self):
+        """ Commit on the underlying connection """
+        return self._conn.commit()
+
+    def rollback(self):
+        """ Rollback on the underlying connection """
+        return self._conn.rollback()
+
+    def close(self):
+        """ Return the underlying connection to the pool (idempotent) """
+        if self._conn is not None:
+            conn = self._conn
+            self._conn = None
+            self._pool.checkin(conn, self._created)
+
+    def __del__(self):
+        # callers that bail out on an exception never reach close()
+        self.close()
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        if self._conn is None:
+            raise MySQLdb.InterfaceError(0, "connection returned to pool")
+        return getattr(self._conn, name)
+
+
+class ConnectionPool(object):
+    """
+    Bounded pool of MySQL connections for one (host, user, db)
+    """
+    def __init__(self, db_host, db_user, db_pass, db_database,
+                 size=POOL_SIZE, timeout=POOL_TIMEOUT, recycle=POOL_RECYCLE):
+        """
+        Pool starts empty; connections are created on demand, up to size.
+        """
+        self._host = db_host
+        self._user = db_user
+        self._pass = db_pass
+        self._db = db_database
+        self.size = size
+        self.timeout = timeout
+        self.recycle = recycle
+        self._idle = []
+        self._open = 0
+        self._reset_at = 0
+        self._cond = threading.Condition()
+        self._stats = {'in_use': 0, 'waits': 0, 'creates': 0,
+                       'checkouts': 0, 'timeouts': 0, 'recycles': 0,
+                       'ping_failures': 0}
+
+    def _connect(self):
+        """
+        Open a brand new MySQL connection
+        """
+        conn = MySQLdb.connect(host=self._host,
+                               user=self._user,
+                               passwd=self._pass,
+                               db=self._db)
+        return conn, time.time()
+
+    @staticmethod
+    def _discard(conn):
+        """
+        Close a connection we no longer trust, ignoring errors
+        """
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def checkout(self):
+        """
+        Return a healthy PooledConnection, waiting up to timeout seconds
+        for one to free up when the pool is at its bound.
+        """
+        deadline = time.time() + self.timeout
+        with self._cond:
+            while not self._idle and self._open >= self.size:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    self._stats['timeouts'] += 1
+                    raise PoolTimeout("no connection to %s@%s/%s within %ss"
+                                      % (self._user, self._host, self._db,
+                                         self.timeout))
+                self._stats['waits'] += 1
+                self._cond.wait(remaining)
+            if self._idle:
+                conn, created = self._idle.pop()
+            else:
+                conn, created = None, None
+                self._open += 1
+            self._stats['in_use'] += 1
+            self._stats['checkouts'] += 1
+
+        # health checks happen outside the lock, they hit the network
+        try:
+            if conn is not None and time.time() - created > self.recycle:
+                self._discard(conn)
+                conn = None
+                self._count('recycles')
+            if conn is not None:
+                try:
+                    conn.ping()
+                except MySQLdb.Error:
+                    self._discard(conn)
+                    conn = None
+                    self._count('ping_failures')
+            if conn is None:
+                conn, created = self._connect()
+                self._count('creates')
+        except Exception:
+            with self._cond:
+                self._open -= 1
+                self._stats['in_use'] -= 1
+                self._cond.notify()
+            raise
+
+        return PooledConnection(self, conn, created)
+
+    def checkin(self, conn, created):
+        """
+        Take back a connection, ending any open transaction/read snapshot.
+        Connections opened before a drain, or above a shrunk size, are
+        closed instead of going back to idle.
+        """
+        try:
+            conn.rollback()
+        except MySQLdb.Error:
+            self._discard(conn)
+            conn = None
+        stale = None
+        with self._cond:
+            self._stats['in_use'] -= 1
+            if conn is not None and (created < self._reset_at or
+                                     self._open > self.size):
+                stale, conn = conn, None
+            if conn is None:
+                self._open -= 1
+            else:
+                self._idle.append((conn, created))
+            self._cond.notify()
+        if stale is not None:
+            self._discard(stale)
+
+    def _drain_idle(self):
+        """
+        Forget the idle connections and mark everything opened so far as
+        stale; caller holds the lock and closes what comes back.
+        """
+        self._reset_at = time.time()
+        drained = [conn for conn, _ in self._idle]
+        self._open -= len(drained)
+        self._idle = []
+        self._cond.notify_all()
+        return drained
+
+    def drain(self):
+        """
+        Close the idle connections now, and checked out ones as they
+        come back.
+        """
+        with self._cond:
+            drained = self._drain_idle()
+        for conn in drained:
+            self._discard(conn)
+
+    def configure(self, db_pass, size, timeout, recycle):
+        """
+        Apply reloaded settings. size, timeout and recycle take effect on
+        the next checkout; a new password drains the pool so no connection
+        made with the old one is handed out again.
+        """
+        drained = []
+        with self._cond:
+            self.timeout = timeout
+            self.recycle = recycle
+            if size != self.size:
+                self.size = size
+                self._cond.notify_all()
+            if db_pass != self._pass:
+                self._pass = db_pass
+                drained = self._drain_idle()
+        for conn in drained:
+            self._discard(conn)
+
+    def _count(self, counter):
+        """
+        Bump one of the pool counters
+        """
+        with self._cond:
+            self._stats[counter] += 1
+
+    def get_stats(self):
+        """
+        Return a snapshot of the pool counters
+        """
+        with self._cond:
+            stats = dict(self._stats)
+            stats['idle'] = len(self._idle)
+            stats['open'] = self._open
+            stats['size'] = self.size
+        return stats
+
+
 def load_json_definition_file(filename):
     """
     Load definition file (json).
@@ -24,18 +267,238 @@ def load_json_definition_file(filename):
     return mydict
 
 
+class SettingsFile(object):
+    """
+    A json settings file, parsed once and re-parsed only when the file's
+    mtime, size or inode changes (checked at most every
+    SETTINGS_CHECK_SECONDS).  Supports read-only dict style access.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self._data = {}
+        self._stamp = None
+        self._loaded = False
+        self._checked = 0
+        self._hooks = []
+        self._lock = threading.Lock()
+
+    def _file_stamp(self):
+        """
+        Return what identifies this version of the file on disk
+        """
+        try:
+            fstat = os.stat(self.filename)
+        except OSError:
+            return None
+        return (fstat.st_ino, fstat.st_mtime, fstat.st_size)
+
+    def _refresh(self, force=False):
+        """
+        Re-parse the file if it changed since the last check
+        """
+        now = time.time()
+        if not force and self._loaded and \
+           now - self._checked < SETTINGS_CHECK_SECONDS:
+            return
+        with self._lock:
+            self._checked = now
+            stamp = self._file_stamp()
+            if not force and self._loaded and stamp == self._stamp:
+                return
+            self._data = load_json_definition_file(self.filename)
+            self._stamp = stamp
+            self._loaded = True
+            hooks = list(self._hooks)
+        for hook in hooks:
+            hook(self)
+
+    def reload(self):
+        """
+        Force a re-parse of the file, running the reload hooks
+        """
+        self._refresh(force=True)
+
+    def add_reload_hook(self, hook):
+        """
+        Call hook(settings) every time the file is (re)parsed
+        """
+        with self._lock:
+            self._hooks.append(hook)
+
+    def __getitem__(self, key):
+        self._refresh()
+        return self._data[key]
+
+    def __contains__(self, key):
+        self._refresh()
+        return key in self._data
+
+    def get(self, key, default=None):
+        """
+        Return the raw value for key, or default
+        """
+        self._refresh()
+        return self._data.get(key, default)
+
+    def get_str(self, key, default=None):
+        """
+        Return the value for key as a string, or default
+        """
+        value = self.get(key)
+        if value is None:
+            return default
+        return str(value)
+
+    def get_int(self, key, default=None):
+        """
+        Return the value for key as an int, or default if missing/invalid
+        """
+        try:
+            return int(self.get(key))
+        except (TypeError, ValueError):
+            return default
+
+    def get_float(self, key, default=None):
+        """
+        Return the value for key as a float, or default if missing/invalid
+        """
+        try:
+            return float(self.get(key))
+        except (TypeError, ValueError):
+            return default
+
+    def get_bool(self, key, default=False):
+        """
+        Return the value for key as a bool (1/true/yes), or default
+        """
+        value = self.get(key)
+        if value is None:
+            return default
+        if isinstance(value, basestring):
+            return value.strip().lower() in ('1', 'true', 'yes', 'on')
+        return bool(value)
+
+    def db_params(self, prefix=""):
+        """
+        Return (host, user, pass, db) for the settings' prefix, e.g.
+        "" for dbhost/.../db_db, "c" for cdbhost/.../cdb_db.
+        """
+        return (self[prefix + 'dbhost'], self[prefix + 'dbuser'],
+                self[prefix + 'dbpass'], self[prefix + 'db_db'])
+
+
+def get_settings(filename):
+    """
+    Return the process-wide SettingsFile for filename.
+    """
+    with _SETTINGS_LOCK:
+        settings = _SETTINGS.get(filename)
+        if settings is None:
+            settings = SettingsFile(filename)
+            _SETTINGS[filename] = settings
+    return settings
+
+
+def get_pool(db_host, db_user, db_pass, db_database, size=POOL_SIZE,
+             timeout=POOL_TIMEOUT, recycle=POOL_RECYCLE):
+    """
+    Return the process-wide pool for (host, user, db), creating it if needed.
+    """
+    key = (db_host, db_user, db_database)
+    with _POOLS_LOCK:
+        pool = _POOLS.get(key)
+        if pool is None:
+            pool = ConnectionPool(db_host, db_user, db_pass, db_database,
+                                  size, timeout, recycle)
+            _POOLS[key] = pool
+    return pool
+
+
+def get_pool_stats():
+    """
+    Return counters for every pool in this process, keyed by user@host/db
+    """
+    with _POOLS_LOCK:
+        pools = _POOLS.items()
+    return dict(("%s@%s/%s" % (key[1], key[0], key[2]), pool.get_stats())
+                for key, pool in pools)
+
+
 def open_monitoring_db(db_host, db_user, db_pass, db_database):
     """
-    Open MySQL monitoring DB
+    Check out a MySQL monitoring DB connection from the pool.
+    Calling close() on it returns it to the pool.
     """
     returnval = 1
     conn = None
 
     try:
-        conn = MySQLdb.connect(host=db_host,
-                               user=db_user,
-                               passwd=db_pass,
-                               db=db_database)
+        conn = get_pool(db_host, db_user, db_pass, db_database).checkout()
+
+    except Exception, err:
+        app.logger.error("mysql exception: %s", err)
+        returnval = 0
+
+    return returnval, conn
+
+
+def _settings_pool(settings, prefix):
+    """
+    Point (settings file, prefix) at the pool for its current db params,
+    applying the password and pool_* keys to it.  The pool it replaces,
+    if no other settings use it, is drained.
+    """
+    db_host, db_user, db_pass, db_database = settings.db_params(prefix)
+    size = settings.get_int('pool_size', POOL_SIZE)
+    timeout = settings.get_float('pool_timeout', POOL_TIMEOUT)
+    recycle = settings.get_int('pool_recycle', POOL_RECYCLE)
+    pool = get_pool(db_host, db_user, db_pass, db_database,
+                    size, timeout, recycle)
+    pool.configure(db_pass, size, timeout, recycle)
+    key = (settings.filename, prefix)
+    with _POOLS_LOCK:
+        old = _SETTINGS_POOLS.get(key)
+        _SETTINGS_POOLS[key] = pool
+        shared = old in _SETTINGS_POOLS.values()
+    if old is not None and not shared:
+        old.drain()
+    return pool
+
+
+def _settings_reload_hook(prefix):
+    """
+    Return a SettingsFile reload hook that re-applies db/pool settings
+    """
+    def hook(settings):
+        try:
+            _settings_pool(settings, prefix)
+        except Exception, err:
+            app.logger.error("settings reload failed for %s: %s",
+                             settings.filename, err)
+    return hook
+
+
+def open_settings_db(filename, prefix=""):
+    """
+    Check out a connection to the db described by a settings file.
+    Optional pool_size/pool_timeout/pool_recycle keys size the pool; a
+    changed file re-applies them, and a new dbpass drains the pool, so
+    neither needs a restart.
+    """
+    returnval = 1
+    conn = None
+
+    try:
+        settings = get_settings(filename)
+        # reading the settings re-parses a changed file, whose reload
+        # hook repoints this (filename, prefix) at the right pool
+        settings.db_params(prefix)
+        with _POOLS_LOCK:
+            pool = _SETTINGS_POOLS.get((filename, prefix))
+        if pool is None:
+            pool = _settings_pool(settings, prefix)
+            settings.add_reload_hook(_settings_reload_hook(prefix))
+        conn = pool.checkout()
 
     except Exception, err:
         app.logger.error("mysql exception: %s", err)
@@ -67,3 +530,142 @@ def get_from_db(query, query_params, dub_conn):
 
     return dblist
 
+
+class ColumnarResult(object):
+    """
+    A result set held as one NumPy array per column.
+    'id' columns are dictionary encoded: codes index into the
+    column's sorted distinct values.
+    """
+    def __init__(self, columns, dictionaries, length):
+        self._columns = columns
+        self._dictionaries = dictionaries
+        self.length = length
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, name):
+        """ Return the column array (codes, for an id column) """
+        return self._columns[name]
+
+    def values(self, name):
+        """ Return the sorted distinct values of an id column """
+        return self._dictionaries[name]
+
+    def decoded(self, name):
+        """ Return an id column's values, one per row """
+        return self._dictionaries[name][self._columns[name]]
+
+    def take(self, mask):
+        """
+        Return the rows selected by a boolean mask (or index array),
+        sharing this result's dictionaries.
+        """
+        columns = dict((name, col[mask])
+                       for name, col in self._columns.iteritems())
+        length = len(columns.itervalues().next()) if columns else 0
+        return ColumnarResult(columns, self._dictionaries, length)
+
+
+# numpy dtype per column kind, 'id' columns are encoded separately
+COLUMN_KINDS = {'float': np.float64, 'int': np.int64, 'str': object}
+
+def get_columns_from_db(query, query_params, dub_conn, columns):
+    """
+    Given a query, optional parameters, and (name, kind) for each
+    selected column, kind one of 'id', 'float', 'int' or 'str',
+    Return the results as a ColumnarResult.  NULL floats become nan.
+    """
+    rows = get_from_db(query, query_params, dub_conn)
+    if rows:
+        raw = zip(*rows)
+    else:
+        raw = [()] * len(columns)
+
+    arrays = {}
+    dictionaries = {}
+    for (name, kind), col in zip(columns, raw):
+        if kind == 'id':
+            dictionaries[name], arrays[name] = np.unique(np.array(col),
+                                                         return_inverse=True)
+        elif kind == 'float':
+            arrays[name] = np.array([np.nan if val is None else val
+                                     for val in col], dtype=np.float64)
+        else:
+            arrays[name] = np.array(col, dtype=COLUMN_KINDS[kind])
+    return ColumnarResult(arrays, dictionaries, len(rows))
+
+
+def group_sum(codes, sizes, weights):
+    """
+    Given parallel code arrays, each < its size, and values,
+    Return (sums, counts) arrays shaped sizes, summing the values of
+    every code combination (a vectorized GROUP BY/pivot).
+    """
+    shape = tuple(sizes)
+    if not shape or min(shape) == 0:
+        return np.zeros(shape), np.zeros(shape, dtype=np.int64)
+    flat = np.ravel_multi_index(tuple(codes), shape)
+    size = int(np.prod(shape))
+    sums = np.bincount(flat, weights=weights, minlength=size)
+    counts = np.bincount(flat, minlength=size)
+    return sums.reshape(shape), counts.reshape(shape)
+
+
+def round_half_away(values):
+    """
+    Round cost sums to whole units the way MySQL's CAST(... AS SIGNED)
+    rounds decimals, first snapping float noise back to cents.
+    """
+    cents = np.round(values, 2)
+    return (np.sign(cents) * np.floor(np.abs(cents) + 0.5)).astype(np.int64)
+
+
+def stream_from_db(query, query_params, dub_conn,
+                   batch_rows=STREAM_BATCH_ROWS):
+    """
+    Given a query and optional parameters...
+    Yield the result rows from an unbuffered server-side cursor,
+    batch_rows at a time, so the full result never sits in memory.
+    The connection is busy until the generator is exhausted or closed.
+    Errors are logged and re-raised: rows may already have been sent,
+    so ending quietly would pass a cut-off result off as complete.
+    """
+    cursor = dub_conn.cursor(MySQLdb.cursors.SSCursor)
+    try:
+        if query_params:
+            cursor.execute(query, query_params)
+        else:
+            cursor.execute(query)
+        while True:
+            rows = cursor.fetchmany(batch_rows)
+            if not rows:
+                break
+            for row in rows:
+                yield row
+    except Exception, err:
+        app.logger.error("mysql exception: %s", err)
+        app.logger.error("generated by: %s", query)
+        raise
+    finally:
+        cursor.close()
+
+
+def bump_data_version(name, dub_conn):
+    """
+    Increment the dataversions counter for name; the caller commits.
+    Caches keyed on dataversions notice the change on their next check.
+    """
+    query = """
+            INSERT INTO dataversions (name, version) VALUES (%s, 1)
+            ON DUPLICATE KEY UPDATE version = version + 1
+            """
+    cursor = dub_conn.cursor()
+    try:
+        cursor.execute(query, (name,))
+    except Exception, err:
+        app.logger.error("mysql exception: %s", err)
+        app.logger.error("generated by: %s", query)
+    finally:
+        cursor.close()
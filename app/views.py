@@ -3,8 +3,8 @@
 """
 from flask import render_template
 from app import app
+import app.dimcache as dimcache
 import app.dubwebdb as dubwebdb
-import app.utils as utils
 
 @app.route('/')
 @app.route('/index.html')
@@ -67,26 +67,15 @@ def workload_daily():
 def load_dropdown_lists():
     """  Load the data structures needed for layout.html pages"""
     settings = dict()
-    metadata = utils.load_json_definition_file(dubwebdb.SETTINGS_FILE)
-    success, db_conn = utils.open_monitoring_db(metadata['dbhost'],
-                                                metadata['dbuser'],
-                                                metadata['dbpass'],
-                                                metadata['db_db'])
-    if success:
-        providers = dubwebdb.get_providers(provider_id=None,
-                                           dub_conn=db_conn)
-        settings['providers'] = [item[0] for item in providers.values()]
-        settings['prvarray'] = providers
-        divisions = dubwebdb.get_divisions(div_ids=None, dub_conn=db_conn)
-        settings['divisions'] = [item for item in divisions.values()]
-        settings['divhash'] = divisions
-        teams = dubwebdb.get_teams(team_ids=None, dub_conn=db_conn)
-        settings['teams'] = [item for item in teams.values()]
-        settings['teamhash'] = teams
-        projects = dubwebdb.get_projects(provider_id=None, team_ids=None,
-                                         project_id=None, dub_conn=db_conn)
-        settings['projects'] = [item[0] for item in projects.values()]
-        settings['prjdict'] = projects
-        db_conn.close()
+    dims = dimcache.get_dimensions(dubwebdb.SETTINGS_FILE)
+    settings['providers'] = [item[0] for item in dims.providers.values()]
+    settings['prvarray'] = dims.providers
+    settings['divisions'] = [item for item in dims.divisions.values()]
+    settings['divhash'] = dims.divisions
+    settings['teams'] = [item for item in dims.teams.values()]
+    settings['teamhash'] = dims.teams
+    projects = dict((prj, vals[:3]) for prj, vals in dims.projects.items())
+    settings['projects'] = [item[0] for item in projects.values()]
+    settings['prjdict'] = projects
 
     return dict(settings=settings)
@@ -0,0 +1,4 @@
+"""
+    dubforecast: spend forecasting shared by the dubweb app and its ETL.
+    Only needs numpy; install it (pip install .) where the ETL runs.
+"""
@@ -0,0 +1,553 @@
+#!/usr/bin/env python
+"""
+forecast library
+   Called by dubwebdb and the ETL (cub_extract, cub_backtest)
+   to project monthly spend for many ids at once, from their
+   daily spend held as one id x day array.
+   Only needs numpy, so it can be imported outside the flask app.
+
+   Copyright 2015 zulily, Inc.
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+     http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+
+import calendar
+import datetime as dt
+import math
+import time
+import numpy as np
+
+#globals
+DEFAULT_FORECAST_PERIOD = 3 * 29 * 86400
+# standard normal quantile of the p90 (and, negated, p10) band
+BAND_Z = 1.2815515655446004
+
+class SeriesBatch(object):
+    """
+    Daily series of many ids as one 2-D array, id x day,
+    NaN where an id has no row for a day.
+    """
+    def __init__(self, ids, day_keys, values):
+        """
+        ids: the id of each row
+        day_keys: YYYYMMDD int of each column, ascending
+        values: float array, len(ids) x len(day_keys)
+        """
+        # plain python ids, so results serialize like the query's
+        self.ids = np.asarray(ids).tolist()
+        self.day_keys = np.asarray(day_keys, dtype=np.int64)
+        self.values = values
+
+    @classmethod
+    def from_codes(cls, ids, day_keys, id_codes, day_codes, values):
+        """
+        Build from parallel per-row codes (indexes into ids and
+        day_keys) and values, e.g. dictionary encoded query columns.
+        """
+        matrix = np.empty((len(ids), len(day_keys)))
+        matrix.fill(np.nan)
+        matrix[np.asarray(id_codes, dtype=np.intp),
+               np.asarray(day_codes, dtype=np.intp)] = values
+        return cls(ids, day_keys, matrix)
+
+    @classmethod
+    def from_rows(cls, rows):
+        """
+        Build from (day key, id, value) rows, one per id and day,
+        as the estimate queries return them.
+        """
+        if not rows:
+            return cls([], [], np.empty((0, 0)))
+        days, ids, values = zip(*rows)
+        day_keys, day_codes = np.unique(np.asarray(days, dtype=np.int64),
+                                        return_inverse=True)
+        id_list, id_codes = np.unique(ids, return_inverse=True)
+        return cls.from_codes(id_list, day_keys, id_codes, day_codes,
+                              np.asarray(values, dtype=float))
+
+    def month_index(self):
+        """
+        Return (month keys YYYYMM ascending, month index of each column)
+        """
+        return np.unique(self.day_keys // 100, return_inverse=True)
+
+
+class MonthStats(object):
+    """
+    Per id statistics of one month's daily values,
+    as compute_month_stats used to give for a single id
+    """
+    def __init__(self, avg, length, std, slice_avg, slice_len):
+        self.avg = avg
+        self.len = length
+        self.std = std
+        self.slice_avg = slice_avg
+        self.slice_len = slice_len
+
+
+def month_stats(batch, month_col, month_sel, slice_len=None):
+    """
+    Return MonthStats for each id over the columns of month
+    month_sel[id] (an index into batch.month_index(), -1 for none),
+    averaging only its first slice_len[id] values for slice_avg.
+    """
+    present = ~np.isnan(batch.values)
+    in_month = present & (month_col[np.newaxis, :] == month_sel[:, np.newaxis])
+    values = np.where(in_month, batch.values, 0.0)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        length = in_month.sum(axis=1)
+        avg = values.sum(axis=1) / length
+        dev = np.where(in_month, values - avg[:, np.newaxis], 0.0)
+        std = np.sqrt((dev * dev).sum(axis=1) / length)
+        if slice_len is None:
+            slice_len = length
+        rank = np.cumsum(in_month, axis=1)
+        in_slice = in_month & (rank <= slice_len[:, np.newaxis])
+        s_len = in_slice.sum(axis=1)
+        slice_avg = np.where(in_slice, values, 0.0).sum(axis=1) / s_len
+
+    return MonthStats(avg, length, std, slice_avg, s_len)
+
+
+def _month_number(month_key):
+    """ Return a count of months for YYYYMM keys, so months can be added """
+    return (month_key // 100) * 12 + (month_key % 100) - 1
+
+
+def _month_info(month_num, firstofmonth):
+    """
+    Return (label, days in month, shown) for a month count: its
+    'YYYY-MM' label, its length, and whether its last day is after
+    firstofmonth (estimates are not shown for the past).
+    """
+    year, month = divmod(int(month_num), 12)
+    month += 1
+    daycount = calendar.monthrange(year, month)[1]
+    lastday = dt.datetime(year, month, daycount)
+    return "%04d-%02d" % (year, month), daycount, lastday > firstofmonth
+
+
+def _day_ordinals(day_keys):
+    """ Return the proleptic ordinal of YYYYMMDD keys """
+    return np.array([dt.date(key // 10000, key // 100 % 100,
+                             key % 100).toordinal()
+                     for key in np.asarray(day_keys, dtype=np.int64)],
+                    dtype=np.int64)
+
+
+def _latest_months(batch):
+    """
+    Return (months, month_col, last, prev): the batch's month keys and
+    each column's month index, then for each id the index of its latest
+    month with data and of the one before that (-1 if none).
+    """
+    months, month_col = batch.month_index()
+    present = ~np.isnan(batch.values)
+    month_cols = (month_col[np.newaxis, :] ==
+                  np.arange(len(months))[:, np.newaxis])
+    has_month = np.dot(present.astype(np.int64),
+                       month_cols.T.astype(np.int64)) > 0
+
+    n_months = len(months)
+    last = n_months - 1 - np.argmax(has_month[:, ::-1], axis=1)
+    earlier = has_month & (np.arange(n_months)[np.newaxis, :] <
+                           last[:, np.newaxis])
+    prev = np.where(earlier.any(axis=1),
+                    n_months - 1 - np.argmax(earlier[:, ::-1], axis=1), -1)
+    return months, month_col, last, prev
+
+
+def _horizon_steps(start_month, end_ts):
+    """
+    Return how many months to project for each id, counting from its
+    latest month (start_month, a month count) through end_ts.  An end
+    sooner than DEFAULT_FORECAST_PERIOD is pushed 3 months past the id's
+    latest month; ids extend it in turn, as one shared window was
+    extended id by id.
+    """
+    steps = np.empty(len(start_month), dtype=np.int64)
+    for idx in range(len(start_month)):
+        year, month = divmod(int(start_month[idx]), 12)
+        curmon_dt = dt.datetime(year, month + 1, 1)
+        start_ts = int(time.mktime(curmon_dt.timetuple()))
+        if end_ts < start_ts + DEFAULT_FORECAST_PERIOD:
+            month += 3
+            end_ts = int(time.mktime(dt.datetime(year + month // 12,
+                                                 month % 12 + 1,
+                                                 1).timetuple()))
+        end_dt = dt.datetime.fromtimestamp(end_ts)
+        # months whose first day is before the end
+        steps[idx] = end_dt.year * 12 + end_dt.month - 1 - start_month[idx]
+        if end_dt > dt.datetime(end_dt.year, end_dt.month, 1):
+            steps[idx] += 1
+    return np.maximum(steps, 0)
+
+
+class ForecastModel(object):
+    """
+    Interface of the forecast models.  fit() takes a whole SeriesBatch
+    and fits every id at once; predict() then gives daily spend for any
+    days after the batch.
+    """
+    name = None
+
+    def fit(self, batch):
+        """ Fit every series of batch, return self """
+        raise NotImplementedError
+
+    def predict(self, day_keys):
+        """
+        Return predicted daily spend, ids x day_keys (YYYYMMDD,
+        ascending, after the fitted batch's last day)
+        """
+        raise NotImplementedError
+
+
+class DecayModel(ForecastModel):
+    """
+    The trend/decay model: the daily average of an id's latest month
+    (or the month before, if the latest varies) is carried forward,
+    scaled each month by the latest/previous month trend, which decays
+    toward 1 (or -1).
+    """
+    name = "decay"
+
+    def __init__(self):
+        self.start_month = None
+        self.dailyspend = None
+        self.trend = None
+        self.decay = None
+        self.std = None
+
+    def fit(self, batch):
+        months, month_col, last, prev = _latest_months(batch)
+        has_prev = prev >= 0
+        cur = month_stats(batch, month_col, last)
+        prv = month_stats(batch, month_col, prev, slice_len=cur.len)
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            self.trend = np.where(has_prev, cur.slice_avg / prv.slice_avg,
+                                  1.0)
+            self.decay = np.where(has_prev & (self.trend < 0), -1.0, 1.0)
+        self.dailyspend = np.where(~has_prev | (cur.std == 0.0), cur.avg,
+                                   prv.avg)
+        self.std = cur.std
+        self.start_month = _month_number(months[last])
+        return self
+
+    def monthly_rates(self, n_months):
+        """
+        Return the daily spend projected for each id, ids x n_months,
+        from its latest month onward
+        """
+        rates = np.empty((len(self.dailyspend), n_months))
+        dailyspend = self.dailyspend
+        trend = self.trend
+        for step in range(n_months):
+            rates[:, step] = dailyspend
+            with np.errstate(invalid='ignore', over='ignore'):
+                dailyspend = dailyspend * trend
+            # Allow trend to decay over time
+            trend = (trend + self.decay + self.decay) / 3.0
+        return rates
+
+    def predict(self, day_keys):
+        offset = _month_number(np.asarray(day_keys, dtype=np.int64) // 100)
+        offset = offset[np.newaxis, :] - self.start_month[:, np.newaxis]
+        rates = self.monthly_rates(int(offset.max()) + 1)
+        return rates[np.arange(len(rates))[:, np.newaxis],
+                     np.maximum(offset, 0)]
+
+
+class _DailyModel(ForecastModel):
+    """
+    Base of the models fit on each id's contiguous daily series: days
+    without a row count as zero spend once the id has started.
+    """
+    def __init__(self):
+        self.last_ordinal = None
+
+    def _daily(self, batch):
+        """
+        Return (ordinals, values, started) over every calendar day of
+        the batch, values 0 where an id has no row, started False
+        before an id's first row.
+        """
+        ordinals = _day_ordinals(batch.day_keys)
+        days = np.arange(ordinals[0], ordinals[-1] + 1)
+        values = np.zeros((len(batch.ids), len(days)))
+        present = np.zeros(values.shape, dtype=bool)
+        cols = ordinals - ordinals[0]
+        values[:, cols] = np.nan_to_num(batch.values)
+        present[:, cols] = ~np.isnan(batch.values)
+        started = np.cumsum(present, axis=1) > 0
+        self.last_ordinal = days[-1]
+        return days, values, started
+
+    def _ahead(self, day_keys):
+        """ Return how many days past the fitted batch each key is """
+        return _day_ordinals(day_keys) - self.last_ordinal
+
+
+class LinearModel(_DailyModel):
+    """
+    Least squares line through each id's daily spend since it started
+    """
+    name = "linear"
+
+    def __init__(self):
+        _DailyModel.__init__(self)
+        self.intercept = None
+        self.slope = None
+
+    def fit(self, batch):
+        days, values, started = self._daily(batch)
+        # time relative to the last day, so predict() is intercept + slope*h
+        tval = np.where(started, (days - days[-1])[np.newaxis, :], 0.0)
+        yval = np.where(started, values, 0.0)
+        count = started.sum(axis=1).astype(float)
+        sum_t = tval.sum(axis=1)
+        sum_y = yval.sum(axis=1)
+        denom = count * (tval * tval).sum(axis=1) - sum_t * sum_t
+        with np.errstate(divide='ignore', invalid='ignore'):
+            slope = (count * (tval * yval).sum(axis=1) - sum_t * sum_y) / denom
+            self.slope = np.where(denom > 0, slope, 0.0)
+            self.intercept = (sum_y - self.slope * sum_t) / count
+        return self
+
+    def predict(self, day_keys):
+        ahead = self._ahead(day_keys)
+        return self.intercept[:, np.newaxis] + \
+            self.slope[:, np.newaxis] * ahead[np.newaxis, :]
+
+
+class HoltWintersModel(_DailyModel):
+    """
+    Additive Holt-Winters with weekly seasonality: level, trend and
+    day-of-week terms updated a day at a time, for all ids together.
+    """
+    name = "holtwinters"
+    PERIOD = 7
+
+    def __init__(self, alpha=0.3, beta=0.05, gamma=0.2):
+        _DailyModel.__init__(self)
+        self.alpha = alpha
+        self.beta = beta
+        self.gamma = gamma
+        self.level = None
+        self.trend = None
+        self.season = None
+
+    def fit(self, batch):
+        days, values, started = self._daily(batch)
+        n_ids = len(values)
+        level = np.zeros(n_ids)
+        trend = np.zeros(n_ids)
+        season = np.zeros((n_ids, self.PERIOD))
+        rows = np.arange(n_ids)
+        for col in range(len(days)):
+            yval = values[:, col]
+            slot = days[col] % self.PERIOD
+            first = started[:, col] & ((col == 0) | ~started[:, col - 1])
+            new_level = self.alpha * (yval - season[:, slot]) + \
+                (1 - self.alpha) * (level + trend)
+            new_trend = self.beta * (new_level - level) + \
+                (1 - self.beta) * trend
+            new_season = self.gamma * (yval - new_level) + \
+                (1 - self.gamma) * season[:, slot]
+            # an id's first day only sets its level
+            update = started[:, col] & ~first
+            level = np.where(first, yval, np.where(update, new_level, level))
+            trend = np.where(update, new_trend, trend)
+            season[rows, slot] = np.where(update, new_season,
+                                          season[:, slot])
+        self.level = level
+        self.trend = trend
+        self.season = season
+        return self
+
+    def predict(self, day_keys):
+        ahead = self._ahead(day_keys)
+        slots = (self.last_ordinal + ahead) % self.PERIOD
+        return self.level[:, np.newaxis] + \
+            self.trend[:, np.newaxis] * ahead[np.newaxis, :] + \
+            self.season[:, slots]
+
+
+class RunRateModel(_DailyModel):
+    """
+    Average daily spend of each id's last n days, carried forward
+    """
+    name = "runrate"
+
+    def __init__(self, days=14):
+        _DailyModel.__init__(self)
+        self.days = days
+        self.rate = None
+
+    def fit(self, batch):
+        _, values, started = self._daily(batch)
+        window = started[:, -self.days:]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            self.rate = np.where(window, values[:, -self.days:],
+                                 0.0).sum(axis=1) / window.sum(axis=1)
+        return self
+
+    def predict(self, day_keys):
+        ahead = self._ahead(day_keys)
+        return np.repeat(self.rate[:, np.newaxis], len(ahead), axis=1)
+
+
+MODELS = dict((model.name, model) for model in
+              (DecayModel, LinearModel, HoltWintersModel, RunRateModel))
+
+def get_model(name):
+    """
+    Return a new model of the given name (see MODELS)
+    """
+    if name not in MODELS:
+        raise ValueError("unknown forecast model: %s" % name)
+    return MODELS[name]()
+
+
+def days_between(first_key, last_key):
+    """ Return the YYYYMMDD keys of every day in [first_key, last_key] """
+    first, last = _day_ordinals([first_key, last_key])
+    return [int(dt.date.fromordinal(day).strftime('%Y%m%d'))
+            for day in range(first, last + 1)]
+
+
+def _forecast_rows(batch, start_month, steps, monthly, daily_std,
+                   firstofmonth):
+    """
+    Return [month label, id, estimate, sigma] rows, ordered by id then
+    month, for each id's steps months from start_month, where
+    monthly(step, daycount) gives every id's estimate of that month.
+    sigma, the estimate's standard deviation, treats days as
+    independent with each id's daily_std, and grows with the square
+    root of the months ahead.
+    """
+    info = {}
+    rows = []
+    for step in range(int(steps.max())):
+        active = step < steps
+        month_num = start_month + step
+        for num in np.unique(month_num[active]):
+            if num not in info:
+                info[num] = _month_info(num, firstofmonth)
+        daycount = np.array([info[num][1] if act else 0
+                             for num, act in zip(month_num, active)])
+        with np.errstate(invalid='ignore', over='ignore'):
+            estimate = np.trunc(monthly(step, daycount))
+        sigma = np.round(daily_std * np.sqrt(daycount * (step + 1.0)))
+        for idx in np.flatnonzero(active):
+            label, _, shown = info[month_num[idx]]
+            # a zero previous month gives no finite trend to project
+            if shown and np.isfinite(estimate[idx]):
+                rows.append((idx, step, label, int(estimate[idx]),
+                             int(sigma[idx])))
+
+    return [[label, batch.ids[idx], estimate, sigma]
+            for idx, _, label, estimate, sigma in sorted(rows)]
+
+
+def decay_forecast(batch, end_ts, now=None):
+    """
+    Project monthly spend for every id of batch with the DecayModel.
+    Months run from each id's latest month up to end_ts, or 3 months
+    past it if end_ts is sooner than DEFAULT_FORECAST_PERIOD.
+    Return [month label, id, estimate, sigma] rows for months not in
+    the past, ordered by id (as given) then month (see _forecast_rows).
+    """
+    if now is None:
+        now = dt.datetime.now()
+    if len(batch.ids) == 0:
+        return []
+
+    model = DecayModel().fit(batch)
+    steps = _horizon_steps(model.start_month, end_ts)
+    rates = model.monthly_rates(int(steps.max()))
+    return _forecast_rows(batch, model.start_month, steps,
+                          lambda step, daycount: rates[:, step] * daycount,
+                          model.std, now.replace(day=1))
+
+
+def model_forecast(model, batch, end_ts, now=None):
+    """
+    Project monthly spend for every id of batch with any ForecastModel,
+    over the same months as decay_forecast: spend already in the batch
+    plus the model's daily predictions for the rest of each month.
+    """
+    if now is None:
+        now = dt.datetime.now()
+    if len(batch.ids) == 0:
+        return []
+
+    months, month_col, last, _ = _latest_months(batch)
+    daily_std = month_stats(batch, month_col, last).std
+    start_month = _month_number(months[last])
+    steps = _horizon_steps(start_month, end_ts)
+    first_num = int(start_month.min())
+    n_nums = int((start_month + steps).max()) - first_num
+    totals = np.zeros((len(batch.ids), max(n_nums, 1)))
+
+    known = _month_number(batch.day_keys // 100) - first_num
+    keep = (known >= 0) & (known < totals.shape[1])
+    np.add.at(totals.T, known[keep], np.nan_to_num(batch.values[:, keep]).T)
+    year, month = divmod(first_num + n_nums - 1, 12)
+    last_key = (year * 100 + month + 1) * 100 + \
+        calendar.monthrange(year, month + 1)[1]
+    future = days_between(int(batch.day_keys[-1]), last_key)[1:]
+    if future:
+        future_nums = _month_number(np.array(future) // 100) - first_num
+        predicted = model.fit(batch).predict(future)
+        np.add.at(totals.T, future_nums, predicted.T)
+
+    offset = start_month - first_num
+    rows = np.arange(len(batch.ids))
+    last_col = totals.shape[1] - 1
+    return _forecast_rows(batch, start_month, steps,
+                          lambda step, daycount: totals[
+                              rows, np.minimum(offset + step, last_col)],
+                          daily_std, now.replace(day=1))
+
+
+def rollup_forecast(stats_list, parents):
+    """
+    Sum [month label, id, estimate, sigma] rows into each id's parent
+    (parents: id : parent id, ids without one are left out), so every
+    level of a hierarchy adds up to the level below it.  Children are
+    taken as independent: their variances add.
+    Return [month label, parent, estimate, sigma] rows ordered by parent
+    then month.
+    """
+    totals = {}
+    for month, my_id, estimate, sigma in stats_list:
+        parent = parents.get(my_id)
+        if parent is not None:
+            total = totals.setdefault((parent, month), [0, 0])
+            total[0] += estimate
+            total[1] += sigma * sigma
+    return [[month, parent, totals[(parent, month)][0],
+             int(round(math.sqrt(totals[(parent, month)][1])))]
+            for parent, month in sorted(totals)]
+
+
+def bands(estimate, sigma):
+    """
+    Return the (p10, p50, p90) band of an estimate, taking it as
+    normally distributed with standard deviation sigma
+    """
+    spread = int(round(BAND_Z * sigma))
+    return estimate - spread, estimate, estimate + spread
@@ -0,0 +1,194 @@
+#!/usr/bin/python
+"""
+    This script replays dubweb's spend history to compare forecast
+    models: for each of the last few months, every model is fit on the
+    days before it (all series of a grouping at once) and scored on the
+    month's actual spend.  Uses the DB settings of the ETL driver file.
+
+    python cub_backtest.py -f ./zu/zu_advanced_meta.json --months 6
+
+   Copyright 2015 zulily, Inc.
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+     http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+
+import sys
+import argparse
+import datetime as dt
+import time
+import MySQLdb
+import numpy as np
+from dateutil.relativedelta import relativedelta
+
+import cub_extract
+from cub_extract import forecast
+
+class ModelScore(object):
+    """
+        Accumulated backtest results of one model on one grouping
+    """
+
+    def __init__(self):
+        self.errors = []
+        self.failed = 0
+        self.series = 0
+        self.seconds = 0.0
+
+    def mape(self):
+        """
+        Return the mean absolute percentage error, in percent
+        """
+        if not self.errors:
+            return float('nan')
+        return 100.0 * sum(self.errors) / len(self.errors)
+
+    def seconds_per_thousand(self):
+        """
+        Return the fit (and predict) time per 1,000 series
+        """
+        if not self.series:
+            return float('nan')
+        return 1000.0 * self.seconds / self.series
+
+
+def read_series(conn, group_by, rollups, first_day, last_day):
+    """
+    Return the SeriesBatch of group_by's daily spend over
+    [first_day, last_day]
+    """
+    cursor = conn.cursor()
+    try:
+        cursor.execute(cub_extract.build_forecast_input_query(group_by,
+                                                              rollups),
+                       cub_extract.forecast_input_days(first_day, last_day,
+                                                       rollups))
+    except MySQLdb.Error, err:
+        print "Error %d: %s" % (err.args[0], err.args[1])
+        sys.exit(1)
+    output = cursor.fetchall()
+    cursor.close()
+    return forecast.SeriesBatch.from_rows(output)
+
+def month_totals(batch, day_keys):
+    """
+    Return id : {YYYYMM : spend} of batch, over the given days
+    """
+    months = np.asarray(day_keys, dtype=np.int64) // 100
+    batch_months = batch.day_keys // 100
+    totals = {}
+    values = np.nan_to_num(batch.values)
+    for month in np.unique(months):
+        sums = values[:, batch_months == month].sum(axis=1)
+        for idx, my_id in enumerate(batch.ids):
+            totals.setdefault(my_id, {})[month] = sums[idx]
+    return totals
+
+def score_cutoff(conn, group_by, rollups, cutoff, args, scores):
+    """
+    Fit every model on the history before cutoff (a first of month) and
+    score its predictions for the following args.horizon months
+    """
+    train = read_series(conn, group_by, rollups,
+                        cutoff - dt.timedelta(days=args.history),
+                        cutoff - dt.timedelta(days=1))
+    if len(train.ids) == 0:
+        return
+    last_day = cutoff + relativedelta(months=args.horizon, days=-1)
+    eval_keys = forecast.days_between(int(cutoff.strftime('%Y%m%d')),
+                                      int(last_day.strftime('%Y%m%d')))
+    eval_months = np.array(eval_keys, dtype=np.int64) // 100
+    actual = month_totals(read_series(conn, group_by, rollups, cutoff,
+                                      last_day), eval_keys)
+
+    for name in args.models:
+        model = forecast.get_model(name)
+        start = time.time()
+        predicted = model.fit(train).predict(eval_keys)
+        score = scores[name]
+        score.seconds += time.time() - start
+        score.series += len(train.ids)
+        for month in np.unique(eval_months):
+            month_pred = predicted[:, eval_months == month].sum(axis=1)
+            for idx, my_id in enumerate(train.ids):
+                spend = actual.get(my_id, {}).get(month, 0.0)
+                if not np.isfinite(month_pred[idx]):
+                    score.failed += 1
+                elif spend != 0:
+                    score.errors.append(abs(month_pred[idx] - spend) /
+                                        abs(spend))
+
+def parse_arguments():
+    """
+    Collect command-line arguments
+    """
+    my_parser = argparse.ArgumentParser(description='Backtest dubweb forecast models against loaded spend.')
+    my_parser.add_argument('-f', dest='filename',
+                           help='path to json file with DB parameters',
+                           required=True)
+    my_parser.add_argument('--models', dest='models',
+                           default=','.join(sorted(forecast.MODELS)),
+                           help='comma separated models to compare')
+    my_parser.add_argument('--group', dest='groups', action='append',
+                           choices=cub_extract.FORECAST_GROUPS,
+                           help='grouping to backtest (default all)')
+    my_parser.add_argument('--months', dest='months', type=int, default=6,
+                           help='number of past months to replay')
+    my_parser.add_argument('--history', dest='history', type=int, default=92,
+                           help='days of history each fit sees')
+    my_parser.add_argument('--horizon', dest='horizon', type=int, default=1,
+                           help='months predicted after each cutoff')
+    return my_parser
+
+
+# Main functionality
+
+def main():
+    """
+    Main function for backtesting, printing one line per
+    grouping and model
+    """
+    args = parse_arguments().parse_args()
+    args.models = args.models.split(',')
+    for name in args.models:
+        forecast.get_model(name)
+    groups = args.groups or cub_extract.FORECAST_GROUPS
+
+    defs = cub_extract.load_json_file(args.filename)
+    conn = cub_extract.open_monitoring_db(defs["dbhost"], defs["dbuser"],
+                                          defs["dbpass"], defs["database"])
+    rollups = cub_extract.has_table(conn, "metricdata_daily") and \
+        cub_extract.get_data_version(conn, 'rollups') > 0
+
+    this_month = dt.date.today().replace(day=1)
+    cutoffs = [this_month - relativedelta(months=args.horizon + back)
+               for back in range(args.months)]
+
+    print "%-8s %-12s %8s %8s %8s %8s %12s" % ("group", "model", "series",
+                                               "scored", "failed", "MAPE %",
+                                               "s/1k series")
+    for group_by in groups:
+        scores = dict((name, ModelScore()) for name in args.models)
+        for cutoff in cutoffs:
+            score_cutoff(conn, group_by, rollups, cutoff, args, scores)
+        for name in args.models:
+            score = scores[name]
+            print "%-8s %-12s %8d %8d %8d %8.1f %12.4f" % (
+                group_by, name, score.series, len(score.errors),
+                score.failed, score.mape(), score.seconds_per_thousand())
+
+    conn.close()
+
+
+
+if __name__ == '__main__':
+    sys.exit(main())
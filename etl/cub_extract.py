@@ -22,62 +22,228 @@
    limitations under the License.
 """
 
+import ast
 import calendar
 import MySQLdb
 import os
 import sys
 import json
+import tempfile
+import time
 import argparse
 import glob
+import hashlib
+import itertools
+import gzip
 import re
 import csv
+import zipfile
 import logging
+import multiprocessing
+import traceback
 import pprint
 from dateutil import parser
-from collections import defaultdict
+from dateutil.relativedelta import relativedelta
+from collections import defaultdict, deque, OrderedDict
+import datetime as dt
+
+# shared with the web app; pip install . from the top of the repo
+from dubforecast import forecast
+
+#globals
+# chart groupings forecasts can be built for
+FORECAST_GROUPS = ['prvid', 'teamid', 'prjid', 'divid']
+# the grain materialized into the forecasts table; dubweb sums it up
+# to teams, divisions and providers
+FORECAST_GRAIN = 'prjid'
+# bytes of a json billing file decoded at a time
+JSON_CHUNK_BYTES = 65536
+# bytes of a billing file hashed at a time
+FILE_HASH_BYTES = 1048576
+JSON_SEPARATORS = re.compile(r'[\s,]*')
+JSON_SPACE = re.compile(r'\s*')
+# files parsed ahead of the DB writes, per --workers process
+PARSE_AHEAD = 2
+# metricdata rows per multi-row INSERT in write_stats
+WRITE_BATCH_ROWS = 1000
+METRICDATA_INSERT = """\
+        INSERT INTO metricdata
+        (datetime, metric, data, prjid, cost, prvid, teamid)
+        VALUES (%s,%s,%s,%s,%s,%s,%s)
+        """
+METRICDATA_LOAD = """\
+        LOAD DATA LOCAL INFILE %s INTO TABLE metricdata
+        FIELDS TERMINATED BY '\\t'
+        (datetime, metric, data, prjid, cost, prvid, teamid)
+        """
+METRICDATA_DELETE = """\
+        DELETE FROM metricdata WHERE prvid = %s AND datetime >= %s
+        AND datetime < DATE_ADD(%s, INTERVAL 1 DAY)
+        """
+METRICDATA_VERSION_BUMP = """\
+        INSERT INTO dataversions (name, version) VALUES ('metricdata', 1)
+        ON DUPLICATE KEY UPDATE version = version + 1
+        """
+MANIFEST_UPSERT = """\
+        INSERT INTO etl_manifest
+        (prvid, path, metricdate, size, sha1, filerows, datarows, loadtime)
+        VALUES (%s,%s,%s,%s,%s,%s,%s,%s)
+        ON DUPLICATE KEY UPDATE metricdate = VALUES(metricdate),
+        size = VALUES(size), sha1 = VALUES(sha1),
+        filerows = VALUES(filerows), datarows = VALUES(datarows),
+        loadtime = VALUES(loadtime)
+        """
+PROJECTS_SELECT = "SELECT extid, prjid, teamid FROM projects WHERE prvid = %s"
+PROJECTS_INSERT = """\
+        INSERT INTO projects (extname, extid, prvid, teamid)
+        VALUES (%s,%s,%s,%s)
+        """
+METRICTYPES_SELECT = """\
+        SELECT metricname, metricid, unit FROM metrictypes WHERE prvid = %s
+        """
+METRICTYPES_INSERT = """\
+        INSERT INTO metrictypes (metricname, unit, prvid) VALUES (%s,%s,%s)
+        """
 
-class DUBLoad(object):
+class MetricDefs(object):
     """
-        Class for each metric set (e.g., a day of datacenter foo's metrics,
-        or a month of datacenter bar's metrics).  Includes separate instance
-        of projects teams, as each set can add projects.
+        A provider's metric definitions (zu_*_metrics.json), with each
+        expression turned into an accessor once per run instead of
+        being eval()'d for every input row.
     """
 
-    def __init__(self, prv_def, prv_id, metric_date, metrics,
-                 metric_defs, conn):
+    def __init__(self, defs, compiled=True):
         """
-        Initialize the object, processing the data for the file
+        defs: the loaded definition file; compiled=False keeps the old
+        per-row eval() of each permetric expression, for comparison.
         """
+        make = compile_metric_expr if compiled else interpret_metric_expr
+        self.permetric = [[make(expr) for expr in metric_evals]
+                          for metric_evals in defs["permetric"]]
+        # summary rows are evaluated once per load, with taxrate in scope
+        self.various = None
+        if 'various' in defs:
+            self.various = [[metric[0]] +
+                            [compile(expr, '<various>', 'eval')
+                             for expr in metric[1:]]
+                            for metric in defs['various']]
+
+
+def interpret_metric_expr(expr):
+    """
+    Return an accessor(metric, load) that eval()s expr on every call
+    """
+    def accessor(metric, load):
+        """ Evaluate the expression string """
+        return eval(expr, globals(), {'metric': metric, 'self': load})
+    return accessor
 
-        self.current_stats = []
-        self._prvid = prv_id
-        self._conn = conn
+
+def compile_metric_expr(expr):
+    """
+    Return an accessor(metric, load) for a permetric expression:
+    a plain function for the declarative forms (metric[...] lookups,
+    literals, self attributes, and + of those), else the expression
+    compiled once and evaluated with metric and self (the DUBLoad).
+    """
+    try:
+        return _build_accessor(ast.parse(expr.strip(), mode='eval').body)
+    except (ValueError, SyntaxError):
+        code = compile(expr, '<permetric>', 'eval')
+
+    def accessor(metric, load):
+        """ Evaluate the compiled expression """
+        return eval(code, globals(), {'metric': metric, 'self': load})
+    return accessor
+
+
+def _build_accessor(node):
+    """
+    Return an accessor(metric, load) for an expression ast node,
+    raising ValueError if it is not one of the declarative forms.
+    """
+    if isinstance(node, (ast.Str, ast.Num)):
+        value = node.s if isinstance(node, ast.Str) else node.n
+        return lambda metric, load: value
+    if isinstance(node, ast.Name) and node.id == 'metric':
+        return lambda metric, load: metric
+    if isinstance(node, ast.Attribute) and \
+       isinstance(node.value, ast.Name) and node.value.id == 'self':
+        attr = node.attr
+        return lambda metric, load: getattr(load, attr)
+    if isinstance(node, ast.Subscript) and isinstance(node.slice, ast.Index) \
+       and isinstance(node.slice.value, (ast.Str, ast.Num)):
+        key = _build_accessor(node.slice.value)(None, None)
+        if isinstance(node.value, ast.Name) and node.value.id == 'metric':
+            return lambda metric, load: metric[key]
+        inner = _build_accessor(node.value)
+        return lambda metric, load: inner(metric, load)[key]
+    if isinstance(node, ast.BinOp) and isinstance(node.op, ast.Add):
+        left = _build_accessor(node.left)
+        right = _build_accessor(node.right)
+        return lambda metric, load: left(metric, load) + right(metric, load)
+    raise ValueError("not a declarative metric expression")
+
+class ParsedMetrics(object):
+    """
+        One provider-day's billing rows, parsed but not yet resolved:
+        rows still name their project by extid and their metric by
+        name, and the projects/metric types they need are listed, so
+        it can be built in a worker process and pickled back.
+    """
+
+    def __init__(self, prv_id, metric_date, path=None):
+        self.prvid = prv_id
+        self.metric_date = metric_date
+        self.path = path
+        # the file as read, and whether it matched its manifest hash
+        self.size = None
+        self.sha1 = None
+        self.unchanged = False
+        self.stats = []
+        # extid : None and metric name : unit, in first-seen order
+        self.projects = OrderedDict()
+        self.metric_types = OrderedDict()
+        self.rows = 0
+        self.seconds = 0.0
+        self.error = None
+
+    def note_dimensions(self, result_array):
+        """
+        Record the project and metric type a parsed row refers to
+        """
+        self.projects.setdefault(result_array[1])
+        self.metric_types.setdefault(result_array[2], result_array[4])
+
+
+class MetricParser(object):
+    """
+        Evaluates a provider's permetric expressions over a billing
+        file without touching the DB.  Its attributes are the self._*
+        values the expressions may use.
+    """
+
+    def __init__(self, prv_def, metric_date):
         self._metric_date = metric_date
         self._metric_format = prv_def[3]
         self._timeunit = prv_def[4]
         self._delimiter = prv_def[5]
-        self._metric_types = self._get_metric_types()
-        self._projects = self._get_projects_for_provider()
-        self._teams = self._get_teams()
-
-        self._parse_billing(metrics, metric_defs["permetric"])
 
-        if 'various' in metric_defs:
-            taxrate = self._get_provider_taxrate()
-            self._post_process_stats(taxrate, metric_defs['various'])
-
-    def _parse_billing(self, my_metrics, metric_list):
+    def parse(self, my_metrics, metric_list, parsed):
         """
-        Given a set of billing metrics, calculate the final (per day)
-        metrics for the given metrics provider.
+        Given a set of billing metrics, calculate the rows of parsed.
+        metric_list holds the accessors of each permetric set.
         """
 
+        start = time.time()
+        daily_stats = {}
         for metric in my_metrics:
+            parsed.rows += 1
             for metric_evals in metric_list:
                 result_array = []
                 for metric_eval in metric_evals:
                     try:
-                        value = eval(metric_eval)
+                        value = metric_eval(metric, self)
                     except KeyError:
                         #support has no projectNumber
                         value = "0"
@@ -86,31 +252,242 @@ class DUBLoad(object):
                    result_array[2] is self._delimiter or \
                    result_array[5] == '0':
                     continue
-                if result_array[1] not in self._projects:
-                    # add a new team/divid (can delete later if necessary)
-                    # add the new project under the new team
-                    self._teams = self._add_team('unk', 1)
-                    last_team_id = sorted(self._teams.keys())[-1]
-                    self._projects = self._add_project('unk',
-                                                       result_array[1],
-                                                       last_team_id)
-                if result_array[2] not in self._metric_types:
-                    self._metric_types = self._add_metric_type(result_array[2],
-                                                               result_array[4])
-                # get team id before remapping prjid
-                result_array.append(self._projects[result_array[1]][1])
-                # clean up prjid, etc.
-                result_array[1] = self._projects[result_array[1]][0]
-                result_array[2] = self._metric_types[result_array[2]][0]
-                #generate daily data if necessary
-                if self._timeunit == "month":
-                    self._add_daily_data(result_array)
+                parsed.note_dimensions(result_array)
+                if self._timeunit == "hour":
+                    # hourly data is aggregated as it is read
+                    self._add_hourly_data(daily_stats, result_array)
                 else:
-                    self.current_stats.append(result_array)
+                    parsed.stats.append(result_array)
 
-        # hourly data needs to be aggregated
         if self._timeunit == "hour":
-            self.current_stats = self._aggregate_hourly_data()
+            parsed.stats = daily_stats.values()
+        parsed.seconds = time.time() - start
+        return parsed
+
+    def _add_hourly_data(self, daily_stats, metric):
+        """
+        Add an hour's metric into the day's totals per metric name
+        (modified cost/hours)
+        """
+        try:
+            daily = daily_stats[metric[2]]
+        except KeyError:
+            daily_stats[metric[2]] = metric
+            metric[0] = self._metric_date + 'T00:00:00'
+            return
+        daily[3] = float(daily[3]) + float(metric[3])
+        daily[5] = float(daily[5]) + float(metric[5])
+
+
+def parse_metric_file(job):
+    """
+    Parse one provider-day's MetricFile into ParsedMetrics.  job is
+    (prv_def, prv_id, metric_date, metric_file, metric json, compiled):
+    plain values, as this runs in the --workers pool, and the accessors
+    themselves cannot be pickled.  A file whose hash matches its
+    manifest entry is only marked unchanged, not parsed.  Failures are
+    returned in .error rather than raised, so the coordinator can stop
+    at that day.
+    """
+    (prv_def, prv_id, metric_date, metric_file, defs, compiled) = job
+    parsed = ParsedMetrics(prv_id, metric_date, metric_file.filename)
+    try:
+        (parsed.size, parsed.sha1) = metric_file.fingerprint()
+        if parsed.sha1 == metric_file.known_sha1:
+            parsed.unchanged = True
+            return parsed
+        metric_defs = MetricDefs(defs, compiled=compiled)
+        MetricParser(prv_def, metric_date).parse(metric_file,
+                                                 metric_defs.permetric,
+                                                 parsed)
+    except Exception:
+        parsed.stats = []
+        parsed.error = traceback.format_exc()
+    return parsed
+
+
+def parse_metric_files(jobs, pool=None, workers=1):
+    """
+    Yield the ParsedMetrics of each job, in order.  With a pool of
+    workers processes, at most PARSE_AHEAD files per worker are queued
+    or parsed but not yet consumed, so a backlog is never held in
+    memory at once.
+    """
+    if pool is None:
+        for job in jobs:
+            yield parse_metric_file(job)
+        return
+
+    jobs = iter(jobs)
+    window = PARSE_AHEAD * workers
+    pending = deque(pool.apply_async(parse_metric_file, (job,))
+                    for job in itertools.islice(jobs, window))
+    while pending:
+        parsed = pending.popleft().get()
+        for job in itertools.islice(jobs, 1):
+            pending.append(pool.apply_async(parse_metric_file, (job,)))
+        yield parsed
+
+
+class DimensionResolver(object):
+    """
+        The projects (extid : [prjid, teamid]) and metric types
+        (name : [metricid, unit]) of each provider, read once per run.
+        The keys a file adds are inserted in one statement per table,
+        and only their generated ids are read back.
+    """
+
+    def __init__(self, conn):
+        self._conn = conn
+        self._projects = {}
+        self._metric_types = {}
+
+    def projects(self, prvid):
+        """
+        Return the provider's extid : [prjid, teamid]
+        """
+        if prvid not in self._projects:
+            self._projects[prvid] = self._select(PROJECTS_SELECT, prvid)
+        return self._projects[prvid]
+
+    def metric_types(self, prvid):
+        """
+        Return the provider's metric name : [metricid, unit]
+        """
+        if prvid not in self._metric_types:
+            self._metric_types[prvid] = self._select(METRICTYPES_SELECT,
+                                                     prvid)
+        return self._metric_types[prvid]
+
+    def resolve(self, prvid, parsed):
+        """
+        Add the projects and metric types of the ParsedMetrics that the
+        provider does not have yet, committing them
+        """
+        projects = self.projects(prvid)
+        metric_types = self.metric_types(prvid)
+        new_projects = [extid for extid in parsed.projects
+                        if extid not in projects]
+        new_types = [(name, unit, prvid)
+                     for name, unit in parsed.metric_types.iteritems()
+                     if name not in metric_types]
+        if not new_projects and not new_types:
+            return
+
+        cursor = self._conn.cursor()
+        try:
+            if new_projects:
+                # add a new team/divid (can delete later if necessary)
+                # holding the file's new projects
+                cursor.execute("INSERT INTO teams (teamname, divid) "
+                               "VALUES ('unk', 1)")
+                teamid = cursor.lastrowid
+                cursor.executemany(PROJECTS_INSERT,
+                                   [('unk', extid, prvid, teamid)
+                                    for extid in new_projects])
+                self._bump_dimension_version(cursor)
+            if new_types:
+                cursor.executemany(METRICTYPES_INSERT, new_types)
+        except MySQLdb.Error, err:
+            print "Error %d: %s" % (err.args[0], err.args[1])
+            self._conn.rollback()
+            sys.exit(1)
+        self._conn.commit()
+        cursor.close()
+
+        if new_projects:
+            projects.update(self._select(PROJECTS_SELECT, prvid, "extid",
+                                         new_projects))
+        if new_types:
+            metric_types.update(self._select(METRICTYPES_SELECT, prvid,
+                                             "metricname",
+                                             [row[0] for row in new_types]))
+        logging.info('Added %d projects and %d metric types for %s',
+                     len(new_projects), len(new_types), parsed.metric_date)
+
+    def _select(self, query, prvid, key_col=None, keys=None):
+        """
+        Return key : [id, other] of the provider's rows from query,
+        only those whose key_col is in keys if given
+        """
+        params = [prvid]
+        if keys:
+            query = query.rstrip() + " AND " + key_col + " IN (" + \
+                ",".join(["%s"] * len(keys)) + ")"
+            params += keys
+        cursor = self._conn.cursor()
+        try:
+            cursor.execute(query, params)
+        except MySQLdb.Error, err:
+            print "Error %d: %s" % (err.args[0], err.args[1])
+            sys.exit(1)
+
+        rows = {}
+        for row in cursor.fetchall():
+            rows[row[0]] = [row[1], row[2]]
+        cursor.close()
+        return rows
+
+    @staticmethod
+    def _bump_dimension_version(cursor):
+        """
+        Tell dubweb's dimension caches that teams/projects changed
+        """
+        query = """\
+        INSERT INTO dataversions (name, version) VALUES ('dimensions', 1)
+        ON DUPLICATE KEY UPDATE version = version + 1
+        """
+        cursor.execute(query)
+
+
+class DUBLoad(MetricParser):
+    """
+        Class for each metric set (e.g., a day of datacenter foo's metrics,
+        or a month of datacenter bar's metrics).  Projects and metric types
+        come from the run's DimensionResolver, as each set can add them.
+    """
+
+    def __init__(self, prv_def, prv_id, parsed, metric_defs, conn,
+                 dimensions):
+        """
+        Initialize the object, resolving the ParsedMetrics of the file
+        against (and adding to) the provider's projects and metric types
+        held by dimensions, the run's DimensionResolver
+        """
+
+        MetricParser.__init__(self, prv_def, parsed.metric_date)
+        self.current_stats = []
+        self.first_day = None
+        self.last_day = None
+        self.rows_written = 0
+        self._prvid = prv_id
+        self._conn = conn
+        dimensions.resolve(prv_id, parsed)
+        self._metric_types = dimensions.metric_types(prv_id)
+        self._projects = dimensions.projects(prv_id)
+
+        self._resolve_billing(parsed)
+
+        if metric_defs.various is not None:
+            taxrate = self._get_provider_taxrate()
+            self._post_process_stats(taxrate, metric_defs.various)
+
+    def _resolve_billing(self, parsed):
+        """
+        Calculate the final (per day) metrics of the parsed rows,
+        with DB ids.
+        """
+        for result_array in parsed.stats:
+            # get team id before remapping prjid
+            result_array.append(self._projects[result_array[1]][1])
+            # clean up prjid, etc.
+            result_array[1] = self._projects[result_array[1]][0]
+            result_array[2] = self._metric_types[result_array[2]][0]
+            #generate daily data if necessary
+            if self._timeunit == "month":
+                self._add_daily_data(result_array)
+            else:
+                self.current_stats.append(result_array)
 
 
     def _add_daily_data(self, in_array):
@@ -130,23 +507,6 @@ class DUBLoad(object):
                                        86400, 'seconds', cost, in_array[6]])
 
 
-    def _aggregate_hourly_data(self):
-        """
-        Aggregate hourly data for the previous day (modified cost/hours)
-        """
-        daily_stats = defaultdict(dict)
-        for metric in self.current_stats:
-            try:
-                daily_stats[metric[2]][3] = \
-                 float(daily_stats[metric[2]][3]) + float(metric[3])
-                daily_stats[metric[2]][5] = \
-                 float(daily_stats[metric[2]][5]) + float(metric[5])
-            except KeyError:
-                daily_stats[metric[2]] = metric
-                daily_stats[metric[2]][0] = self._metric_date + 'T00:00:00'
-        return daily_stats.values()
-
-
     def _post_process_stats(self, taxrate, summary_metrics):
         """
         Do any final calculations necessary.
@@ -167,64 +527,37 @@ class DUBLoad(object):
                                            '86400', 'seconds', cost, teamid])
 
 
-    def _get_teams(self):
+    def update_provider_stats(self, stats_date):
         """
-        Get teams from  MySQL cub DB
+        Update ETL time for provider in MySQL DB, committing the
+        provider-day's metrics and rollups along with it
         """
-        cursor = self._conn.cursor()
-        teams = {}
-        try:
-            cursor.execute("SELECT teamid, teamname FROM teams")
-        except MySQLdb.Error, err:
-            print "Error %d: %s" % (err.args[0], err.args[1])
-            sys.exit(1)
+        update_lastetl(self._conn, self._prvid, stats_date)
 
-        output = cursor.fetchall()
-        for i in range(0, len(output)):
-            teams[output[i][0]] = output[i][1]
-
-        cursor.close()
-        return teams
-
-    def _get_metric_types(self):
+    def record_file(self, parsed):
         """
-        Get metrics types from  MySQL cub DB
+        Record the loaded file in etl_manifest, in the provider-day's
+        transaction
         """
         cursor = self._conn.cursor()
-        metrictypes = {}
-        query = "SELECT metricname, metricid, unit FROM metrictypes \
-                 WHERE prvid = %s"
+        loadtime = dt.datetime.now().replace(microsecond=0)
         try:
-            cursor.execute(query, (self._prvid))
+            cursor.execute(MANIFEST_UPSERT,
+                           (self._prvid, parsed.path, self._metric_date,
+                            parsed.size, parsed.sha1, parsed.rows,
+                            self.rows_written, loadtime))
         except MySQLdb.Error, err:
             print "Error %d: %s" % (err.args[0], err.args[1])
+            self._conn.rollback()
             sys.exit(1)
-
-        output = cursor.fetchall()
-        for i in range(0, len(output)):
-            metrictypes[output[i][0]] = [output[i][1], output[i][2]]
-
         cursor.close()
-        return metrictypes
 
-    def _add_metric_type(self, name, unit):
+    def _get_provider_taxrate(self):
         """
-        Add metrics type to  MySQL cub DB
+        Get current provider taxrate from  MySQL DB
         """
         cursor = self._conn.cursor()
-        metrictypes = {}
-        query = """\
-        INSERT INTO metrictypes (metricname, unit, prvid) VALUES (%s,%s,%s)
-        """
-        try:
-            cursor.execute(query, (name, unit, self._prvid))
-        except MySQLdb.Error, err:
-            print "Error %d: %s" % (err.args[0], err.args[1])
-            sys.exit(1)
-        self._conn.commit()
-        query = """\
-        SELECT metricname, metricid, unit FROM metrictypes WHERE prvid = %s
-        """
+        query = "SELECT taxrate FROM providers WHERE prvid = %s"
         try:
             cursor.execute(query, (self._prvid))
         except MySQLdb.Error, err:
@@ -232,129 +565,343 @@ class DUBLoad(object):
             sys.exit(1)
 
         output = cursor.fetchall()
-        for i in range(0, len(output)):
-            metrictypes[output[i][0]] = [output[i][1], output[i][2]]
-
         cursor.close()
-        return metrictypes
+        return float(output[0][0])
+
 
-    def _add_team(self, teamname, div_id):
+    def _stats_rows(self):
         """
-        Add team to  MySQL cub DB
+        Return current_stats as metricdata rows, parsing each distinct
+        timestamp once.  Truncate to UTC, as each provider bills
+        according to their own time zone logic.
         """
-        cursor = self._conn.cursor()
-        query = "INSERT INTO teams (teamname, divid) VALUES (%s, %s)"
-        try:
-            cursor.execute(query, (teamname, div_id))
-        except MySQLdb.Error, err:
-            print "Error %d: %s" % (err.args[0], err.args[1])
-            sys.exit(1)
-
-        self._conn.commit()
-        cursor.close()
-        return self._get_teams()
+        parsed = {}
+        rows = []
+        for metric in self.current_stats:
+            trunctime = parsed.get(metric[0])
+            if trunctime is None:
+                mytime = parser.parse(metric[0])
+                trunctime = mytime.replace(second=0, microsecond=0)
+                parsed[metric[0]] = trunctime
+                self._note_day_written(trunctime.date())
+            value = int(round(float(metric[3])))
+            cost = int((float(metric[5])*100)+0.5) / 100.0
+            rows.append((trunctime, metric[2], value, metric[1], cost,
+                         self._prvid, metric[6]))
+        return rows
 
-    def _add_project(self, extname, extid, teamid):
+    @staticmethod
+    def _load_infile(cursor, rows):
         """
-        Add project to  MySQL cub DB
+        Stream rows to metricdata through a TSV and LOAD DATA LOCAL INFILE,
+        writing None ids as \\N so they load as NULL, as with INSERT
         """
-        cursor = self._conn.cursor()
-        query = """\
-        INSERT INTO projects (extname, extid, prvid, teamid) VALUES (%s,%s,%s,%s)
+        with tempfile.NamedTemporaryFile(suffix='.tsv') as tsv:
+            for row in rows:
+                ids = tuple('\\N' if value is None else value
+                            for value in (row[1], row[3], row[5], row[6]))
+                tsv.write("%s\t%s\t%d\t%s\t%.2f\t%s\t%s\n" %
+                          (row[0].strftime('%Y-%m-%d %H:%M:%S'), ids[0],
+                           row[2], ids[1], row[4], ids[2], ids[3]))
+            tsv.flush()
+            cursor.execute(METRICDATA_LOAD, (tsv.name,))
+        if cursor.rowcount != len(rows):
+            logging.warning('LOAD DATA wrote %d of %d rows',
+                            cursor.rowcount, len(rows))
+
+    def write_stats(self, batch_rows=WRITE_BATCH_ROWS, load_infile=False,
+                    bump_version=False):
+        """
+        Write current_stats to the MySQL DB, batch_rows per multi-row
+        INSERT, or all through LOAD DATA LOCAL INFILE if load_infile,
+        first deleting the provider's rows on the days they cover so a
+        reloaded file replaces its earlier load.  If bump_version (the
+        dataversions table exists), the metricdata version is bumped
+        too, so dubweb's caches drop the old numbers even when lastetl
+        does not move.  Nothing is committed until
+        update_provider_stats, so a provider-day is loaded in one
+        transaction.
         """
+        start = time.time()
+        rows = self._stats_rows()
+        self.rows_written = len(rows)
+        cursor = self._conn.cursor()
         try:
-            cursor.execute(query, (extname, extid, self._prvid, teamid))
+            if self.first_day is not None:
+                cursor.execute(METRICDATA_DELETE, (self._prvid,
+                                                   self.first_day,
+                                                   self.last_day))
+                if cursor.rowcount > 0:
+                    logging.info('Replacing %d rows of %s', cursor.rowcount,
+                                 self._metric_date)
+            if load_infile:
+                self._load_infile(cursor, rows)
+            else:
+                for first in range(0, len(rows), batch_rows):
+                    cursor.executemany(METRICDATA_INSERT,
+                                       rows[first:first + batch_rows])
+                    logging.debug('Wrote %d of %d rows of %s',
+                                  min(first + batch_rows, len(rows)),
+                                  len(rows), self._metric_date)
+            if bump_version:
+                cursor.execute(METRICDATA_VERSION_BUMP)
         except MySQLdb.Error, err:
             print "Error %d: %s" % (err.args[0], err.args[1])
+            self._conn.rollback()
             sys.exit(1)
-        self._conn.commit()
         cursor.close()
-        return self._get_projects_for_provider()
 
-    def update_provider_stats(self, stats_date):
+        seconds = time.time() - start
+        logging.info('Wrote %d rows of %s in %.2fs (%.0f rows/sec)',
+                     len(rows), self._metric_date, seconds,
+                     len(rows) / seconds if seconds else 0)
+
+    def _note_day_written(self, day):
         """
-        Update ETL time for provider in MySQL DB
+        Track the range of days write_stats touched
         """
-        cursor = self._conn.cursor()
-        query = "UPDATE providers SET lastetl = %s WHERE prvid = %s"
-
-        try:
-            cursor.execute(query, (stats_date, self._prvid))
-        except MySQLdb.Error, err:
-            print "Error %d: %s" % (err.args[0], err.args[1])
-            sys.exit(1)
-        self._conn.commit()
-        cursor.close()
+        if self.first_day is None or day < self.first_day:
+            self.first_day = day
+        if self.last_day is None or day > self.last_day:
+            self.last_day = day
 
-    def _get_provider_taxrate(self):
+    def refresh_rollups(self):
         """
-        Get current provider taxrate from  MySQL DB
+        Recompute the daily/monthly rollups for the days just written
         """
-        cursor = self._conn.cursor()
-        query = "SELECT taxrate FROM providers WHERE prvid = %s"
-        try:
-            cursor.execute(query, (self._prvid))
-        except MySQLdb.Error, err:
-            print "Error %d: %s" % (err.args[0], err.args[1])
-            sys.exit(1)
+        if self.first_day is not None:
+            rebuild_rollups(self._conn, self._prvid, self.first_day,
+                            self.last_day, commit=False)
 
-        output = cursor.fetchall()
-        cursor.close()
-        return float(output[0][0])
 
+def update_lastetl(conn, prvid, stats_date):
+    """
+    Move the provider's lastetl up to stats_date (never back, as files
+    older than it may be reloaded) and commit
+    """
+    cursor = conn.cursor()
+    query = """\
+    UPDATE providers SET lastetl = %s
+    WHERE prvid = %s AND (lastetl IS NULL OR lastetl < %s)
+    """
 
-    def _get_projects_for_provider(self):
-        """
-        Get projects provider id from  MySQL cub DB
-        """
-        cursor = self._conn.cursor()
-        projects = {}
-        query = """\
-        SELECT extid, prjid, teamid FROM projects WHERE prvid = %s
-        """
+    try:
+        cursor.execute(query, (stats_date, prvid, stats_date))
+    except MySQLdb.Error, err:
+        print "Error %d: %s" % (err.args[0], err.args[1])
+        sys.exit(1)
+    conn.commit()
+    cursor.close()
 
+def rebuild_rollups(conn, prvid, first_day, last_day, commit=True):
+    """
+    Recompute metricdata_daily for one provider's days in
+    [first_day, last_day], then metricdata_monthly for every month
+    those days fall in, in one transaction (left open unless commit).
+    """
+    first_month = first_day.replace(day=1)
+    last_month = last_day.replace(day=1)
+    queries = [("""\
+        DELETE FROM metricdata_daily WHERE prvid = %s
+        AND day BETWEEN %s AND %s
+        """, (prvid, first_day, last_day)),
+               ("""\
+        INSERT INTO metricdata_daily
+        (day, prvid, teamid, prjid, metric, cost, data)
+        SELECT DATE(datetime), prvid, teamid, prjid, metric,
+        SUM(cost), SUM(data) FROM metricdata
+        WHERE prvid = %s AND datetime >= %s
+        AND datetime < DATE_ADD(%s, INTERVAL 1 DAY)
+        GROUP BY DATE(datetime), prvid, teamid, prjid, metric
+        """, (prvid, first_day, last_day)),
+               ("""\
+        DELETE FROM metricdata_monthly WHERE prvid = %s
+        AND month BETWEEN %s AND %s
+        """, (prvid, first_month, last_month)),
+               ("""\
+        INSERT INTO metricdata_monthly (month, prvid, teamid, prjid, cost)
+        SELECT DATE_FORMAT(day, '%%Y-%%m-01'), prvid, teamid, prjid,
+        SUM(cost) FROM metricdata_daily
+        WHERE prvid = %s AND day >= %s
+        AND day < DATE_ADD(%s, INTERVAL 1 MONTH)
+        GROUP BY DATE_FORMAT(day, '%%Y-%%m-01'), prvid, teamid, prjid
+        """, (prvid, first_month, last_month)),
+               (METRICDATA_VERSION_BUMP, None)]
+    cursor = conn.cursor()
+    for query, params in queries:
         try:
-            cursor.execute(query, (self._prvid))
+            cursor.execute(query, params)
         except MySQLdb.Error, err:
             print "Error %d: %s" % (err.args[0], err.args[1])
+            conn.rollback()
             sys.exit(1)
+    if commit:
+        conn.commit()
+    cursor.close()
 
-        output = cursor.fetchall()
-        for i in range(0, len(output)):
-            projects[output[i][0]] = [output[i][1], output[i][2]]
+def rebuild_all_rollups(conn, logger):
+    """
+    Backfill the rollups from every metricdata row, a month at a time,
+    then mark them usable for dubweb's query router.
+    """
+    cursor = conn.cursor()
+    query = """\
+    SELECT prvid, DATE(MIN(datetime)), DATE(MAX(datetime)) FROM metricdata
+    GROUP BY prvid
+    """
+    try:
+        cursor.execute(query)
+    except MySQLdb.Error, err:
+        print "Error %d: %s" % (err.args[0], err.args[1])
+        sys.exit(1)
+    ranges = cursor.fetchall()
+
+    for prvid, first_day, last_day in ranges:
+        month = first_day.replace(day=1)
+        while month <= last_day:
+            month_end = month + relativedelta(months=1, days=-1)
+            logger.info('Rebuilding rollups for provider %s, %s',
+                        prvid, month.strftime('%Y-%m'))
+            rebuild_rollups(conn, prvid, month, month_end)
+            month = month + relativedelta(months=1)
+
+    query = """\
+    INSERT INTO dataversions (name, version) VALUES ('rollups', 1)
+    ON DUPLICATE KEY UPDATE version = version + 1
+    """
+    try:
+        cursor.execute(query)
+    except MySQLdb.Error, err:
+        print "Error %d: %s" % (err.args[0], err.args[1])
+        sys.exit(1)
+    conn.commit()
+    cursor.close()
 
-        cursor.close()
-        return projects
+def get_data_version(conn, name):
+    """
+    Return the dataversions version of name, 0 if it has none
+    """
+    cursor = conn.cursor()
+    query = "SELECT IFNULL(MAX(version), 0) FROM dataversions WHERE name = %s"
+    try:
+        cursor.execute(query, (name,))
+    except MySQLdb.Error, err:
+        print "Error %d: %s" % (err.args[0], err.args[1])
+        sys.exit(1)
+    output = cursor.fetchall()
+    cursor.close()
+    return int(output[0][0])
 
-    def write_stats(self):
-        """
-        Write current_stats to the MySQL DB
-        Truncate to UTC, as each provider bills according
-        to their own time zone logic.
-        """
-        cursor = self._conn.cursor()
-        query = """\
-        INSERT INTO metricdata
-        (datetime, metric, data, prjid, cost, prvid, teamid)
-        VALUES (%s,%s,%s,%s,%s,%s,%s)
-        """
-        for metric in self.current_stats:
-            mytime = parser.parse(metric[0])
-            trunctime = mytime.replace(second=0, microsecond=0)
-            project = metric[1]
-            metricid = metric[2]
-            value = int(round(float(metric[3])))
-            cost = int((float(metric[5])*100)+0.5) / 100.0
-            team_id = metric[6]
-            try:
-                cursor.execute(query, (trunctime, metricid, value,
-                                       project, cost, self._prvid, team_id))
-            except MySQLdb.Error, err:
-                print "Error %d: %s" % (err.args[0], err.args[1])
-                sys.exit(1)
+def get_forecast_stamp(conn):
+    """
+    Return the input data version forecasts are stamped with: the
+    newest providers.lastetl (epoch seconds) and the dimensions version,
+    as dubweb reads them.
+    """
+    cursor = conn.cursor()
+    query = "SELECT IFNULL(UNIX_TIMESTAMP(MAX(lastetl)), 0) FROM providers"
+    try:
+        cursor.execute(query)
+    except MySQLdb.Error, err:
+        print "Error %d: %s" % (err.args[0], err.args[1])
+        sys.exit(1)
+    output = cursor.fetchall()
+    cursor.close()
+    return int(output[0][0]), get_data_version(conn, 'dimensions')
 
-        self._conn.commit()
-        cursor.close()
+def build_forecast_input_query(group_by, rollups):
+    """
+    Return the query for the daily spend points of every id of
+    group_by, over whole days, like dubweb's estimate queries.
+    """
+    if rollups:
+        source = """SELECT day + 0 AS daykey, prvid, teamid, prjid, cost
+                    FROM metricdata_daily WHERE day BETWEEN %s AND %s"""
+    else:
+        source = """SELECT daykey, prvid, teamid, prjid, cost
+                    FROM metricdata WHERE daykey BETWEEN %s AND %s"""
+    if group_by == "divid":
+        group_col = "teams.divid"
+        join = " JOIN teams ON teams.teamid = md.teamid "
+    else:
+        group_col = "md." + group_by
+        join = " "
+    return "SELECT md.daykey, " + group_col + \
+        ", CAST(IFNULL(SUM(md.cost),0) AS SIGNED INT) FROM (" + source + \
+        ") AS md" + join + "WHERE " + group_col + " IS NOT NULL" + \
+        " GROUP BY " + group_col + ", md.daykey"
+
+def forecast_input_days(first_day, last_day, rollups):
+    """
+    Return the day parameters of build_forecast_input_query
+    """
+    if rollups:
+        return (first_day, last_day)
+    return (int(first_day.strftime('%Y%m%d')),
+            int(last_day.strftime('%Y%m%d')))
+
+def materialize_forecasts(conn, rollups, logger, model_name="decay"):
+    """
+    Forecast every project (FORECAST_GRAIN) with the named model
+    (see forecast.MODELS) from the whole days of dubweb's default
+    estimate window (three months back from the end of this month) and
+    replace the forecasts table with the results, stamped with the
+    input data version, in one transaction.
+    """
+    end_dt = dt.datetime.now() + relativedelta(day=31)
+    start_dt = end_dt + relativedelta(months=-3, day=31)
+    # dubweb trusts the rollups only once they are backfilled
+    rollups = rollups and get_data_version(conn, 'rollups') > 0
+    days = forecast_input_days(start_dt.date(), end_dt.date(), rollups)
+    lastetl, dimversion = get_forecast_stamp(conn)
+
+    cursor = conn.cursor()
+    insert = """\
+    INSERT INTO forecasts (grp, grpid, month, spend, sigma, lastetl,
+                           dimversion)
+    VALUES (%s, %s, %s, %s, %s, %s, %s)
+    """
+    try:
+        cursor.execute("DELETE FROM forecasts")
+        cursor.execute(build_forecast_input_query(FORECAST_GRAIN, rollups),
+                       days)
+        batch = forecast.SeriesBatch.from_rows(cursor.fetchall())
+        # no end: each id's default horizon, as /est uses
+        if model_name == "decay":
+            estimates = forecast.decay_forecast(batch, 0)
+        else:
+            estimates = forecast.model_forecast(
+                forecast.get_model(model_name), batch, 0)
+        logger.info('Materialized %d %s forecasts for %d ids',
+                    len(estimates), FORECAST_GRAIN, len(batch.ids))
+        cursor.executemany(insert, [(FORECAST_GRAIN, grpid, month + '-01',
+                                     spend, sigma, lastetl, dimversion)
+                                    for month, grpid, spend, sigma
+                                    in estimates])
+        cursor.execute("""\
+        INSERT INTO dataversions (name, version) VALUES ('forecasts', 1)
+        ON DUPLICATE KEY UPDATE version = version + 1
+        """)
+    except MySQLdb.Error, err:
+        print "Error %d: %s" % (err.args[0], err.args[1])
+        conn.rollback()
+        sys.exit(1)
+    conn.commit()
+    cursor.close()
+
+def has_table(conn, table):
+    """
+    Return True if the current database has the given table
+    """
+    cursor = conn.cursor()
+    try:
+        cursor.execute("SHOW TABLES LIKE %s", (table,))
+    except MySQLdb.Error, err:
+        print "Error %d: %s" % (err.args[0], err.args[1])
+        sys.exit(1)
+    output = cursor.fetchall()
+    cursor.close()
+    return len(output) > 0
 
 
 def load_json_file(filename):
@@ -369,23 +916,108 @@ def load_json_file(filename):
         print " Couldn't load " + filename + "\n"
     return mydict
 
-def load_csv_file(filename):
+def open_metric_file(filename):
+    """
+    Yield a file object for each file in filename, decompressing
+    .gz files and each member of .zip archives as they are read.
+    """
+    if filename.endswith('.zip'):
+        with zipfile.ZipFile(filename) as archive:
+            for name in archive.namelist():
+                if not name.endswith('/'):
+                    with archive.open(name) as member:
+                        yield member
+    elif filename.endswith('.gz'):
+        with gzip.open(filename, 'rb') as filehandle:
+            yield filehandle
+    else:
+        with open(filename, 'rb') as filehandle:
+            yield filehandle
+
+def iter_json_array(filehandle, chunk_bytes=JSON_CHUNK_BYTES):
     """
-    Load csv file (all).
+    Yield each element of the json array in filehandle, reading and
+    decoding it chunk_bytes at a time.
     """
-    with open(filename, 'r') as filehandle:
-        #read csv into a list of lists
-        data = list(list(rec) for rec in csv.reader(filehandle, delimiter=','))
-    filehandle.close()
-    return data
+    decoder = json.JSONDecoder()
+    buf = ""
+    while not buf:
+        chunk = filehandle.read(chunk_bytes)
+        if not chunk:
+            return
+        buf = chunk.lstrip()
+    if buf[0] != '[':
+        raise ValueError("not a json array")
+    pos = 1
+    eof = False
+    while True:
+        pos = JSON_SEPARATORS.match(buf, pos).end()
+        if pos < len(buf) and buf[pos] == ']':
+            return
+        try:
+            element, end = decoder.raw_decode(buf, pos)
+            follow = JSON_SPACE.match(buf, end).end()
+        except ValueError:
+            end = None
+        # complete once the array goes on (a number may be cut short)
+        if end is not None and follow < len(buf) and buf[follow] in ',]':
+            pos = follow
+            yield element
+            continue
+        if eof:
+            raise ValueError("truncated json array")
+        chunk = filehandle.read(chunk_bytes)
+        eof = not chunk
+        buf = buf[pos:] + chunk
+        pos = 0
+
+class MetricFile(object):
+    """
+        A provider billing file, read lazily: iterating it streams the
+        csv rows or json array elements, so only the rows being
+        processed are held in memory.
+    """
+
+    def __init__(self, filename, filetype):
+        self.filename = filename
+        self.filetype = filetype
+        # sha1 of the copy etl_manifest says was loaded, if any
+        self.known_sha1 = None
 
-def open_monitoring_db(dbhost, dbuser, dbpass, database):
+    def fingerprint(self):
+        """
+        Return (size, sha1 hex digest) of the file as stored
+        """
+        sha1 = hashlib.sha1()
+        size = 0
+        with open(self.filename, 'rb') as filehandle:
+            for chunk in iter(lambda: filehandle.read(FILE_HASH_BYTES), ''):
+                sha1.update(chunk)
+                size += len(chunk)
+        return (size, sha1.hexdigest())
+
+    def __iter__(self):
+        """
+        Yield the file's rows.  Read errors (a missing, truncated or
+        corrupt file) are raised, not taken for the end of the file,
+        so a partial day is never loaded as if complete.
+        """
+        for filehandle in open_metric_file(self.filename):
+            if self.filetype == "json":
+                rows = iter_json_array(filehandle)
+            else:
+                rows = csv.reader(filehandle, delimiter=',')
+            for row in rows:
+                yield row
+
+def open_monitoring_db(dbhost, dbuser, dbpass, database, local_infile=False):
     """
-    Open MySQL monitoring DB
+    Open MySQL monitoring DB, allowing LOAD DATA LOCAL if local_infile
     """
     try:
         conn = MySQLdb.connect(host=dbhost, user=dbuser,
-                               passwd=dbpass, db=database)
+                               passwd=dbpass, db=database,
+                               local_infile=int(local_infile))
 
     except MySQLdb.Error, err:
         print "Error %d: %s" % (err.args[0], err.args[1])
@@ -393,11 +1025,48 @@ def open_monitoring_db(dbhost, dbuser, dbpass, database):
 
     return conn
 
-def load_latest_metrics(conn, prefix, filetype, provider_id):
+def get_manifest(conn, provider_id):
+    """
+    Return path : (size, sha1, loadtime) of the provider's files in
+    etl_manifest
     """
-    Load metrics generated since lastetl value in provider
-    table of MySQL cub DB
+    cursor = conn.cursor()
+    manifest = {}
+    query = """\
+    SELECT path, size, sha1, loadtime FROM etl_manifest WHERE prvid = %s
     """
+    try:
+        cursor.execute(query, (provider_id,))
+    except MySQLdb.Error, err:
+        print "Error %d: %s" % (err.args[0], err.args[1])
+        sys.exit(1)
+
+    for row in cursor.fetchall():
+        manifest[row[0]] = (int(row[1]), row[2], row[3])
+    cursor.close()
+    return manifest
+
+def changed_since_load(path, loaded):
+    """
+    Return whether the file at path differs in size from, or was
+    modified after, its manifest (size, sha1, loadtime) entry
+    """
+    stat = os.stat(path)
+    return stat.st_size != loaded[0] or \
+        dt.datetime.fromtimestamp(stat.st_mtime) > loaded[2]
+
+def load_latest_metrics(conn, prefix, filetype, provider_id, manifest=None,
+                        since=None):
+    """
+    Return date : MetricFile of the metrics generated since lastetl value
+    in provider table of MySQL cub DB; files are only read as each
+    date is processed.  With a manifest (from get_manifest), older files
+    changed since they were loaded are returned too, and since (a
+    datetime) returns every file from that day on.  Files in the
+    manifest carry its sha1, so unchanged ones are skipped unparsed.
+    """
+    if manifest is None:
+        manifest = {}
     stats = {}
     cursor = conn.cursor()
 
@@ -421,11 +1090,14 @@ def load_latest_metrics(conn, prefix, filetype, provider_id):
         datepart = re.search(datepattern, currentfile)
         curdatestring = datepart.group(1)
         curdate = parser.parse(curdatestring)
-        if curdate > lastetl:
-            if filetype == "json":
-                stats[curdatestring] = load_json_file(currentfile)
-            else:
-                stats[curdatestring] = load_csv_file(currentfile)
+        metric_file = MetricFile(currentfile, filetype)
+        loaded = manifest.get(currentfile)
+        if loaded is not None:
+            metric_file.known_sha1 = loaded[1]
+        if curdate > lastetl or (since is not None and curdate >= since) \
+           or (loaded is not None and changed_since_load(currentfile,
+                                                         loaded)):
+            stats[curdatestring] = metric_file
 
     cursor.close()
     return stats
@@ -459,6 +1131,31 @@ def parse_arguments():
                            action='store_true', help='enable verbose messages')
     my_parser.add_argument('--debug', '-d', dest='debug', action='store_true',
                            help='enable debug-only mode (no mysql writing)')
+    my_parser.add_argument('--rebuild-rollups', dest='rebuild_rollups',
+                           action='store_true',
+                           help='recompute the daily/monthly rollup tables '
+                           'from all metricdata before loading')
+    my_parser.add_argument('--refresh-forecasts', dest='refresh_forecasts',
+                           action='store_true',
+                           help='materialize the forecasts table even if '
+                           'no new metrics were loaded')
+    my_parser.add_argument('--batch-rows', dest='batch_rows', type=int,
+                           default=WRITE_BATCH_ROWS,
+                           help='metric rows per multi-row INSERT')
+    my_parser.add_argument('--load-infile', dest='load_infile',
+                           action='store_true',
+                           help='write metric rows with LOAD DATA LOCAL '
+                           'INFILE (needs local_infile on the server)')
+    my_parser.add_argument('--eval-metrics', dest='eval_metrics',
+                           action='store_true',
+                           help='eval() the metric expressions on every row '
+                           'as before, to compare rows/sec (see -v)')
+    my_parser.add_argument('--workers', dest='workers', type=int, default=1,
+                           help='processes parsing billing files in '
+                           'parallel (DB writes stay in this process)')
+    my_parser.add_argument('--since', dest='since', type=parser.parse,
+                           help='also reload files dated from this day '
+                           'on (YYYY-MM-DD); unchanged files are skipped')
     return my_parser
 
 def configure_logging(args):
@@ -501,11 +1198,29 @@ def main():
         logging.debug('Got filename of %s', filename)
         logging.debug(pprint.pformat(defs))
 
+    # fork the parsing workers before any DB connection is open
+    pool = None
+    if args.workers > 1:
+        pool = multiprocessing.Pool(args.workers)
+
     # open metrics DB
     conn = open_monitoring_db(defs["dbhost"], defs["dbuser"],
-                              defs["dbpass"], defs["database"])
-
-    # Iterate through providers, loading their stats files
+                              defs["dbpass"], defs["database"],
+                              local_infile=args.load_infile)
+
+    rollups = has_table(conn, "metricdata_daily")
+    if not rollups:
+        logging.warning('No rollup tables, see misc/migrations')
+    elif args.rebuild_rollups and not args.debug:
+        rebuild_all_rollups(conn, logger)
+    versions = has_table(conn, "dataversions")
+    manifests = has_table(conn, "etl_manifest")
+    if not manifests:
+        logging.warning('No etl_manifest table, see misc/migrations')
+
+    # Collect every provider's new metric files as parse jobs
+    providers = {}
+    jobs = []
     for prvdef in defs["metricstypes"]:
         provider = prvdef[0]
         provider_id = get_provider_id(conn, provider)
@@ -513,35 +1228,88 @@ def main():
             #unknown provider
             continue
         statsfilename = prvdef[1]
-        prvmetricdefs = load_json_file(statsfilename)
+        prvmetricjson = load_json_file(statsfilename)
         if logger.isEnabledFor(logging.DEBUG):
             logging.debug('Got provider of %s', provider)
             logging.debug('Got stats file of %s', statsfilename)
-            logging.debug(pprint.pformat(prvmetricdefs))
+            logging.debug(pprint.pformat(prvmetricjson))
 
         # load latest given metric files for a provider
+        manifest = None
+        if manifests:
+            manifest = get_manifest(conn, provider_id)
         providermetrics = load_latest_metrics(conn, prvdef[2], prvdef[3],
-                                              provider_id)
+                                              provider_id, manifest,
+                                              args.since)
         if not providermetrics:
             logging.debug('No metrics found for %s', provider)
             continue
         metricdates = sorted(providermetrics.iterkeys())
         logging.debug('Got a last metrics date of %s', metricdates[-1])
+        providers[provider_id] = (prvdef, MetricDefs(prvmetricjson))
+        for metricrun in metricdates:
+            jobs.append((prvdef, provider_id, metricrun,
+                         providermetrics[metricrun], prvmetricjson,
+                         not args.eval_metrics))
+
+    # Files are parsed in the pool (in order, a few ahead of the
+    # writes); this process alone adds dimensions and writes each
+    # provider-day in its own transaction.  A day that fails to parse
+    # stops its provider, so lastetl only advances over contiguous
+    # completed days.
+    parsed_files = parse_metric_files(jobs, pool, args.workers)
+    dimensions = DimensionResolver(conn)
+    loaded = False
+    failed = set()
+    for parsed in parsed_files:
+        (prvdef, prvmetricdefs) = providers[parsed.prvid]
+        if parsed.prvid in failed:
+            logging.warning('Skipped %s %s, after an earlier failure',
+                            prvdef[0], parsed.metric_date)
+            continue
+        if parsed.error is not None:
+            logging.error('Could not parse %s %s:\n%s', prvdef[0],
+                          parsed.metric_date, parsed.error)
+            failed.add(parsed.prvid)
+            continue
+        if parsed.unchanged:
+            logging.info('Skipped %s, unchanged since it was loaded',
+                         parsed.path)
+            if not args.debug:
+                update_lastetl(conn, parsed.prvid, parsed.metric_date)
+            continue
+        logging.info('Parsed %d rows of %s in %.2fs (%.0f rows/sec)',
+                     parsed.rows, parsed.metric_date, parsed.seconds,
+                     parsed.rows / parsed.seconds if parsed.seconds else 0)
 
         # Create a DubLoad instance for each day/month of metrics
-        for metricrun in metricdates:
-            dub_load = DUBLoad(prvdef, provider_id, metricrun,
-                               providermetrics[metricrun], prvmetricdefs, conn)
-            if logger.isEnabledFor(logging.DEBUG):
-                logging.debug('On %s, %s gave current_stats of',
-                              metricrun, provider)
-                logging.debug(pprint.pformat(dub_load.current_stats))
-            elif len(dub_load.current_stats) > 0:
-                dub_load.write_stats()
-                #todo if not success, then handle it here
-                dub_load.update_provider_stats(metricrun)
-
-    # end provider loop
+        dub_load = DUBLoad(prvdef, parsed.prvid, parsed, prvmetricdefs,
+                           conn, dimensions)
+        if logger.isEnabledFor(logging.DEBUG):
+            logging.debug('On %s, %s gave current_stats of',
+                          parsed.metric_date, prvdef[0])
+            logging.debug(pprint.pformat(dub_load.current_stats))
+        elif len(dub_load.current_stats) > 0:
+            dub_load.write_stats(args.batch_rows, args.load_infile,
+                                 bump_version=versions)
+            loaded = True
+            if rollups:
+                dub_load.refresh_rollups()
+            if manifests:
+                dub_load.record_file(parsed)
+            dub_load.update_provider_stats(parsed.metric_date)
+
+    # end provider-day loop
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+    if (loaded or args.refresh_forecasts) and not args.debug:
+        if has_table(conn, "forecasts"):
+            materialize_forecasts(conn, rollups, logger,
+                                  defs.get("forecast_model", "decay"))
+        else:
+            logging.warning('No forecasts table, see misc/migrations')
     conn.close()
 
 
@@ -2,6 +2,12 @@
 # This script will trigger dubweb to clone the budget for the current month
 # into the next month. It was designed to be run on the 28th of the month. 
 # Change the days on the NEXTMONTH generation if you run it at any other time.
+# Optional arguments clone into more months, and scale the budgets by a
+# percentage, e.g. a year of budgets 5% up for planning:
+#   clone_month.sh 12 5
+MONTHS=${1:-1}
+UPLIFT=${2:-0}
 CURMONTH=`/bin/date +%Y-%m`
 NEXTMONTH=`/bin/date -d +5days +%Y-%m`
-/usr/bin/curl -X POST --user (basicauth_username):(basicauth_password) --data "source=$CURMONTH&dest=$NEXTMONTH" https://(server)/data/budgets/clone
+LASTMONTH=`/bin/date -d "$NEXTMONTH-01 +$((MONTHS - 1)) months" +%Y-%m`
+/usr/bin/curl -X POST --user (basicauth_username):(basicauth_password) --data "source=$CURMONTH&dest=$NEXTMONTH&dest_end=$LASTMONTH&uplift=$UPLIFT" https://(server)/data/budgets/clone
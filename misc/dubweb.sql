@@ -117,10 +117,14 @@ CREATE TABLE IF NOT EXISTS `cub_zu`.`budgetdata` (
   `teamid` TINYINT(4) UNSIGNED NOT NULL,
   `comment` VARCHAR(255) NULL DEFAULT NULL,
   `response` VARCHAR(255) NULL DEFAULT NULL,
+  `monthkey` MEDIUMINT(6) UNSIGNED AS (CAST(LEFT(`month`, 4) AS UNSIGNED) *
+    100 + CAST(SUBSTRING(`month`, 6, 2) AS UNSIGNED)) STORED,
   PRIMARY KEY (`budgetid`),
   UNIQUE INDEX `pid_UNIQUE` (`budgetid` ASC),
   INDEX `prvid_idx` (`prvid` ASC),
   INDEX `budget_teamid` (`teamid` ASC),
+  INDEX `monthkey_cover_idx` (`monthkey` ASC, `teamid` ASC, `prvid` ASC,
+    `month` ASC, `budget` ASC),
   UNIQUE KEY `month` (`month`, `prvid`, `teamid`),
   CONSTRAINT `budget_prvid`
     FOREIGN KEY (`prvid`)
@@ -227,8 +231,17 @@ CREATE TABLE IF NOT EXISTS `cub_zu`.`metricdata` (
   `cost` DECIMAL(12,2) NOT NULL DEFAULT '0.00',
   `prvid` TINYINT(4) UNSIGNED NOT NULL,
   `teamid` TINYINT(4) UNSIGNED NOT NULL,
+  `daykey` INT(8) UNSIGNED AS (YEAR(`datetime`) * 10000 +
+    MONTH(`datetime`) * 100 + DAYOFMONTH(`datetime`)) STORED,
+  `monthkey` MEDIUMINT(6) UNSIGNED AS (YEAR(`datetime`) * 100 +
+    MONTH(`datetime`)) STORED,
   PRIMARY KEY (`id`),
-  INDEX `IDX_Datetime` (`datetime` ASC),
+  INDEX `IDX_Datetime` (`datetime` ASC, `prvid` ASC, `teamid` ASC,
+    `prjid` ASC, `metric` ASC, `cost` ASC),
+  INDEX `daykey_cover_idx` (`daykey` ASC, `prvid` ASC, `teamid` ASC,
+    `prjid` ASC, `metric` ASC, `cost` ASC),
+  INDEX `monthkey_cover_idx` (`monthkey` ASC, `prvid` ASC, `teamid` ASC,
+    `prjid` ASC, `metric` ASC, `cost` ASC),
   INDEX `pid_idx` (`prjid` ASC),
   INDEX `metricid_idx` (`metric` ASC),
   INDEX `prvid_idx` (`prvid` ASC),
@@ -257,6 +270,96 @@ ENGINE = InnoDB
 DEFAULT CHARACTER SET = latin1;
 
 
+-- -----------------------------------------------------
+-- Table `cub_zu`.`dataversions`
+-- -----------------------------------------------------
+DROP TABLE IF EXISTS `cub_zu`.`dataversions` ;
+
+CREATE TABLE IF NOT EXISTS `cub_zu`.`dataversions` (
+  `name` VARCHAR(32) NOT NULL,
+  `version` INT(10) UNSIGNED NOT NULL DEFAULT 0,
+  `updated` TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+    ON UPDATE CURRENT_TIMESTAMP,
+  PRIMARY KEY (`name`))
+ENGINE = InnoDB
+DEFAULT CHARACTER SET = latin1;
+
+INSERT INTO `cub_zu`.`dataversions` (`name`, `version`) VALUES ('dimensions', 1);
+
+
+-- -----------------------------------------------------
+-- Table `cub_zu`.`metricdata_daily`
+-- -----------------------------------------------------
+DROP TABLE IF EXISTS `cub_zu`.`metricdata_daily` ;
+
+CREATE TABLE IF NOT EXISTS `cub_zu`.`metricdata_daily` (
+  `day` DATE NOT NULL,
+  `prvid` TINYINT(4) UNSIGNED NOT NULL,
+  `teamid` TINYINT(4) UNSIGNED NOT NULL,
+  `prjid` SMALLINT(6) UNSIGNED NOT NULL,
+  `metric` SMALLINT(6) UNSIGNED NOT NULL,
+  `cost` DECIMAL(14,2) NOT NULL DEFAULT '0.00',
+  `data` BIGINT(20) UNSIGNED NOT NULL DEFAULT 0,
+  PRIMARY KEY (`day`, `prvid`, `teamid`, `prjid`, `metric`),
+  INDEX `prvid_day_idx` (`prvid` ASC, `day` ASC))
+ENGINE = InnoDB
+DEFAULT CHARACTER SET = latin1;
+
+
+-- -----------------------------------------------------
+-- Table `cub_zu`.`metricdata_monthly`
+-- -----------------------------------------------------
+DROP TABLE IF EXISTS `cub_zu`.`metricdata_monthly` ;
+
+CREATE TABLE IF NOT EXISTS `cub_zu`.`metricdata_monthly` (
+  `month` DATE NOT NULL,
+  `prvid` TINYINT(4) UNSIGNED NOT NULL,
+  `teamid` TINYINT(4) UNSIGNED NOT NULL,
+  `prjid` SMALLINT(6) UNSIGNED NOT NULL,
+  `cost` DECIMAL(16,2) NOT NULL DEFAULT '0.00',
+  PRIMARY KEY (`month`, `prvid`, `teamid`, `prjid`),
+  INDEX `prvid_month_idx` (`prvid` ASC, `month` ASC))
+ENGINE = InnoDB
+DEFAULT CHARACTER SET = latin1;
+
+
+-- -----------------------------------------------------
+-- Table `cub_zu`.`forecasts`
+-- -----------------------------------------------------
+DROP TABLE IF EXISTS `cub_zu`.`forecasts` ;
+
+CREATE TABLE IF NOT EXISTS `cub_zu`.`forecasts` (
+  `grp` VARCHAR(8) NOT NULL,
+  `grpid` SMALLINT(6) UNSIGNED NOT NULL,
+  `month` DATE NOT NULL,
+  `spend` BIGINT(20) NOT NULL,
+  `sigma` BIGINT(20) NOT NULL DEFAULT 0,
+  `lastetl` INT(10) UNSIGNED NOT NULL,
+  `dimversion` INT(10) UNSIGNED NOT NULL,
+  PRIMARY KEY (`grp`, `grpid`, `month`))
+ENGINE = InnoDB
+DEFAULT CHARACTER SET = latin1;
+
+
+-- -----------------------------------------------------
+-- Table `cub_zu`.`etl_manifest`
+-- -----------------------------------------------------
+DROP TABLE IF EXISTS `cub_zu`.`etl_manifest` ;
+
+CREATE TABLE IF NOT EXISTS `cub_zu`.`etl_manifest` (
+  `prvid` TINYINT(4) UNSIGNED NOT NULL,
+  `path` VARCHAR(255) NOT NULL,
+  `metricdate` DATE NOT NULL,
+  `size` BIGINT(20) UNSIGNED NOT NULL,
+  `sha1` CHAR(40) NOT NULL,
+  `filerows` INT(10) UNSIGNED NOT NULL DEFAULT 0,
+  `datarows` INT(10) UNSIGNED NOT NULL DEFAULT 0,
+  `loadtime` DATETIME NOT NULL,
+  PRIMARY KEY (`prvid`, `path`))
+ENGINE = InnoDB
+DEFAULT CHARACTER SET = latin1;
+
+
 -- -----------------------------------------------------
 -- Table `cub_zu`.`perfconst`
 -- -----------------------------------------------------
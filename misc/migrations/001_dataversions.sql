@@ -0,0 +1,18 @@
+-- -----------------------------------------------------
+-- Migration 001: dataversions
+-- Version counters bumped by admin writes and the ETL, so that
+-- dubweb workers can cache dimension tables and only reload them
+-- when a counter moves.  Run against the dubweb database:
+--   mysql cub_zu < 001_dataversions.sql
+-- -----------------------------------------------------
+
+CREATE TABLE IF NOT EXISTS `dataversions` (
+  `name` VARCHAR(32) NOT NULL,
+  `version` INT(10) UNSIGNED NOT NULL DEFAULT 0,
+  `updated` TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+    ON UPDATE CURRENT_TIMESTAMP,
+  PRIMARY KEY (`name`))
+ENGINE = InnoDB
+DEFAULT CHARACTER SET = latin1;
+
+INSERT IGNORE INTO `dataversions` (`name`, `version`) VALUES ('dimensions', 1);
@@ -0,0 +1,34 @@
+-- -----------------------------------------------------
+-- Migration 002: metricdata rollups
+-- Daily (day, prvid, teamid, prjid, metric) and monthly
+-- (month, prvid, teamid, prjid) sums of metricdata, kept current by
+-- cub_extract after each load.  Run against the dubweb database:
+--   mysql cub_zu < 002_rollups.sql
+-- then backfill them (dubweb keeps reading raw metricdata until
+-- the backfill has finished):
+--   python cub_extract.py -f zu/zu_advanced_meta.json --rebuild-rollups
+-- -----------------------------------------------------
+
+CREATE TABLE IF NOT EXISTS `metricdata_daily` (
+  `day` DATE NOT NULL,
+  `prvid` TINYINT(4) UNSIGNED NOT NULL,
+  `teamid` TINYINT(4) UNSIGNED NOT NULL,
+  `prjid` SMALLINT(6) UNSIGNED NOT NULL,
+  `metric` SMALLINT(6) UNSIGNED NOT NULL,
+  `cost` DECIMAL(14,2) NOT NULL DEFAULT '0.00',
+  `data` BIGINT(20) UNSIGNED NOT NULL DEFAULT 0,
+  PRIMARY KEY (`day`, `prvid`, `teamid`, `prjid`, `metric`),
+  INDEX `prvid_day_idx` (`prvid` ASC, `day` ASC))
+ENGINE = InnoDB
+DEFAULT CHARACTER SET = latin1;
+
+CREATE TABLE IF NOT EXISTS `metricdata_monthly` (
+  `month` DATE NOT NULL,
+  `prvid` TINYINT(4) UNSIGNED NOT NULL,
+  `teamid` TINYINT(4) UNSIGNED NOT NULL,
+  `prjid` SMALLINT(6) UNSIGNED NOT NULL,
+  `cost` DECIMAL(16,2) NOT NULL DEFAULT '0.00',
+  PRIMARY KEY (`month`, `prvid`, `teamid`, `prjid`),
+  INDEX `prvid_month_idx` (`prvid` ASC, `month` ASC))
+ENGINE = InnoDB
+DEFAULT CHARACTER SET = latin1;
@@ -0,0 +1,21 @@
+-- -----------------------------------------------------
+-- Migration 003: metricdata day/month keys
+-- Stored generated daykey (YYYYMMDD) and monthkey (YYYYMM) columns,
+-- and covering indexes so dubweb's spend queries filter and group
+-- without reading the clustered rows.  Needs MySQL 5.7 or later.
+-- This rebuilds metricdata; run it during a quiet period:
+--   mysql cub_zu < 003_metricdata_keys.sql
+-- -----------------------------------------------------
+
+ALTER TABLE `metricdata`
+  ADD COLUMN `daykey` INT(8) UNSIGNED AS (YEAR(`datetime`) * 10000 +
+    MONTH(`datetime`) * 100 + DAYOFMONTH(`datetime`)) STORED,
+  ADD COLUMN `monthkey` MEDIUMINT(6) UNSIGNED AS (YEAR(`datetime`) * 100 +
+    MONTH(`datetime`)) STORED,
+  DROP INDEX `IDX_Datetime`,
+  ADD INDEX `IDX_Datetime` (`datetime` ASC, `prvid` ASC, `teamid` ASC,
+    `prjid` ASC, `metric` ASC, `cost` ASC),
+  ADD INDEX `daykey_cover_idx` (`daykey` ASC, `prvid` ASC, `teamid` ASC,
+    `prjid` ASC, `metric` ASC, `cost` ASC),
+  ADD INDEX `monthkey_cover_idx` (`monthkey` ASC, `prvid` ASC,
+    `teamid` ASC, `prjid` ASC, `metric` ASC, `cost` ASC);
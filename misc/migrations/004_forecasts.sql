@@ -0,0 +1,22 @@
+-- -----------------------------------------------------
+-- Migration 004: materialized forecasts
+-- Monthly spend estimates per project (grp names the id column,
+-- prjid; dubweb sums projects up to teams, divisions and providers),
+-- rewritten by cub_extract after each load and stamped with the
+-- lastetl and dimensions version they were computed from.  Run against
+-- the dubweb database:
+--   mysql cub_zu < 004_forecasts.sql
+-- then fill it (the /est charts forecast on demand until then):
+--   python cub_extract.py -f zu/zu_advanced_meta.json --refresh-forecasts
+-- -----------------------------------------------------
+
+CREATE TABLE IF NOT EXISTS `forecasts` (
+  `grp` VARCHAR(8) NOT NULL,
+  `grpid` SMALLINT(6) UNSIGNED NOT NULL,
+  `month` DATE NOT NULL,
+  `spend` BIGINT(20) NOT NULL,
+  `lastetl` INT(10) UNSIGNED NOT NULL,
+  `dimversion` INT(10) UNSIGNED NOT NULL,
+  PRIMARY KEY (`grp`, `grpid`, `month`))
+ENGINE = InnoDB
+DEFAULT CHARACTER SET = latin1;
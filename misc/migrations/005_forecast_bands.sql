@@ -0,0 +1,12 @@
+-- -----------------------------------------------------
+-- Migration 005: forecast prediction bands
+-- Standard deviation of each materialized monthly estimate, from
+-- which /est?bands=1 derives its p10/p90 series.  Run against the
+-- dubweb database:
+--   mysql cub_zu < 005_forecast_bands.sql
+-- then refill the table so stored rows carry a sigma:
+--   python cub_extract.py -f zu/zu_advanced_meta.json --refresh-forecasts
+-- -----------------------------------------------------
+
+ALTER TABLE `forecasts`
+  ADD COLUMN `sigma` BIGINT(20) NOT NULL DEFAULT 0 AFTER `spend`;
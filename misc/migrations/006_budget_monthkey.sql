@@ -0,0 +1,15 @@
+-- -----------------------------------------------------
+-- Migration 006: budgetdata month keys
+-- Stored generated monthkey (YYYYMM) column, computed from the
+-- 'YYYY-MM' month, and a covering index so dubweb's budget queries
+-- take the chart's month window as a range predicate.  Needs MySQL
+-- 5.7 or later:
+--   mysql cub_zu < 006_budget_monthkey.sql
+-- -----------------------------------------------------
+
+ALTER TABLE `budgetdata`
+  ADD COLUMN `monthkey` MEDIUMINT(6) UNSIGNED AS
+    (CAST(LEFT(`month`, 4) AS UNSIGNED) * 100 +
+     CAST(SUBSTRING(`month`, 6, 2) AS UNSIGNED)) STORED,
+  ADD INDEX `monthkey_cover_idx` (`monthkey` ASC, `teamid` ASC,
+    `prvid` ASC, `month` ASC, `budget` ASC);
@@ -0,0 +1,21 @@
+-- -----------------------------------------------------
+-- Migration 007: ETL file manifest
+-- One row per billing file cub_extract has loaded: its size, content
+-- hash, rows read and written, and when.  Unchanged files are skipped
+-- by hash; a changed file replaces its provider's metricdata for the
+-- days it covers.  Run against the dubweb database:
+--   mysql cub_zu < 007_etl_manifest.sql
+-- -----------------------------------------------------
+
+CREATE TABLE IF NOT EXISTS `etl_manifest` (
+  `prvid` TINYINT(4) UNSIGNED NOT NULL,
+  `path` VARCHAR(255) NOT NULL,
+  `metricdate` DATE NOT NULL,
+  `size` BIGINT(20) UNSIGNED NOT NULL,
+  `sha1` CHAR(40) NOT NULL,
+  `filerows` INT(10) UNSIGNED NOT NULL DEFAULT 0,
+  `datarows` INT(10) UNSIGNED NOT NULL DEFAULT 0,
+  `loadtime` DATETIME NOT NULL,
+  PRIMARY KEY (`prvid`, `path`))
+ENGINE = InnoDB
+DEFAULT CHARACTER SET = latin1;
@@ -0,0 +1,16 @@
+#!/usr/bin/env python
+"""
+    Installs dubforecast, the forecast library shared by the dubweb
+    app and the ETL scripts in /etl:
+
+    pip install .
+"""
+
+from setuptools import setup
+
+setup(name='dubforecast',
+      version='0.1.0',
+      description='dubweb spend forecasting, shared by the app and ETL',
+      license='Apache License 2.0',
+      packages=['dubforecast'],
+      install_requires=['numpy'])
@@ -11,6 +11,7 @@ import unittest
 
 # Local imports
 from app import admindb
+from app import dimcache
 
 class TestDubwebDB(unittest.TestCase):
     """
@@ -197,6 +198,125 @@ class TestDubwebDB(unittest.TestCase):
                                           my_comment=comment_test)
         self.assertEqual(len(item), 7)
 
+    def test_month_range(self):
+        """
+        Test the destination month ranges of budget cloning.
+        """
+        self.assertEqual(admindb.month_range('2014-11', '2015-02'),
+                         ['2014-11', '2014-12', '2015-01', '2015-02'])
+        self.assertEqual(admindb.month_range('2015-02', '2015-02'),
+                         ['2015-02'])
+        self.assertEqual(admindb.month_range('2015-02', '2015-01'), [])
+        self.assertRaises(ValueError, admindb.month_range, '2015-13',
+                          '2016-01')
+
+    def test_clone_budget_months(self):
+        """
+        Test cloning one month into a range of months with an uplift,
+        then cloning again skips the budgets already there.
+        """
+        prvid_test = 1
+        teamid_test = 2
+        src_month = '2013-06'
+        dst_months = ['2013-07', '2013-08', '2013-09']
+        new_budget = admindb.AdmIDs(prvid_test, teamid_test,
+                                    project_id=None, budget_id=None,
+                                    div_id=None)
+        src_item = admindb.insert_budget_item(new_budget,
+                                              my_month=src_month,
+                                              my_budget=200,
+                                              my_comment='please delete me.',
+                                              my_response=None)
+        counts = admindb.clone_budget_months(new_budget, src_month,
+                                             dst_months, uplift=10)
+        self.assertEqual(counts, {"Inserted": 3, "Skipped": 0})
+        counts = admindb.clone_budget_months(new_budget, src_month,
+                                             dst_months, uplift=10)
+        self.assertEqual(counts, {"Inserted": 0, "Skipped": 3})
+
+        for month in [src_month] + dst_months:
+            items = admindb.get_budget_items(ids=new_budget, m_filter=month,
+                                             bgt_filter=None)
+            self.assertEqual(len(items), 1)
+            if month != src_month:
+                self.assertEqual(items[0]['Budget'], 220)
+                self.assertEqual(items[0]['Comment'],
+                                 'Cloned from ' + src_month + ' +10%')
+            delete_id = admindb.AdmIDs(prv_id=None, team_id=None,
+                                       project_id=None,
+                                       budget_id=items[0]['ID'],
+                                       div_id=None)
+            admindb.delete_budget_item(delete_id, my_month=month,
+                                       my_budget=None, my_comment=None)
+        self.assertEqual(src_item['Month'], src_month)
+
+    def test_parse_budget_matrix(self):
+        """
+        Test budget matrix validation against the dimensions.
+        """
+        dims = dimcache.Dimensions(providers={1: ['prv', 0, 0]},
+                                   teams={2: 'team'}, team_divs={2: 1},
+                                   divisions={1: 'div'}, projects={})
+        rows = [{"TeamID": "2", "ProviderID": "1", "2015-01": "100",
+                 "2015-02": ""},
+                {"TeamID": 2, "ProviderID": 1, "2015-03": 300,
+                 "2015-04": 1500.75, "2015-05": "99.5"}]
+        budgets, errors = admindb.parse_budget_matrix(rows, dims)
+        self.assertEqual(budgets, [(100, '2015-01', 2, 1),
+                                   (300, '2015-03', 2, 1),
+                                   (1501, '2015-04', 2, 1),
+                                   (100, '2015-05', 2, 1)])
+        self.assertEqual(errors, [])
+        bad_rows = [{"TeamID": "9", "ProviderID": "1", "2015-13": "1"},
+                    {"TeamID": "2", "ProviderID": "x"},
+                    {"TeamID": "2", "ProviderID": "1", "2015-01": "lots"}]
+        budgets, errors = admindb.parse_budget_matrix(bad_rows, dims)
+        self.assertEqual(budgets, [])
+        self.assertEqual(len(errors), 4)
+        budgets, errors = admindb.parse_budget_matrix(
+            [[2, 1, "2015-01", 5], [1], "row"], dims)
+        self.assertEqual(budgets, [])
+        self.assertEqual(len(errors), 3)
+
+    def test_upload_export_budget_matrix(self):
+        """
+        Test a budget matrix upload, then reupload, round trips through
+        the export; an invalid upload writes nothing.
+        """
+        team_test = 1
+        prv_test = 1
+        months = ['2012-01', '2012-02']
+        matrix = [{"TeamID": team_test, "ProviderID": prv_test,
+                   months[0]: 10, months[1]: 20}]
+        result = admindb.upload_budget_matrix(matrix, 'please delete me.')
+        self.assertEqual(result, {"Budgets": 2, "Errors": []})
+        matrix[0][months[1]] = 25
+        result = admindb.upload_budget_matrix(matrix, 'please delete me.')
+        self.assertEqual(result, {"Budgets": 2, "Errors": []})
+
+        bad = [dict(matrix[0], TeamID=250)]
+        result = admindb.upload_budget_matrix(bad)
+        self.assertEqual(result["Budgets"], 0)
+        self.assertEqual(len(result["Errors"]), 1)
+
+        ids = admindb.AdmIDs(prv_test, team_test, project_id=None,
+                             budget_id=None, div_id=None)
+        exported = list(admindb.iter_budget_matrix(ids, months[0],
+                                                   months[1]))
+        self.assertEqual(exported, [admindb.MATRIX_KEYS + months,
+                                    [team_test, prv_test, 10, 25]])
+
+        for month in months:
+            items = admindb.get_budget_items(ids=ids, m_filter=month,
+                                             bgt_filter=None)
+            self.assertEqual(len(items), 1)
+            delete_id = admindb.AdmIDs(prv_id=None, team_id=None,
+                                       project_id=None,
+                                       budget_id=items[0]['ID'],
+                                       div_id=None)
+            admindb.delete_budget_item(delete_id, my_month=month,
+                                       my_budget=None, my_comment=None)
+
     def test_all_get_provider_admin(self):
         """
         Test that all providers in MySQL have 4 fields
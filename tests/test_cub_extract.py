@@ -0,0 +1,413 @@
+#!/usr/bin/env python
+"""
+   Tests for etl/cub_extract.py
+   Called via nosetests tests/test_cub_extract.py
+"""
+
+# Global imports
+import datetime as dt
+import gzip
+import hashlib
+import json
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+import zipfile
+from StringIO import StringIO
+
+# Local imports
+ETL_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                       os.pardir, 'etl')
+sys.path.append(ETL_DIR)
+import cub_extract
+
+SETTINGS_PATH = "/var/dubweb/.settings"
+# a provider-day with no real metricdata, written and cleared by TestDUBLoad
+LOAD_PRVID = 1
+LOAD_DAY = '2001-01-15'
+
+class FakeLoad(object):
+    """ The DUBLoad attributes metric expressions may use """
+    _delimiter = ':'
+    _metric_date = '2015-06-01'
+    _timeunit = 'hour'
+
+
+class TestMetricDefs(unittest.TestCase):
+    """ Test compiling the provider metric definitions """
+
+    def sample_rows(self):
+        """ Return a provider : input row that every expression can read """
+        google = {'startTime': '2015-06-01T00:00:00-07:00',
+                  'projectNumber': '1234',
+                  'measurements': [{'measurementId': 'vm', 'sum': '60',
+                                    'unit': 'seconds'}],
+                  'cost': {'amount': '1.25'},
+                  'credits': [{'amount': '-0.25'}]}
+        line = ['field%d' % idx for idx in range(20)]
+        return {'zu_google_metrics.json': google,
+                'zu_aws_metrics.json': line,
+                'zu_brandx_metrics.json': line}
+
+    def test_compiled_matches_eval(self):
+        """ Test every shipped expression gives eval()'s value """
+        for filename, row in self.sample_rows().iteritems():
+            with open(os.path.join(ETL_DIR, 'zu', filename)) as defs_file:
+                defs = json.load(defs_file)
+            compiled = cub_extract.MetricDefs(defs)
+            legacy = cub_extract.MetricDefs(defs, compiled=False)
+            for exprs, accessors, evals in zip(defs['permetric'],
+                                               compiled.permetric,
+                                               legacy.permetric):
+                for expr, accessor, evaluate in zip(exprs, accessors, evals):
+                    self.assertEqual(accessor(row, FakeLoad()),
+                                     evaluate(row, FakeLoad()), msg=expr)
+
+    def test_compile_metric_expr(self):
+        """ Test declarative and general expressions """
+        row = {'a': [{'b': 'x'}], 'c': ' padded '}
+        accessor = cub_extract.compile_metric_expr("metric['a'][0]['b'] + "
+                                                   "self._delimiter + 'y'")
+        self.assertEqual(accessor(row, FakeLoad()), 'x:y')
+        accessor = cub_extract.compile_metric_expr("metric['c'].strip()")
+        self.assertEqual(accessor(row, FakeLoad()), 'padded')
+        accessor = cub_extract.compile_metric_expr("metric['missing']")
+        self.assertRaises(KeyError, accessor, row, FakeLoad())
+
+
+class TestMetricFiles(unittest.TestCase):
+    """ Test streaming the provider billing files """
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_iter_json_array(self):
+        """ Test elements decode the same whatever the chunk size """
+        elements = [{'startTime': 'day %d' % idx, 'cost': {'amount': idx},
+                     'tags': ['a]', 'b,'] * (idx % 3)} for idx in range(50)]
+        elements += [1.25, -30, "]"]
+        for text in [json.dumps(elements), json.dumps(elements, indent=2)]:
+            for chunk_bytes in [1, 3, 17, 65536]:
+                self.assertEqual(list(cub_extract.iter_json_array(
+                    StringIO(text), chunk_bytes)), elements)
+        self.assertEqual(list(cub_extract.iter_json_array(StringIO(""))), [])
+        self.assertEqual(list(cub_extract.iter_json_array(StringIO(" [] "))),
+                         [])
+        truncated = cub_extract.iter_json_array(StringIO('[{"a": 1}, {"b'), 4)
+        self.assertRaises(ValueError, list, truncated)
+
+    def test_compressed_metric_files(self):
+        """ Test csv and json files read the same compressed or not """
+        rows = [['a', 'b'], ['1', '2']]
+        csv_text = "a,b\n1,2\n"
+        json_text = json.dumps(rows)
+        with open(os.path.join(self.tmpdir, 'plain.csv'), 'w') as plain:
+            plain.write(csv_text)
+        with gzip.open(os.path.join(self.tmpdir, 'day.json.gz'), 'wb') as gz:
+            gz.write(json_text)
+        with zipfile.ZipFile(os.path.join(self.tmpdir, 'month.csv.zip'),
+                             'w') as archive:
+            archive.writestr('month.csv', csv_text)
+        for name, filetype in [('plain.csv', 'csv'), ('day.json.gz', 'json'),
+                               ('month.csv.zip', 'csv')]:
+            metric_file = cub_extract.MetricFile(
+                os.path.join(self.tmpdir, name), filetype)
+            self.assertEqual([list(row) for row in metric_file], rows)
+
+    def test_truncated_metric_files(self):
+        """ Test a cut-off gz or zip file fails its parse, not ends it """
+        csv_text = "".join("2015-06-01T%02d:00:00,p%d,vm,%d,1.5\n" %
+                           (idx % 24, idx % 7, idx) for idx in range(20000))
+        gz_path = os.path.join(self.tmpdir, 'aws-2015-06-01.csv.gz')
+        with gzip.open(gz_path, 'wb') as gz:
+            gz.write(csv_text)
+        zip_path = os.path.join(self.tmpdir, 'aws-2015-06-02.csv.zip')
+        with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_DEFLATED) as archive:
+            archive.writestr('aws.csv', csv_text)
+        defs = {'permetric': [["metric[0]", "metric[1]", "metric[2]",
+                               "metric[3]", "'hours'", "metric[4]"]]}
+        prv_def = ['AWS', 'defs.json', 'aws-', 'csv', 'hour', ':']
+        for path in [gz_path, zip_path]:
+            with open(path, 'rb') as whole:
+                data = whole.read()
+            with open(path, 'wb') as cut:
+                cut.write(data[:len(data) // 2])
+            metric_file = cub_extract.MetricFile(path, 'csv')
+            parsed = cub_extract.parse_metric_file(
+                (prv_def, 3, '2015-06-01', metric_file, defs, True))
+            self.assertIsNotNone(parsed.error, msg=path)
+            self.assertEqual(parsed.stats, [])
+
+    def test_parse_metric_file(self):
+        """ Test parsing hourly rows, in and out of a worker pool """
+        with open(os.path.join(self.tmpdir, 'aws-2015-06-01.csv'),
+                  'w') as billing:
+            billing.write("time,project,name,usage,cost\n"
+                          "2015-06-01T01:00:00,p1,vm,10,1.5\n"
+                          "2015-06-01T02:00:00,p2,vm,20,2.5\n"
+                          "2015-06-01T02:00:00,p2,disk,5,0\n"
+                          "2015-06-01T03:00:00,p2,ip,1,0.5\n")
+        defs = {'permetric': [["metric[0]", "metric[1]", "metric[2]",
+                               "metric[3]", "'hours'", "metric[4]"]]}
+        prv_def = ['AWS', 'defs.json', 'aws-', 'csv', 'hour', ':']
+        metric_file = cub_extract.MetricFile(
+            os.path.join(self.tmpdir, 'aws-2015-06-01.csv'), 'csv')
+        jobs = [(prv_def, 3, '2015-06-01', metric_file, defs, True),
+                (prv_def, 3, '2015-06-02', metric_file,
+                 {'permetric': [["metric[9]"]]}, True)]
+        parsed = cub_extract.parse_metric_file(jobs[0])
+        self.assertEqual(parsed.rows, 5)
+        self.assertEqual(parsed.projects.keys(), ['p1', 'p2'])
+        self.assertEqual(parsed.metric_types.items(),
+                         [('vm', 'hours'), ('ip', 'hours')])
+        self.assertEqual(sorted(parsed.stats),
+                         [['2015-06-01T00:00:00', 'p1', 'vm', 30.0, 'hours',
+                           4.0],
+                          ['2015-06-01T00:00:00', 'p2', 'ip', '1', 'hours',
+                           '0.5']])
+        self.assertIsNone(parsed.error)
+        pool = multiprocessing.Pool(2)
+        try:
+            pooled = list(cub_extract.parse_metric_files(jobs * 3, pool, 1))
+        finally:
+            pool.close()
+            pool.join()
+        self.assertEqual([each.metric_date for each in pooled],
+                         ['2015-06-01', '2015-06-02'] * 3)
+        self.assertEqual(sorted(pooled[0].stats), sorted(parsed.stats))
+        self.assertEqual(pooled[1].stats, [])
+        self.assertIn('IndexError', pooled[1].error)
+
+    def test_unchanged_metric_file(self):
+        """ Test files matching their manifest entry are not parsed """
+        path = os.path.join(self.tmpdir, 'brandx-2015-06-01.csv')
+        with open(path, 'w') as billing:
+            billing.write("2015-06-01,p1,vm,1,5\n")
+        prv_def = ['BrandX', 'defs.json', 'brandx-', 'csv', 'month', '']
+        defs = {'permetric': [["metric[0]", "metric[1]", "metric[2]",
+                               "metric[3]", "'hours'", "metric[4]"]]}
+        metric_file = cub_extract.MetricFile(path, 'csv')
+        (size, sha1) = metric_file.fingerprint()
+        self.assertEqual(size, 21)
+        self.assertEqual(sha1, hashlib.sha1("2015-06-01,p1,vm,1,5\n")
+                         .hexdigest())
+        job = (prv_def, 2, '2015-06-01', metric_file, defs, True)
+        self.assertEqual(cub_extract.parse_metric_file(job).rows, 1)
+        metric_file.known_sha1 = sha1
+        parsed = cub_extract.parse_metric_file(job)
+        self.assertTrue(parsed.unchanged)
+        self.assertEqual((parsed.path, parsed.rows), (path, 0))
+
+        loadtime = dt.datetime.fromtimestamp(os.stat(path).st_mtime + 1)
+        self.assertFalse(cub_extract.changed_since_load(
+            path, (size, sha1, loadtime)))
+        self.assertTrue(cub_extract.changed_since_load(
+            path, (size + 1, sha1, loadtime)))
+        self.assertTrue(cub_extract.changed_since_load(
+            path, (size, sha1, loadtime - dt.timedelta(seconds=5))))
+
+
+class TestDimensionResolver(unittest.TestCase):
+    """ Test batched project and metric type discovery in the test DB """
+
+    @classmethod
+    def setUpClass(cls):
+        settings = cub_extract.load_json_file(SETTINGS_PATH)
+        cls._conn = cub_extract.open_monitoring_db(settings['dbhost'],
+                                                   settings['dbuser'],
+                                                   settings['dbpass'],
+                                                   settings['db_db'])
+
+    @classmethod
+    def tearDownClass(cls):
+        cls._conn.close()
+
+    def count_rows(self, query, params):
+        """ Return the single value of a COUNT query """
+        cursor = self._conn.cursor()
+        cursor.execute(query, params)
+        count = cursor.fetchall()[0][0]
+        cursor.close()
+        return count
+
+    def test_resolve(self):
+        """
+        Test new keys are added in bulk, under one new team,
+        and known keys again add nothing.
+        """
+        prvid_test = 1
+        parsed = cub_extract.ParsedMetrics(prvid_test, '2015-06-01')
+        for extid, name in [('zz-test-1', 'zz-test:a'),
+                            ('zz-test-2', 'zz-test:b'),
+                            ('zz-test-1', 'zz-test:a')]:
+            parsed.note_dimensions(['2015-06-01', extid, name, '1',
+                                    'hours', '1.0'])
+        resolver = cub_extract.DimensionResolver(self._conn)
+        known = len(resolver.projects(prvid_test))
+        resolver.resolve(prvid_test, parsed)
+        projects = resolver.projects(prvid_test)
+        metric_types = resolver.metric_types(prvid_test)
+        try:
+            self.assertEqual(len(projects), known + 2)
+            self.assertEqual(projects['zz-test-1'][1],
+                             projects['zz-test-2'][1])
+            self.assertEqual(metric_types['zz-test:b'][1], 'hours')
+            self.assertEqual(cub_extract.DimensionResolver(self._conn)
+                             .projects(prvid_test)['zz-test-2'],
+                             projects['zz-test-2'])
+            resolver.resolve(prvid_test, parsed)
+            self.assertEqual(self.count_rows(
+                "SELECT COUNT(*) FROM projects WHERE extid LIKE %s",
+                ('zz-test-%',)), 2)
+        finally:
+            cursor = self._conn.cursor()
+            cursor.execute("SELECT DISTINCT teamid FROM projects "
+                           "WHERE extid LIKE %s", ('zz-test-%',))
+            team_ids = [row[0] for row in cursor.fetchall()]
+            cursor.execute("DELETE FROM projects WHERE extid LIKE %s",
+                           ('zz-test-%',))
+            cursor.execute("DELETE FROM metrictypes WHERE metricname "
+                           "LIKE %s", ('zz-test:%',))
+            for teamid in team_ids:
+                cursor.execute("DELETE FROM teams WHERE teamid = %s",
+                               (teamid,))
+            self._conn.commit()
+            cursor.close()
+
+
+class TestDUBLoad(unittest.TestCase):
+    """ Test writing a provider-day to metricdata in the test DB """
+
+    @classmethod
+    def setUpClass(cls):
+        settings = cub_extract.load_json_file(SETTINGS_PATH)
+        cls._conn = cub_extract.open_monitoring_db(settings['dbhost'],
+                                                   settings['dbuser'],
+                                                   settings['dbpass'],
+                                                   settings['db_db'],
+                                                   local_infile=True)
+        cursor = cls._conn.cursor()
+        cursor.execute("SHOW VARIABLES LIKE 'local_infile'")
+        rows = cursor.fetchall()
+        cursor.close()
+        cls.local_infile = bool(rows) and rows[0][1] == 'ON'
+
+    @classmethod
+    def tearDownClass(cls):
+        cursor = cls._conn.cursor()
+        cursor.execute("SELECT DISTINCT teamid FROM projects "
+                       "WHERE extid LIKE %s", ('zz-load-%',))
+        team_ids = [row[0] for row in cursor.fetchall()]
+        cursor.execute("DELETE FROM metricdata WHERE prvid = %s AND "
+                       "datetime >= %s AND "
+                       "datetime < DATE_ADD(%s, INTERVAL 1 DAY)",
+                       (LOAD_PRVID, LOAD_DAY, LOAD_DAY))
+        cursor.execute("DELETE FROM projects WHERE extid LIKE %s",
+                       ('zz-load-%',))
+        cursor.execute("DELETE FROM metrictypes WHERE metricname LIKE %s",
+                       ('zz-load:%',))
+        for teamid in team_ids:
+            cursor.execute("DELETE FROM teams WHERE teamid = %s", (teamid,))
+        cls._conn.commit()
+        cursor.close()
+        cls._conn.close()
+
+    def make_load(self):
+        """ Return a DUBLoad of five hourly rows on LOAD_DAY """
+        parsed = cub_extract.ParsedMetrics(LOAD_PRVID, LOAD_DAY)
+        parsed.stats = [[LOAD_DAY + 'T%02d:00:00' % hour, 'zz-load-1',
+                         'zz-load:vm', str(hour * 10), 'hours',
+                         '%.3f' % (hour * 1.005 + 1)] for hour in range(5)]
+        parsed.note_dimensions(parsed.stats[0])
+        prv_def = ['Test', 'defs.json', 'test-', 'csv', 'day', '']
+        return cub_extract.DUBLoad(prv_def, LOAD_PRVID, parsed,
+                                   cub_extract.MetricDefs({'permetric': []}),
+                                   self._conn,
+                                   cub_extract.DimensionResolver(self._conn))
+
+    def day_totals(self):
+        """ Return (rows, SUM(cost)) of LOAD_DAY's metricdata """
+        cursor = self._conn.cursor()
+        cursor.execute("SELECT COUNT(*), SUM(cost) FROM metricdata "
+                       "WHERE prvid = %s AND datetime >= %s AND "
+                       "datetime < DATE_ADD(%s, INTERVAL 1 DAY)",
+                       (LOAD_PRVID, LOAD_DAY, LOAD_DAY))
+        totals = cursor.fetchall()[0]
+        cursor.close()
+        return totals
+
+    def clear_day(self):
+        """ Remove LOAD_DAY's metricdata """
+        cursor = self._conn.cursor()
+        cursor.execute("DELETE FROM metricdata WHERE prvid = %s AND "
+                       "datetime >= %s AND "
+                       "datetime < DATE_ADD(%s, INTERVAL 1 DAY)",
+                       (LOAD_PRVID, LOAD_DAY, LOAD_DAY))
+        self._conn.commit()
+        cursor.close()
+
+    def test_write_stats_batches(self):
+        """
+        Test every batch size, and LOAD DATA if the server allows it,
+        write what one INSERT per row (batch_rows=1) writes.
+        """
+        self.clear_day()
+        expected = None
+        for batch_rows, load_infile in [(1, False), (2, False), (5, False),
+                                        (6, False), (2, True)]:
+            if load_infile and not self.local_infile:
+                continue
+            self.make_load().write_stats(batch_rows, load_infile)
+            self._conn.commit()
+            totals = self.day_totals()
+            if expected is None:
+                expected = totals
+            self.assertEqual(totals, expected, msg=batch_rows)
+            self.clear_day()
+        self.assertEqual(expected[0], 5)
+
+    def test_reload_replaces_day(self):
+        """
+        Test loading a provider-day again replaces its rows, and a
+        corrected file's rows replace them too, bumping the
+        metricdata version each time.
+        """
+        self.clear_day()
+        self.make_load().write_stats(2)
+        self._conn.commit()
+        first = self.day_totals()
+        version = cub_extract.get_data_version(self._conn, 'metricdata')
+        self.make_load().write_stats(2, bump_version=True)
+        self._conn.commit()
+        self.assertEqual(self.day_totals(), first)
+        self.assertEqual(first[0], 5)
+        corrected = self.make_load()
+        corrected.current_stats.pop()
+        corrected.write_stats(2, bump_version=True)
+        self._conn.commit()
+        self.assertEqual(self.day_totals()[0], 4)
+        self.assertEqual(cub_extract.get_data_version(self._conn,
+                                                      'metricdata'),
+                         version + 2)
+        self.clear_day()
+
+    def test_write_stats_rollback(self):
+        """ Test a failing batch rolls back the batches before it """
+        self.clear_day()
+        dub_load = self.make_load()
+        bad_row = list(dub_load.current_stats[0])
+        # no such metric type
+        bad_row[2] = 65000
+        dub_load.current_stats.append(bad_row)
+        self.assertRaises(SystemExit, dub_load.write_stats, 2)
+        self.assertEqual(self.day_totals()[0], 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -8,7 +8,9 @@
 import datetime
 import calendar
 import json
+import time
 import unittest
+import MySQLdb
 
 # Local imports
 from app import dubwebdb
@@ -16,6 +18,34 @@ from app import utils
 
 SETTINGS_PATH = "/var/dubweb/.settings"
 
+class FailingCursor(object):
+    """ Server-side cursor stand-in whose second fetchmany fails """
+    def __init__(self):
+        self.fetches = 0
+
+    def execute(self, query, params=None):
+        """ Accept any query """
+        pass
+
+    def fetchmany(self, size):
+        """ Return one batch, then fail as a timed out stream would """
+        self.fetches += 1
+        if self.fetches > 1:
+            raise MySQLdb.OperationalError(1161, "net_write_timeout")
+        return [('2015-06-01', 'vm', 10, 'prj', 'prv', 'team')] * size
+
+    def close(self):
+        """ Nothing to release """
+        pass
+
+
+class FailingConn(object):
+    """ Connection stand-in handing out a FailingCursor """
+    def cursor(self, cursor_class=None):
+        """ Return the failing cursor """
+        return FailingCursor()
+
+
 class TestDubwebDB(unittest.TestCase):
     """ Test the primary dubweb costing library """
 
@@ -84,6 +114,27 @@ class TestDubwebDB(unittest.TestCase):
         self.assertGreater(date_filters.end,
                            date_filters.start + (29*24*60*60))
 
+    def test_budget_month_keys(self):
+        """ Test the budget month window keeps the months whose first
+            day starts within the timestamps.  """
+        start = time.mktime(datetime.datetime(2015, 3, 1).timetuple())
+        end = time.mktime(datetime.datetime(2015, 6, 30, 12).timetuple())
+        self.assertEqual(dubwebdb.budget_month_keys(start, end),
+                         (201503, 201506))
+        self.assertEqual(dubwebdb.budget_month_keys(start + 3600, end),
+                         (201504, 201506))
+        december = time.mktime(datetime.datetime(2015, 12, 2).timetuple())
+        self.assertEqual(dubwebdb.budget_month_keys(december, december),
+                         (201601, 201512))
+
+    def test_plan_budget_query(self):
+        """ Test that the windowed team budget query is index-only. """
+        all_ids = dubwebdb.Ids(prv_id=None, team_id=None,
+                               project_id=None, div_id=None)
+        query, params = dubwebdb.build_budget_by_teams_query(
+            all_ids, (201501, 201512))
+        self.assert_index_only(query, params, table='budgetdata')
+
     def test_get_prv_metric_buckets(self):
         """ Test the metric bucketing mechanism, which
             groups, by provider, metric names so provider workloads
@@ -217,6 +268,29 @@ class TestDubwebDB(unittest.TestCase):
         for series in csv_data:
             self.assertEqual(len(series), 41)
 
+    def test_multi_team_over_under(self):
+        """ Test a multi-team over/under csv is the single team tables
+            in order, and leaves the caller's ids alone. """
+        jan = datetime.datetime(2014, 12, 1, 0, 0, 0)
+        december = datetime.datetime(2015, 12, 31, 23, 59, 0)
+        def custom_time():
+            """ Return a fresh custom window """
+            return dubwebdb.CTimes(d_format="%Y-%m",
+                                   start_time=calendar.timegm(jan.timetuple()),
+                                   end_time=calendar.timegm(
+                                       december.timetuple()))
+        two_teams = dubwebdb.Ids(prv_id=None, team_id=["1", "2"],
+                                 project_id=None, div_id=None)
+        csv_data = dubwebdb.get_budget_over_under(custom_time(), two_teams)
+        self.assertEqual(two_teams.team, ["1", "2"])
+        expected = []
+        for team in ["1", "2"]:
+            one_team = dubwebdb.Ids(prv_id=None, team_id=[team],
+                                    project_id=None, div_id=None)
+            expected += dubwebdb.get_budget_over_under(custom_time(),
+                                                       one_team)
+        self.assertEqual(csv_data, expected)
+
     def test_dflt_csv_get_data_team(self):
         """ Test the API used for dubwebdb monthly team csv,
             Returning the default (last 3 months) dataset. """
@@ -450,6 +524,20 @@ class TestDubwebDB(unittest.TestCase):
         for series in json.loads(monthly_chart_data):
             self.assertEqual(len(series), 3)
 
+    def test_item_table_stream_error(self):
+        """ Test a stream failing after its first batch raises,
+            rather than ending in a believable Total: row. """
+        rows = []
+        stream = utils.stream_from_db("SELECT 1", None, FailingConn(),
+                                      batch_rows=2)
+        table = dubwebdb.iter_item_table(stream, ['Date', 'Item', 'Cost'],
+                                         inc_total=True, sum_col=2)
+        with self.assertRaises(MySQLdb.OperationalError):
+            for row in table:
+                rows.append(row)
+        self.assertEqual(len(rows), 3)
+        self.assertNotIn("Total:", [row[0] for row in rows])
+
     def test_daily_get_data_workload(self):
         """ Test the API used for dubwebdb daily workload
             chart, returning the default (last 30 days) dataset. """
@@ -493,6 +581,155 @@ class TestDubwebDB(unittest.TestCase):
         for series in json.loads(monthly_chart_data):
             self.assertEqual(len(series), 3)
 
+    def test_mon_estimate_data_workload(self):
+        """ Test the API used for dubwebdb estimate monthly workload
+            chart, which needs one provider and project. """
+        default_monthly_time = dubwebdb.CTimes(d_format="%Y-%m",
+                                               start_time=None, end_time=None)
+        one_prj = dubwebdb.Ids(prv_id=["1"], team_id=None,
+                               project_id=2, div_id=None)
+        monthly_chart_data = dubwebdb.estimate_data_workload(
+            default_monthly_time, one_prj)
+        for series in json.loads(monthly_chart_data):
+            self.assertEqual(len(series), 3)
+        no_prv = dubwebdb.Ids(prv_id=None, team_id=None,
+                              project_id=2, div_id=None)
+        self.assertEqual(json.loads(dubwebdb.estimate_data_workload(
+            default_monthly_time, no_prv)), [])
+
+    def test_materialized_estimates(self):
+        """ Test the forecasts table is only used for the default
+            window, and holds no past months. """
+        custom_time = dubwebdb.CTimes(d_format="%Y-%m",
+                                      start_time=None, end_time="1500000000")
+        self.assertIsNone(dubwebdb.get_materialized_estimates(custom_time,
+                                                              self._conn))
+
+        default_monthly_time = dubwebdb.CTimes(d_format="%Y-%m",
+                                               start_time=None, end_time=None)
+        this_month = time.strftime("%Y-%m")
+        stored = dubwebdb.get_materialized_estimates(default_monthly_time,
+                                                     self._conn)
+        for estimate in stored or []:
+            self.assertEqual(len(estimate), 4)
+            self.assertGreaterEqual(estimate[0], this_month)
+            self.assertGreaterEqual(estimate[3], 0)
+
+    def test_estimates_reconcile(self):
+        """ Test provider, team and division estimates all add up to
+            the project estimates. """
+        default_monthly_time = dubwebdb.CTimes(d_format="%Y-%m",
+                                               start_time=None, end_time=None)
+        all_ids = dubwebdb.Ids(prv_id=None, team_id=None,
+                               project_id=None, div_id=None)
+        totals = {}
+        for group_by in ("prjid", "teamid", "divid", "prvid"):
+            month_sums = {}
+            for month, _, spend in dubwebdb.get_estimates(
+                    default_monthly_time, all_ids, self._conn, group_by):
+                month_sums[month] = month_sums.get(month, 0) + spend
+            totals[group_by] = month_sums
+        # every test project has a team in a division
+        self.assertEqual(totals["teamid"], totals["prjid"])
+        self.assertEqual(totals["divid"], totals["prjid"])
+        self.assertEqual(totals["prvid"], totals["prjid"])
+
+    # Query plan tests follow
+    def assert_index_only(self, query, query_params, table='metricdata'):
+        """ Assert every access to table in the query's EXPLAIN plan
+            is served from an index alone. """
+        cursor = self._conn.cursor()
+        cursor.execute("EXPLAIN " + query, query_params)
+        columns = [col[0] for col in cursor.description]
+        plan = [dict(zip(columns, row)) for row in cursor.fetchall()]
+        cursor.close()
+        md_rows = [row for row in plan if row['table'] == table]
+        self.assertGreater(len(md_rows), 0)
+        for row in md_rows:
+            extra = [item.strip() for item in (row['Extra'] or '').split(';')]
+            self.assertIn('Using index', extra, msg=str(row))
+
+    def plan_windows(self):
+        """ Return a monthly window with partial days and months at both
+            ends, and a daily window, so every segment type is planned. """
+        start = time.mktime(datetime.datetime(2015, 1, 15, 12).timetuple())
+        end = time.mktime(datetime.datetime(2015, 4, 10, 13).timetuple())
+        monthly = dubwebdb.CTimes(d_format="%Y-%m", start_time=int(start),
+                                  end_time=int(end))
+        daily = dubwebdb.CTimes(d_format="%Y-%m-%d", start_time=int(start),
+                                end_time=int(end))
+        return monthly, daily
+
+    def test_plan_cube_query(self):
+        """ Test that the spend cube query behind the provider/team/
+            division/project charts, monthly and daily, is index-only. """
+        for my_time in self.plan_windows():
+            query, params = dubwebdb.build_cube_query(my_time, self._conn)
+            self.assert_index_only(query, params)
+
+    def test_cube_slices_agree(self):
+        """ Test that every grouping of the default monthly cube
+            adds up to the same monthly totals (within rounding). """
+        default_monthly_time = dubwebdb.CTimes(d_format="%Y-%m",
+                                               start_time=None, end_time=None)
+        mytime = dubwebdb.get_date_filters(default_monthly_time)
+        all_ids = dubwebdb.Ids(prv_id=None, team_id=None,
+                               project_id=None, div_id=None)
+        by_prv = dubwebdb.get_data_general(mytime, all_ids, self._conn,
+                                           group_by="prvid")
+        months = set(row[0] for row in by_prv)
+        for group_by in ("teamid", "prjid", "divid"):
+            rows = dubwebdb.get_data_general(mytime, all_ids, self._conn,
+                                             group_by=group_by)
+            self.assertEqual(set(row[0] for row in rows), months)
+            for month in months:
+                self.assertAlmostEqual(
+                    sum(row[2] for row in rows if row[0] == month),
+                    sum(row[2] for row in by_prv if row[0] == month),
+                    delta=len(rows))
+
+    def test_cube_provider_filter(self):
+        """ Test that a cube built for one provider slices the same as
+            the all-provider cube filtered to it. """
+        default_monthly_time = dubwebdb.CTimes(d_format="%Y-%m",
+                                               start_time=None, end_time=None)
+        mytime = dubwebdb.get_date_filters(default_monthly_time)
+        all_ids = dubwebdb.Ids(prv_id=None, team_id=None,
+                               project_id=None, div_id=None)
+        prv_ids = dubwebdb.Ids(prv_id=['1'], team_id=None,
+                               project_id=None, div_id=None)
+        full = dubwebdb.get_spend_cube(mytime, all_ids, self._conn)
+        one = dubwebdb.get_spend_cube(mytime, prv_ids, self._conn)
+        self.assertEqual(one.slice(prv_ids, "teamid"),
+                         full.slice(prv_ids, "teamid"))
+        self.assertEqual(set(one.result.values('prvid')) - set([1]), set())
+
+    def test_plan_item_cost_query(self):
+        """ Test that the item cost csv query is index-only. """
+        all_ids = dubwebdb.Ids(prv_id=None, team_id=None,
+                               project_id=None, div_id=None)
+        for my_time in self.plan_windows():
+            query, params = dubwebdb.build_item_cost_query(my_time, all_ids,
+                                                           self._conn)
+            self.assert_index_only(query, params)
+
+    def test_plan_workload_query(self):
+        """ Test that the daily workload query is index-only. """
+        one_prj = dubwebdb.Ids(prv_id="1", team_id=None,
+                               project_id=2, div_id=None)
+        query, params = dubwebdb.build_workload_query(self.plan_windows()[1],
+                                                      one_prj, self._conn)
+        self.assert_index_only(query, params)
+
+    def test_plan_estimate_queries(self):
+        """ Test that the estimate daily-point queries are index-only. """
+        all_ids = dubwebdb.Ids(prv_id=None, team_id=None,
+                               project_id=None, div_id=None)
+        for group_by in ("prvid", "teamid"):
+            query, params = dubwebdb.build_estimate_query(
+                self.plan_windows()[0], all_ids, self._conn, group_by)
+            self.assert_index_only(query, params)
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,234 @@
+#!/usr/bin/env python
+"""
+   Tests for dubforecast/forecast.py
+   Called via nosetests tests/test_forecast.py
+"""
+
+# Global imports
+import unittest
+import datetime as dt
+import time
+import numpy as np
+from dateutil.relativedelta import relativedelta
+# Local imports
+from dubforecast import forecast
+
+NOW = dt.datetime(2015, 6, 17, 10, 30)
+
+class Window(object):
+    """ Stand-in for dubwebdb.CTimes """
+    def __init__(self, end):
+        self.start = None
+        self.end = end
+
+
+def ref_month_stats(slice_len, stat_array):
+    """ One id's month statistics, as dubwebdb computed them """
+    sdict = {}
+    sdict['avg'] = np.mean(stat_array)
+    sdict['len'] = len(stat_array)
+    sdict['std'] = np.std(stat_array)
+    if not slice_len:
+        slice_len = sdict['len']
+    sdict['slice_avg'] = np.mean(stat_array[:slice_len])
+    return sdict
+
+
+def ref_forecast(times, my_id, current, prev):
+    """ One id's forecast, as dubwebdb computed it """
+    stats_list = []
+    decay = 1.0
+    if prev:
+        trend = current['slice_avg'] / prev['slice_avg']
+        if trend < 0:
+            decay = -1.0
+    else:
+        trend = 1.0
+    fcast = dt.datetime.fromtimestamp(float(times.start))
+    endtime = dt.datetime.fromtimestamp(float(times.end))
+    firstofmonth = NOW + relativedelta(day=1)
+    if not prev or current['std'] == 0.0:
+        dailyspend = current['avg']
+    else:
+        dailyspend = prev['avg']
+    while fcast < endtime:
+        fcast = fcast + relativedelta(day=1, months=+1, days=-1)
+        daycount = int(fcast.strftime('%d'))
+        if fcast > firstofmonth:
+            stats_list.append([fcast.strftime('%Y-%m'), my_id,
+                               int(dailyspend * daycount)])
+        fcast = fcast + relativedelta(days=+1)
+        dailyspend *= trend
+        trend = (trend + decay + decay) / 3.0
+    return stats_list
+
+
+def ref_estimate(end_ts, series):
+    """ series: {id: [(YYYYMMDD, spend), ...]}, forecast id by id """
+    times = Window(end_ts)
+    stats_list = []
+    for my_id in sorted(series):
+        months = {}
+        for day_key, spend in sorted(series[my_id]):
+            months.setdefault(day_key // 100, []).append(spend)
+        keys = sorted(months)
+        curmon = dt.datetime(keys[-1] // 100, keys[-1] % 100, 1)
+        times.start = int(time.mktime(curmon.timetuple()))
+        if times.end < times.start + forecast.DEFAULT_FORECAST_PERIOD:
+            times.end = int(time.mktime(
+                (curmon + relativedelta(months=3)).timetuple()))
+        cur = ref_month_stats(None, np.array(months[keys[-1]], dtype=float))
+        prev = {}
+        if len(keys) > 1:
+            prev = ref_month_stats(cur['len'],
+                                   np.array(months[keys[-2]], dtype=float))
+        stats_list += ref_forecast(times, my_id, cur, prev)
+    return stats_list
+
+
+def make_batch(series):
+    """ Build a SeriesBatch from {id: [(YYYYMMDD, spend), ...]} """
+    ids = sorted(series)
+    day_keys = sorted(set(day for rows in series.values() for day, _ in rows))
+    id_codes, day_codes, values = [], [], []
+    for id_idx, my_id in enumerate(ids):
+        for day_key, spend in series[my_id]:
+            id_codes.append(id_idx)
+            day_codes.append(day_keys.index(day_key))
+            values.append(spend)
+    return forecast.SeriesBatch.from_codes(ids, day_keys, id_codes,
+                                           day_codes, values)
+
+
+def day_keys_between(start, days):
+    """ Return YYYYMMDD keys for days consecutive days from start """
+    return [int((start + dt.timedelta(days=day)).strftime('%Y%m%d'))
+            for day in range(days)]
+
+
+class TestForecast(unittest.TestCase):
+    """ Standard test class, for all forecast functions """
+
+    def setUp(self):
+        rand = np.random.RandomState(42)
+        days = day_keys_between(dt.date(2015, 3, 1), 108)
+        self.series = {}
+        for my_id in range(1, 41):
+            # ids start, stop and skip days at random
+            first = rand.randint(0, 80)
+            keep = rand.rand(len(days) - first) > 0.1
+            keep[0] = True
+            self.series[my_id] = [(day, int(rand.randint(1, 500)))
+                                  for day, ok in zip(days[first:], keep)
+                                  if ok]
+        # flat, single month, growing, and sign flipping series
+        self.series[50] = [(day, 100) for day in days]
+        self.series[51] = [(day, 7) for day in days[-10:]]
+        self.series[52] = [(day, idx + 1) for idx, day in enumerate(days)]
+        self.series[53] = [(day, 50 if day < 20150601 else -30 - day % 3)
+                           for day in days]
+
+    def test_decay_forecast_matches_reference(self):
+        """ Test the batch forecast against id by id forecasting """
+        end_ts = int(time.mktime(dt.datetime(2015, 7, 31).timetuple()))
+        expected = ref_estimate(end_ts, self.series)
+        actual = forecast.decay_forecast(make_batch(self.series), end_ts,
+                                         now=NOW)
+        self.assertEqual([row[:3] for row in actual], expected)
+
+    def test_decay_forecast_long_window(self):
+        """ Test a window reaching well past the default period """
+        end_ts = int(time.mktime(dt.datetime(2016, 1, 15, 12).timetuple()))
+        expected = ref_estimate(end_ts, self.series)
+        actual = forecast.decay_forecast(make_batch(self.series), end_ts,
+                                         now=NOW)
+        self.assertEqual([row[:3] for row in actual], expected)
+        self.assertGreater(len(actual), len(self.series))
+
+    def test_decay_forecast_skips_zero_month(self):
+        """ Test a zero previous month yields no infinite estimates """
+        series = {1: [(20150528, 0), (20150529, 0), (20150601, 10)]}
+        end_ts = int(time.mktime(dt.datetime(2015, 9, 1).timetuple()))
+        actual = forecast.decay_forecast(make_batch(series), end_ts, now=NOW)
+        self.assertEqual([row[:3] for row in actual], [['2015-06', 1, 300]])
+
+    def test_series_batch_from_rows(self):
+        """ Test building a batch from (day, id, spend) query rows """
+        rows = [(day, my_id, spend) for my_id in sorted(self.series)
+                for day, spend in self.series[my_id]]
+        batch = forecast.SeriesBatch.from_rows(rows)
+        self.assertEqual(batch.ids, sorted(self.series))
+        self.assertEqual(batch.values.shape, (len(self.series), 108))
+        self.assertEqual(forecast.decay_forecast(batch, 0, now=NOW),
+                         forecast.decay_forecast(make_batch(self.series), 0,
+                                                 now=NOW))
+
+    def test_daily_models(self):
+        """ Test each model continues series it can describe exactly """
+        days = day_keys_between(dt.date(2015, 3, 2), 70)
+        ahead = day_keys_between(dt.date(2015, 5, 11), 14)
+        series = {1: [(day, 40) for day in days],
+                  2: [(day, 10 + 3 * idx) for idx, day in enumerate(days)]}
+        batch = make_batch(series)
+        for name in forecast.MODELS:
+            predicted = forecast.get_model(name).fit(batch).predict(ahead)
+            self.assertEqual(predicted.shape, (2, len(ahead)))
+            np.testing.assert_allclose(predicted[0], 40.0, rtol=1e-6)
+        linear = forecast.get_model("linear").fit(batch).predict(ahead)
+        np.testing.assert_allclose(linear[1], 10 + 3 * np.arange(70, 84),
+                                   rtol=1e-9)
+        runrate = forecast.get_model("runrate").fit(batch).predict(ahead)
+        np.testing.assert_allclose(runrate[1], 10 + 3 * np.arange(56, 70).mean())
+
+    def test_holtwinters_weekly(self):
+        """ Test Holt-Winters picks up a weekday/weekend pattern """
+        days = day_keys_between(dt.date(2015, 3, 2), 84)
+        series = {1: [(day, 20 if idx % 7 < 5 else 5)
+                      for idx, day in enumerate(days)]}
+        ahead = day_keys_between(dt.date(2015, 5, 25), 7)
+        predicted = forecast.get_model("holtwinters").fit(
+            make_batch(series)).predict(ahead)
+        self.assertGreater(predicted[0][:5].min(), predicted[0][5:].max())
+
+    def test_model_forecast(self):
+        """ Test monthly forecasts of any model cover decay's months """
+        end_ts = int(time.mktime(dt.datetime(2015, 7, 31).timetuple()))
+        batch = make_batch(self.series)
+        decay = forecast.decay_forecast(batch, end_ts, now=NOW)
+        runrate = forecast.model_forecast(forecast.get_model("runrate"),
+                                          batch, end_ts, now=NOW)
+        self.assertEqual([row[:2] for row in runrate],
+                         [row[:2] for row in decay])
+        self.assertRaises(ValueError, forecast.get_model, "none")
+
+    def test_rollup_forecast(self):
+        """ Test summing forecasts into parents """
+        rows = [['2015-06', 1, 10, 3], ['2015-07', 1, 11, 5],
+                ['2015-06', 2, 5, 4], ['2015-06', 3, 7, 2]]
+        self.assertEqual(forecast.rollup_forecast(rows, {1: 9, 2: 9, 3: 8}),
+                         [['2015-06', 8, 7, 2], ['2015-06', 9, 15, 5],
+                          ['2015-07', 9, 11, 5]])
+        self.assertEqual(forecast.rollup_forecast(rows, {3: 8}),
+                         [['2015-06', 8, 7, 2]])
+
+    def test_forecast_bands(self):
+        """ Test sigma grows with the months ahead and bounds bands """
+        series = {1: [(day, 100 + 10 * (day % 2))
+                      for day in day_keys_between(dt.date(2015, 6, 1), 17)]}
+        end_ts = int(time.mktime(dt.datetime(2015, 8, 31).timetuple()))
+        actual = forecast.decay_forecast(make_batch(series), end_ts, now=NOW)
+        sigmas = [row[3] for row in actual]
+        self.assertEqual(len(sigmas), 3)
+        self.assertGreater(sigmas[0], 0)
+        self.assertEqual(sigmas, sorted(sigmas))
+        self.assertEqual(forecast.bands(100, 10), (87, 100, 113))
+        self.assertEqual(forecast.bands(100, 0), (100, 100, 100))
+
+    def test_decay_forecast_empty(self):
+        """ Test an empty batch """
+        batch = forecast.SeriesBatch.from_codes([], [], [], [], [])
+        self.assertEqual(forecast.decay_forecast(batch, 0, now=NOW), [])
+
+
+if __name__ == "__main__":
+    unittest.main()